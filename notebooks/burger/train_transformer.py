@@ -41,6 +41,8 @@ def train(config, checkpoint_dir):
     #d_ff = 512
     window_size = 10#config['window_size']
     batch_size = 16#config['batch_size']
+    accumulation_steps = config.get('accumulation_steps', 1) ### mini-batches per optimizer step, see TrainEngine
+    use_compile = config.get('compile', False)
     
     #model = Tranformer(feature_size=feature_size,num_layers=num_layer,dropout=dropout,num_head=num_head)
     model = Tranformer(feature_size=feature_size,num_enc_layers=num_enc_layers,num_dec_layers = num_dec_layers,\
@@ -66,18 +68,15 @@ def train(config, checkpoint_dir):
     train_loader,val_loader, test_loader = get_data_loaders(train_proportion, test_proportion, val_proportion,\
          window_size=window_size, pred_size =1, batch_size=batch_size, num_workers = 2, pin_memory = False)
 
-    for epoch in range(1, epochs + 1):
-        model.train() 
-        total_loss = 0.
+    def loss_fn(batch):
+        data, targets = batch
+        data, targets = data.to(device), targets.to(device)
+        output = model(data, targets) 
+        return criterion(output, targets)
+    engine = TrainEngine(model, optimizer, loss_fn, accumulation_steps=accumulation_steps, use_compile=use_compile)
 
-        for i, (data, targets) in enumerate(train_loader):
-            data, targets = data.to(device), targets.to(device)
-            optimizer.zero_grad()
-            output = model(data, targets) 
-            loss = criterion(output, targets)
-            total_loss += loss.item()
-            loss.backward()
-            optimizer.step()
+    for epoch in range(1, epochs + 1):
+        total_loss = engine.run_epoch(train_loader)
             
         val_loss = evaluate(model, val_loader, criterion)
         print(f'Epoch: {epoch}, train_loss: {total_loss}, val_loss: {val_loss}')
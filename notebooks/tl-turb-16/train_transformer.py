@@ -89,6 +89,8 @@ def train(config, checkpoint_dir):
     pe_type = config['pe_type']
     feature_size = config['feature_size']
     batch_size = config['batch_size']
+    accumulation_steps = config.get('accumulation_steps', 1) ### mini-batches per optimizer step, see TrainEngine
+    use_compile = config.get('compile', False)
 
     scale = False
     num_enc_layers = 1
@@ -128,21 +130,18 @@ def train(config, checkpoint_dir):
         test_mode = False, scale = scale, window_size = window_size, patch_size = patch_size)
 
 
+    def loss_fn(batch):
+        ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) = batch
+        src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
+                                                        src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
+        dec_inp = torch.zeros([tgt.shape[0], x1*x2*x3, tgt.shape[-1]]).float().to(device)
+        dec_inp = torch.cat([tgt[:,:(tgt.shape[1]-x1*x2*x3),:], dec_inp], dim=1).float().to(device)
+        output = model(src, dec_inp, src_coord, tgt_coord, src_ts, tgt_ts)
+        return criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:])
+    engine = TrainEngine(model, optimizer, loss_fn, accumulation_steps=accumulation_steps, use_compile=use_compile)
+
     for epoch in range(1, epochs + 1):
-        model.train() 
-        total_loss = 0.
-
-        for i, ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) in enumerate(train_loader):
-            src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
-                                                            src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
-            optimizer.zero_grad()
-            dec_inp = torch.zeros([tgt.shape[0], x1*x2*x3, tgt.shape[-1]]).float().to(device)
-            dec_inp = torch.cat([tgt[:,:(tgt.shape[1]-x1*x2*x3),:], dec_inp], dim=1).float().to(device)
-            output = model(src, dec_inp, src_coord, tgt_coord, src_ts, tgt_ts)
-            loss = criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:])
-            total_loss += loss.item()
-            loss.backward()
-            optimizer.step()
+        total_loss = engine.run_epoch(train_loader)
 
         train_loss = total_loss*batch_size/len(train_loader.dataset)
         val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size)
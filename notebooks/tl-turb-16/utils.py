@@ -9,31 +9,18 @@ from sklearn.preprocessing import StandardScaler
 from matplotlib import animation
 import matplotlib.pyplot as plt
 
-def get_rho(data_path):
+def get_rho(data_path, num_workers = 8):
     lst = sorted(os.listdir(data_path))[4:-1]
-    rho = []
-    coords = []
-    timestamps = []
-    for name in lst:
-        path = data_path+'/'+name
-        d = athdf(path)
-        nx1 = len(d['x1v'])
-        nx2 = len(d['x2v'])
-        nx3 = len(d['x3v'])
-        coord = np.transpose(np.array(np.meshgrid(np.arange(nx1),np.arange(nx2),np.arange(nx3))), axes=[2,1,3,0]).reshape(-1,3)
-        rho.append(d['rho'])
-        timestamp_repeated = [d['Time']]*(np.prod(d['rho'].shape))
-        timestamps.extend(timestamp_repeated) ### Add nx1*nx2*nx3 time values into the output list
-        #print('rho:',d['rho'].shape, 'coord.shape:',coord.shape,'len timestamp:',len(timestamp_repeated))
-        coords.extend(coord)
-
-    rho = np.array(rho)
+    series = athdf_series([data_path+'/'+name for name in lst], ['rho'], num_workers=num_workers)
+    nx1 = len(series['x1v'])
+    nx2 = len(series['x2v'])
+    nx3 = len(series['x3v'])
+    coord = np.transpose(np.array(np.meshgrid(np.arange(nx1),np.arange(nx2),np.arange(nx3))), axes=[2,1,3,0]).reshape(-1,3)
+    rho = series['data'][...,0]
     meshed_blocks = (nx1, nx2, nx3)
-    timestamps = np.array(timestamps)
-    uniq, index = np.unique(timestamps, return_index=True)
-    uniq[index.argsort()]
+    timestamps = np.repeat(series['Time'], np.prod(rho.shape[1:])) ### nx1*nx2*nx3 time values per snapshot
     rho_reshaped = rho.flatten()
-    coords = np.array(coords)
+    coords = np.tile(coord, (len(lst),1))
     #print(f'rho shape: {rho_reshaped.shape}, coords shape: {coords.shape}')
     return rho_reshaped, meshed_blocks, coords, timestamps
 
@@ -103,6 +90,40 @@ class CustomDataset(torch.utils.data.Dataset):
         return((self.x[idx][0].view(-1,1), self.x[idx][1].view(-1,1)),(self.coords[idx][0], self.coords[idx][1]),(self.timestamp[idx][0].view(-1,1), self.timestamp[idx][1].view(-1,1)))
     
 
+class TrainEngine():
+    """
+    Training epochs whose optimizer steps sum the gradients of accumulation_steps micro-batches, an effective batch of
+    accumulation_steps*batch_size; the batch losses are summed on the device and read once per epoch
+    loss_fn: maps a batch of the loader to its scalar loss
+    use_compile: wrap loss_fn (forward and loss) in torch.compile
+    """
+    def __init__(self, model, optimizer, loss_fn, accumulation_steps=1, use_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        self.loss_fn = torch.compile(loss_fn) if use_compile else loss_fn
+
+    def run_epoch(self, loader):
+        """
+        One pass over loader; returns the sum of the batch losses, the only device sync of the epoch
+        """
+        self.model.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        num_batches = len(loader)
+        total_loss = None
+        for i, batch in enumerate(loader):
+            ### the last step of the epoch may accumulate fewer micro-batches, its gradient is still their mean
+            group_start = i - i%self.accumulation_steps
+            group_size = min(self.accumulation_steps, num_batches-group_start)
+            loss = self.loss_fn(batch)
+            (loss/group_size).backward()
+            total_loss = loss.detach() if total_loss is None else total_loss + loss.detach()
+            if i+1 == group_start+group_size:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+        return 0. if total_loss is None else total_loss.item()
+
+
 def get_data_loaders(train_proportion = 0.5, test_proportion = 0.25, val_proportion = 0.25,\
                         pred_size =1, batch_size = 16, num_workers = 1, pin_memory = True, \
                         use_coords = True, use_time = True, test_mode = False, scale = False, \
@@ -51,6 +51,40 @@ class CustomDataset(torch.utils.data.Dataset):
     def __getitem__(self,idx):
         return(self.x[idx][0].view(-1,1),self.x[idx][1].view(-1,1))
     
+class TrainEngine():
+    '''
+    Training epochs whose optimizer steps sum the gradients of accumulation_steps micro-batches, an effective batch of
+    accumulation_steps*batch_size; the batch losses are summed on the device and read once per epoch
+    loss_fn: maps a batch of the loader to its scalar loss
+    use_compile: wrap loss_fn (forward and loss) in torch.compile
+    '''
+    def __init__(self, model, optimizer, loss_fn, accumulation_steps=1, use_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        self.loss_fn = torch.compile(loss_fn) if use_compile else loss_fn
+
+    def run_epoch(self, loader):
+        '''
+        One pass over loader; returns the sum of the batch losses, the only device sync of the epoch
+        '''
+        self.model.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        num_batches = len(loader)
+        total_loss = None
+        for i, batch in enumerate(loader):
+            ### the last step of the epoch may accumulate fewer micro-batches, its gradient is still their mean
+            group_start = i - i%self.accumulation_steps
+            group_size = min(self.accumulation_steps, num_batches-group_start)
+            loss = self.loss_fn(batch)
+            (loss/group_size).backward()
+            total_loss = loss.detach() if total_loss is None else total_loss + loss.detach()
+            if i+1 == group_start+group_size:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+        return 0. if total_loss is None else total_loss.item()
+
+
 def get_data_loaders(train_proportion = 0.6, test_proportion = 0.2, val_proportion = 0.2,window_size = 10, \
     pred_size =1, batch_size = 10, num_workers = 1, pin_memory = True, test_mode = False): 
 
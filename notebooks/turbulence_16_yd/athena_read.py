@@ -7,6 +7,7 @@ import re
 import struct
 import sys
 import warnings
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from io import open  # Consistent binary I/O from Python 2 and 3
 
 # Other Python modules
@@ -332,12 +333,15 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
           return_levels=False, subsample=False, fast_restrict=False, x1_min=None,
           x1_max=None, x2_min=None, x2_max=None, x3_min=None, x3_max=None, vol_func=None,
           vol_params=None, face_func_1=None, face_func_2=None, face_func_3=None,
-          center_func_1=None, center_func_2=None, center_func_3=None, num_ghost=0):
+          center_func_1=None, center_func_2=None, center_func_3=None, num_ghost=0,
+          vectorized=False):
     """Read .athdf files and populate dict of arrays of data.
 
 
     Keyword arguments:
     raw -- if True, do not merge MeshBlocks into a single array (default False)
+    vectorized -- if True, read each dataset once and place all MeshBlocks at or below
+        the output level with array indexing instead of per-block reads (default False)
     """
 
     # Load HDF5 reader
@@ -726,8 +730,71 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
         if not subsample and not fast_restrict and max_level > level:
             restricted_data = np.zeros((lx3, lx2, lx1), dtype=bool)
 
+        # Place same-level and coarser blocks from whole-dataset reads
+        assembled_blocks = np.zeros(num_blocks, dtype=bool)
+        if vectorized and num_ghost == 0:
+            select = x1_select or x2_select or x3_select
+            if select:
+                merged = {q: np.zeros((nx3, nx2, nx1), dtype=dtype) for q in quantities}
+                merged_levels = np.zeros((nx3, nx2, nx1), dtype=np.int32)
+            else:
+                merged = {q: data[q] for q in quantities}
+                merged_levels = data['Levels'] if return_levels else None
+
+            # Read each needed dataset once as (nvar, nblocks, nz, ny, nx)
+            dataset_arrays = {}
+            for dataset in set(quantity_datasets):
+                dataset_arrays[dataset] = f[dataset][...]
+
+            for block_level in np.unique(levels[levels <= level]):
+                block_nums = np.where(levels == block_level)[0]
+                s = 2 ** (level - block_level)
+
+                # Calculate destination indices of every cell, per dimension
+                index_arrays = []
+                for d, nx in enumerate(nx_vals):
+                    if nx > 1:
+                        offsets = logical_locations[block_nums, d] * block_size[d] * s
+                        cells = np.arange(block_size[d] * s)
+                    else:
+                        offsets = np.zeros(len(block_nums), dtype=np.int64)
+                        cells = np.arange(1)
+                    index_arrays.append(offsets[:, None] + cells[None, :])
+                i_d, j_d, k_d = index_arrays
+                destination = (k_d[:, :, None, None], j_d[:, None, :, None],
+                               i_d[:, None, None, :])
+
+                # Assign values
+                for q, dataset, index in zip(quantities, quantity_datasets,
+                                             quantity_indices):
+                    block_data = dataset_arrays[dataset][index, block_nums]
+                    if s > 1:
+                        if nx1 > 1:
+                            block_data = np.repeat(block_data, s, axis=3)
+                        if nx2 > 1:
+                            block_data = np.repeat(block_data, s, axis=2)
+                        if nx3 > 1:
+                            block_data = np.repeat(block_data, s, axis=1)
+                    merged[q][destination] = block_data
+                if return_levels:
+                    merged_levels[destination] = block_level
+                assembled_blocks[block_nums] = True
+            del dataset_arrays
+
+            # Account for selection
+            if select:
+                for q in quantities:
+                    data[q][...] = merged[q][k_min:k_max, j_min:j_max, i_min:i_max]
+                if return_levels:
+                    data['Levels'][...] = merged_levels[k_min:k_max, j_min:j_max,
+                                                        i_min:i_max]
+
         # Go through blocks in data file
         for block_num in range(num_blocks):
+            # Skip blocks already placed above
+            if assembled_blocks[block_num]:
+                continue
+
             # Extract location information
             block_level = levels[block_num]
             block_location = logical_locations[block_num, :]
@@ -948,6 +1015,89 @@ def athdf(filename, raw=False, data=None, quantities=None, dtype=None, level=Non
     return data
 
 
+# ========================================================================================
+
+def athdf_series(filenames, quantities, num_workers=1, max_in_flight=None, grid_size=None,
+                 coarsen_method='mean', **kwargs):
+    """Read a time series of .athdf files into a single preallocated array.
+
+    Each file is opened once and all requested quantities are read in that pass. With
+    num_workers > 1 files are read by a pool of processes, with at most max_in_flight
+    files (default 2*num_workers) outstanding at any time.
+
+    Returns a dict with 'Time' (num_files,), 'x1v', 'x2v', 'x3v' from the first file,
+    'VariableNames' and 'data' of shape (num_files, nz, ny, nx, num_quantities), where
+    data[n, ..., c] is athdf(filenames[n])[quantities[c]].
+
+    Keyword arguments:
+    num_workers -- number of reader processes (default 1, read in this process)
+    max_in_flight -- maximum number of files being read at once (default 2*num_workers)
+    grid_size -- if given, each snapshot is coarsened to this size with coarsen() as soon
+        as it is read, so the full-resolution series is never held in memory
+    coarsen_method -- method passed to coarsen(); 'volume' weights by the cell volumes
+        computed from the face coordinates of each file
+    kwargs -- passed to athdf(); vectorized defaults to True
+    """
+
+    filenames = list(filenames)
+    quantities = [str(q) for q in quantities]
+    if len(filenames) == 0:
+        raise AthenaError('No files given')
+    kwargs.setdefault('vectorized', True)
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+
+    series = {'VariableNames': np.array(quantities)}
+
+    def store(file_num, result):
+        time, values, coords = result
+        if 'data' not in series:
+            series['data'] = np.empty((len(filenames),) + values.shape, dtype=values.dtype)
+            series['Time'] = np.empty(len(filenames))
+        if file_num == 0:
+            series['x1v'], series['x2v'], series['x3v'] = coords
+        series['data'][file_num] = values
+        series['Time'][file_num] = time
+
+    if num_workers <= 1:
+        for file_num, filename in enumerate(filenames):
+            store(file_num, _athdf_snapshot(filename, quantities, kwargs, grid_size,
+                                            coarsen_method))
+        return series
+
+    # Keep a bounded window of files in flight and fill the output as reads finish
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = {}
+        next_file = 0
+        while next_file < len(filenames) or pending:
+            while next_file < len(filenames) and len(pending) < max_in_flight:
+                future = executor.submit(_athdf_snapshot, filenames[next_file], quantities,
+                                         kwargs, grid_size, coarsen_method)
+                pending[future] = next_file
+                next_file += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                store(pending.pop(future), future.result())
+    return series
+
+
+def _athdf_snapshot(filename, quantities, kwargs, grid_size=None, coarsen_method='mean'):
+    """Read one file for athdf_series(), stacking quantities along the last axis."""
+    data = athdf(filename, quantities=quantities, **kwargs)
+    values = np.stack([data[q] for q in quantities], axis=-1)
+    coords = (data['x1v'], data['x2v'], data['x3v'])
+    if grid_size is not None:
+        volumes = None
+        if coarsen_method == 'volume':
+            dx1, dx2, dx3 = [np.diff(data['x{0}f'.format(d)]) for d in (1, 2, 3)]
+            volumes = dx3[:, None, None] * dx2[None, :, None] * dx1[None, None, :]
+        values = coarsen(values[None], grid_size, coarsen_method, volumes)[0]
+        # Cell centers of the coarse grid, one per block of fine cells
+        coords = tuple(np.mean(np.reshape(x, (g, -1)), axis=1)
+                       for x, g in zip(coords, values.shape[2::-1]))
+    return data['Time'], values, coords
+
+
 # ========================================================================================
 
 def restrict_like(vals, levels, vols=None):
@@ -1003,6 +1153,78 @@ def restrict_like(vals, levels, vols=None):
     return vals_restricted
 
 
+# ========================================================================================
+
+def coarsen(data, grid_size, method='mean', volumes=None, chunk_bytes=2**28):
+    """Coarsen a batch of uniform grids by reducing non-overlapping blocks of cells.
+
+    data has shape (T, n1, n2, n3) or (T, n1, n2, n3, C). Each spatial axis is split
+    into grid_size blocks of coef = n // grid_size cells and every block is reduced in
+    one reshape to (T, g1, coef1, g2, coef2, g3, coef3, ...), so all snapshots and
+    variables are handled together. Work is split into chunks of at most about
+    chunk_bytes of input, along time and then along the first spatial axis, which keeps
+    memory bounded for large (e.g. 512^3) grids and allows np.memmap input.
+
+    Keyword arguments:
+    grid_size -- int or (g1, g2, g3), number of cells of the coarse grid along each axis
+    method -- 'mean', 'max' or 'volume' (average weighted by volumes)
+    volumes -- (n1, n2, n3) array of cell volumes, required for method='volume'
+    chunk_bytes -- approximate size of the input processed at once
+    """
+
+    if method not in ('mean', 'max', 'volume'):
+        raise AthenaError('Unknown coarsening method: {0}'.format(method))
+    if np.isscalar(grid_size):
+        grid_size = (int(grid_size),) * 3
+    shape = data.shape
+    if data.ndim not in (4, 5):
+        raise AthenaError('Data must have shape (T, n1, n2, n3) or (T, n1, n2, n3, C)')
+    coefs = []
+    for n, g in zip(shape[1:4], grid_size):
+        if n % g != 0:
+            raise AthenaError('Grid of size {0} cannot be coarsened to {1}'.format(n, g))
+        coefs.append(n // g)
+    g1, g2, g3 = grid_size
+    c1, c2, c3 = coefs
+    trailing = shape[4:]
+    if method == 'volume':
+        if volumes is None:
+            raise AthenaError('Cell volumes are required for volume-weighted coarsening')
+        volumes = np.asarray(volumes, dtype=np.float64)
+        if volumes.shape != shape[1:4]:
+            raise AthenaError('Array of volumes must match the spatial shape of the data')
+        vols = np.reshape(volumes, (g1, c1, g2, c2, g3, c3) + (1,) * len(trailing))
+        vols_sum = np.sum(vols, axis=(1, 3, 5))
+
+    out_dtype = data.dtype if method == 'max' else np.float64
+    coarse = np.empty((shape[0], g1, g2, g3) + trailing, dtype=out_dtype)
+
+    # Chunk along time first, then along blocks of the first spatial axis
+    row_bytes = data.itemsize * c1 * int(np.prod(shape[2:]))
+    rows_per_chunk = max(1, chunk_bytes // row_bytes)
+    if rows_per_chunk >= g1:
+        t_step = max(1, rows_per_chunk // g1)
+        i_step = g1
+    else:
+        t_step = 1
+        i_step = rows_per_chunk
+    for t in range(0, shape[0], t_step):
+        for i in range(0, g1, i_step):
+            block = np.asarray(data[t:t+t_step, i*c1:(i+i_step)*c1])
+            nt, ni = block.shape[0], block.shape[1] // c1
+            block = np.reshape(block, (nt, ni, c1, g2, c2, g3, c3) + trailing)
+            if method == 'mean':
+                reduced = np.mean(block, axis=(2, 4, 6), dtype=np.float64)
+            elif method == 'max':
+                reduced = np.max(block, axis=(2, 4, 6))
+            else:
+                block_vols = vols[i:i+ni]
+                reduced = (np.sum(block * block_vols, axis=(2, 4, 6), dtype=np.float64)
+                           / vols_sum[i:i+ni])
+            coarse[t:t+nt, i:i+ni] = reduced
+    return coarse
+
+
 # ========================================================================================
 
 def athinput(filename):
@@ -0,0 +1,49 @@
+#!/bin/bash python
+import time
+import torch
+from tmsa import scaled_attention, AttentionMask
+from transformer_test import Transformer
+
+def run(backend, q, k, v, mask, repeats):
+    '''Mean time of one attention call, and its peak device memory on cuda (None on cpu)'''
+    scaled_attention(q, k, v, mask, backend=backend) ### warm up
+    if q.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(repeats):
+        out = scaled_attention(q, k, v, mask, backend=backend)
+    if q.is_cuda:
+        torch.cuda.synchronize()
+        return out, (time.time()-start_time)/repeats, torch.cuda.max_memory_allocated()
+    return out, (time.time()-start_time)/repeats, None
+
+def benchmark(window_sizes=(5, 10, 15, 20), patch_size=(4,4,4), batch_size=64, num_heads=4, head_dim=16, repeats=5):
+    '''
+    Self-attention over window_size x patch_length tokens under the block-causal patch mask: the dense masked scores
+    against the time blocks of block_sparse, which only computes the past and current blocks
+    batch_size: sequences per call, e.g. the patches of a 16^3 grid with 4x4x4 patches
+    '''
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    patch_length = patch_size[0]*patch_size[1]*patch_size[2]
+    model = Transformer(feature_size=12, pe_type='3d', grid_size=16, mask_type='patch', patch_size=patch_size)
+    for window_size in window_sizes:
+        L = window_size*patch_length
+        q, k, v = torch.randn((3, batch_size, num_heads, L, head_dim), device=device).unbind(0)
+        ### the keys of each query read once, as the model does
+        mask = AttentionMask(model._generate_patch_mask(patch_size, window_size).to(device))
+        ### scores computed by the dense version and by the causal blocks
+        dense_scores = L*L
+        sparse_scores = patch_length*patch_length*window_size*(window_size+1)//2
+        outputs, timings, memory = {}, {}, {}
+        for backend in ['math', 'block_sparse']:
+            outputs[backend], timings[backend], memory[backend] = run(backend, q, k, v, mask, repeats)
+        assert torch.allclose(outputs['math'], outputs['block_sparse'], atol=1e-5), 'Mismatch between attention backends'
+        line = f'window {window_size} ({L} tokens): dense {timings["math"]*1e3:.1f} ms, block sparse {timings["block_sparse"]*1e3:.1f} ms, '\
+               f'speedup {timings["math"]/timings["block_sparse"]:.2f}x, scores {dense_scores/sparse_scores:.2f}x fewer'
+        if memory['math'] is not None:
+            line += f', peak memory {memory["math"]/2**20:.0f} MiB vs {memory["block_sparse"]/2**20:.0f} MiB'
+        print(line, flush=True)
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,63 @@
+#!/bin/bash python
+import time
+import torch
+from tmsa import ACTIVATION_CHECKPOINTS
+from transformer import Transformer
+from unet import Unet
+
+def run(model, inputs, repeats):
+    '''Mean time of one training forward and backward, and its peak device memory on cuda (None on cpu)'''
+    model(*inputs).square().mean().backward() ### warm up
+    model.zero_grad(set_to_none=True)
+    device = inputs[0].device
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(repeats):
+        model(*inputs).square().mean().backward()
+        model.zero_grad(set_to_none=True)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        return (time.time()-start_time)/repeats, torch.cuda.max_memory_allocated()
+    return (time.time()-start_time)/repeats, None
+
+def build(family, policy, grid_size, feature_size, window_size, patch_size):
+    '''The model of family ('transformer' or 'unet') under an activation_checkpoint policy, with fixed weights'''
+    torch.manual_seed(1008)
+    if family == 'unet':
+        return Unet(feature_size=feature_size, conv_config={'num_layer': 3, 'start_filts': 32}, activation_checkpoint=policy)
+    tmsa_config = {'use_tmsa': True, 'use_tgt_tmsa': True, 'window_patch_size': (2,4,4,4), 'shift_size': (1,2,2,2), 'depth': 4,
+                   'num_heads': 4, 'pos_insert': 'both', 'attn_backend': 'math'}
+    return Transformer(None, feature_size=feature_size, num_enc_layers=2, num_dec_layers=3, d_ff=2*feature_size, dropout=0.,
+                       num_head=4, pe_type='3d_temporal', grid_size=(grid_size,)*3, mask_type='patch', patch_size=patch_size,
+                       window_size=window_size, tmsa_config=tmsa_config, activation_checkpoint=policy)
+
+def benchmark(family='transformer', grid_sizes=(16, 32), feature_size=72, window_size=4, patch_size=(4,4,4), repeats=3):
+    '''
+    Peak memory and time of a training step under each activation_checkpoint policy; the gradients of every policy are
+    checked against 'none'
+    '''
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    for grid_size in grid_sizes:
+        grid = (window_size,) + (grid_size,)*3
+        src, tgt, src_ts, tgt_ts = torch.randn(grid + (5,), device=device), torch.randn(grid + (5,), device=device), \
+                                   torch.rand(grid + (1,), device=device), torch.rand(grid + (1,), device=device)
+        inputs = (src, tgt, torch.empty(0), torch.empty(0), src_ts, tgt_ts)
+        grads = None
+        for policy in ACTIVATION_CHECKPOINTS:
+            model = build(family, policy, grid_size, feature_size, window_size, patch_size).to(device)
+            timing, memory = run(model, inputs, repeats)
+            model(*inputs).square().mean().backward()
+            policy_grads = [p.grad for p in model.parameters() if p.grad is not None]
+            if grads is None:
+                grads = policy_grads
+            assert all(torch.allclose(g, h, atol=1e-5) for g, h in zip(grads, policy_grads)), f'Gradient mismatch for {policy}'
+            line = f'{family} grid {grid_size}^3, {policy}: {timing*1e3:.0f} ms per step'
+            if memory is not None:
+                line += f', peak memory {memory/2**20:.0f} MiB'
+            print(line, flush=True)
+
+if __name__ == "__main__":
+    benchmark('transformer')
+    benchmark('unet')
@@ -0,0 +1,52 @@
+#!/bin/bash python
+import time
+import numpy as np
+import torch
+from transformer import Transformer, PRECISIONS
+from utils import rollout_trajectories
+
+def synthetic_runs(num_runs, num_snapshots, grid_size, num_vars=5):
+    '''Smooth travelling waves of a different phase per run and variable, as (T, nx1, nx2, nx3, C) series and their times'''
+    x = torch.arange(grid_size).float()*2*np.pi/grid_size
+    X, Y, Z = torch.meshgrid(x, x, x, indexing='ij')
+    times = [np.arange(num_snapshots)*0.1 for _ in range(num_runs)]
+    runs = [torch.stack([torch.stack([torch.sin(X + 0.3*t*(c+1) + run) * torch.cos(Y - 0.2*t + c) + 0.1*torch.sin(Z + t) \
+                                      for c in range(num_vars)], dim=-1) for t in range(num_snapshots)]) for run in range(num_runs)]
+    return runs, times
+
+def benchmark(grid_size=16, feature_size=72, window_size=4, num_steps=8, num_trajectories=4, state_dict=None, repeats=1):
+    '''
+    Time of a batched rollout (rollout_trajectories) at each precision against fp32, and the drift of its predictions
+    from the fp32 ones, for the same weights at every precision
+    state_dict: path of trained weights of this configuration, random weights if None
+    '''
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    tmsa_config = {'use_tmsa': True, 'use_tgt_tmsa': True, 'window_patch_size': (2,4,4,4), 'shift_size': (1,2,2,2), 'depth': 4,
+                   'num_heads': 4, 'pos_insert': 'both', 'attn_backend': 'math'}
+    runs, times = synthetic_runs(num_trajectories, window_size+num_steps, grid_size)
+    starts = [(run, 0) for run in range(num_trajectories)]
+    torch.manual_seed(1008)
+    weights = torch.load(state_dict, map_location='cpu') if state_dict is not None else None
+    results = {}
+    for precision in PRECISIONS:
+        model = Transformer(None, feature_size=feature_size, num_enc_layers=2, num_dec_layers=3, d_ff=2*feature_size, dropout=0.,
+                            num_head=4, pe_type='3d_temporal', grid_size=(grid_size,)*3, mask_type='patch', patch_size=(4,4,4),
+                            window_size=window_size, tmsa_config=tmsa_config, precision=precision)
+        if weights is None:
+            weights = model.state_dict()
+        model.load_state_dict(weights)
+        model.to(device)
+        rollout_trajectories(model, runs, times, starts, window_size, 1) ### warm up
+        start_time = time.time()
+        for _ in range(repeats):
+            result = rollout_trajectories(model, runs, times, starts, window_size, num_steps, return_fields=True)
+        results[precision] = (time.time()-start_time)/repeats, result
+    fp32_time, fp32_result = results['fp32']
+    for precision, (timing, result) in results.items():
+        ### mean over trajectories and variables of the squared difference to the fp32 fields, first and last step
+        drift = (result['prediction']-fp32_result['prediction']).pow(2).mean(dim=(0,2,3,4,5))
+        print(f'{precision}: {timing:.2f} s per rollout, speedup {fp32_time/timing:.2f}x, rollout mse {result["mse"][:,-1].mean():.3e} '\
+              f'(fp32 {fp32_result["mse"][:,-1].mean():.3e}), drift from fp32 {drift[0]:.2e} at step 1, {drift[-1]:.2e} at step {num_steps}', flush=True)
+
+if __name__ == "__main__":
+    benchmark()
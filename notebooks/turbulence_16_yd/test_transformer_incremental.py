@@ -0,0 +1,47 @@
+#!/bin/bash python
+import os
+import sys
+import pytest
+import torch
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.modules.pop('transformer', None) ### src has its own transformer.py
+from transformer import Transformer
+
+def make_model(**kwargs):
+    torch.manual_seed(0)
+    config = dict(feature_size=12, num_enc_layers=1, num_dec_layers=1, d_ff=16, dropout=0., num_head=2, pe_type='3d_temporal', \
+                  grid_size=(8,8,8), mask_type='patch', patch_size=(2,2,2), window_size=4, \
+                  tmsa_config={'use_tmsa': False, 'use_tgt_tmsa': False, 'pos_insert': 'both'}, \
+                  ablation={'tmsa': False, 'temp_embed': True, 'encoder': True})
+    config.update(kwargs)
+    return Transformer(None, **config).eval()
+
+def rollout_windows(blocks, times, window_size):
+    '''(K, N, D, H, W, C) src and tgt windows of a rollout over blocks (K, T, D, H, W, C), the tgt padded with zeros'''
+    K, T = blocks.shape[:2]
+    grid = blocks.shape[2:5]
+    coord = torch.stack(torch.meshgrid(*[torch.arange(n) for n in grid], indexing='ij'), dim=-1).float()
+    coords = coord.expand((K, window_size)+coord.shape)
+    ts = times.view(K, T, 1, 1, 1, 1).expand(K, T, *grid, 1)
+    for t in range(T-window_size):
+        src = blocks[:,t:t+window_size]
+        tgt = torch.cat([blocks[:,t+1:t+window_size], torch.zeros_like(blocks[:,:1])], dim=1)
+        yield src, tgt, coords, coords, ts[:,t:t+window_size], ts[:,t+1:t+window_size+1]
+
+def test_forward_incremental_matches_forward_batch():
+    model = make_model(decoder_only=True)
+    blocks = torch.randn(2, 9, 8, 8, 8, 5)
+    times = torch.rand(2, 9).cumsum(1)
+    cache = None
+    with torch.no_grad():
+        for inputs in rollout_windows(blocks, times, model.window_size):
+            expected = model.forward_batch(*inputs, temporal_insert_layer=1)[:,-1]
+            output, cache = model.forward_incremental(*inputs, cache, temporal_insert_layer=1)
+            assert torch.allclose(output[:,-1], expected, atol=1e-5)
+
+@pytest.mark.parametrize('kwargs', [{}, {'decoder_only': True, 'num_dec_layers': 2}])
+def test_forward_incremental_rejects_several_layers(kwargs):
+    model = make_model(**kwargs)
+    inputs = next(rollout_windows(torch.randn(1, 5, 8, 8, 8, 5), torch.rand(1, 5), model.window_size))
+    with pytest.raises(ValueError):
+        model.forward_incremental(*inputs)
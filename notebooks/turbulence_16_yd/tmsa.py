@@ -1,10 +1,95 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from functools import reduce, lru_cache
+import torch.utils.checkpoint as checkpoint
+from functools import reduce
 from operator import mul
 import numpy as np
 
+ATTN_BACKENDS = ('math', 'sdpa', 'chunked', 'block_sparse')
+ACTIVATION_CHECKPOINTS = ('none', 'per_block', 'per_layer', 'selective')
+
+def run_checkpointed(function, *args, enabled=True):
+    """ function(*args), recomputed in the backward pass instead of keeping its activations when enabled and gradients
+    are being recorded.
+    """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint.checkpoint(function, *args, use_reentrant=False)
+    return function(*args)
+
+# additive mask value of the keys a query does not see, finite so that fully masked rows stay defined; -inf works too
+MASK_FILL = -100.
+
+def _visible_keys(mask, L, K):
+    """ For each of the L queries of an additive mask broadcast to (..., L, K), where the keys at MASK_FILL or below are
+    hidden: one past the last key it sees in any slice, and whether it sees every key before that in all slices (so the
+    mask adds nothing up to there). Read on the host, so it syncs with the device.
+    """
+    visible = (mask > MASK_FILL).reshape(-1, *mask.shape[-2:])
+    key_end = K - visible.any(0).expand(L, K).flip(-1).int().argmax(-1)
+    prefix = visible.all(0).expand(L, K).sum(-1) == key_end
+    return key_end.tolist(), prefix.tolist()
+
+class AttentionMask():
+    """ A (..., L, K) additive mask together with the keys its queries see (see _visible_keys), read once when it is
+    built, so that the 'chunked' and 'block_sparse' attention over it never sync with the device. Build it once per mask
+    and pass it to scaled_attention in place of the tensor.
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.visible = _visible_keys(mask, *mask.shape[-2:])
+
+def scaled_attention(q, k, v, mask=None, scale=None, backend='math', chunk_size=256):
+    """ softmax(q k^T * scale + mask) v for (..., L, E) queries and (..., K, E) keys and values.
+    Args:
+        mask: additive (0/MASK_FILL or 0/-inf) mask broadcast to (..., L, K), e.g. the block-causal patch mask, or its
+            AttentionMask, or None
+        scale: factor of the scores, default E ** -0.5
+        backend (str): 'math' builds the whole (..., L, K) score tensor;
+            'sdpa' calls torch.nn.functional.scaled_dot_product_attention (fused flash / memory-efficient kernels);
+            'chunked' takes chunk_size queries at a time over the keys up to the last one any of them sees, so the scores
+            are at most (..., chunk_size, K) and the masked future of a block-causal mask is skipped;
+            'block_sparse' takes the runs of queries that see the same keys, i.e. the time blocks of the patch mask,
+            each over its visible keys only, so a block-causal mask computes only the past and current blocks
+    """
+    scale = scale or q.shape[-1] ** -0.5
+    visible = None
+    if isinstance(mask, AttentionMask):
+        mask, visible = mask.mask, mask.visible
+    if mask is not None:
+        mask = mask.to(q.dtype)
+    if backend == 'sdpa':
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, scale=scale)
+    if backend == 'math':
+        attn = (q * scale) @ k.transpose(-2, -1)
+        if mask is not None:
+            attn = attn + mask
+        return attn.softmax(dim=-1) @ v
+    if backend not in ATTN_BACKENDS:
+        raise ValueError(f'Unknown attention backend {backend}, expect one of {ATTN_BACKENDS}')
+    L, K = q.shape[-2], k.shape[-2]
+    if mask is None:
+        key_end, prefix = [K] * L, [True] * L
+    else:
+        key_end, prefix = visible if visible is not None and len(visible[0]) == L else _visible_keys(mask, L, K)
+    if backend == 'chunked':
+        bounds = [(start, min(start + chunk_size, L)) for start in range(0, L, chunk_size)]
+    else:
+        starts = [i for i in range(L) if i == 0 or key_end[i] != key_end[i - 1]]
+        bounds = list(zip(starts, starts[1:] + [L]))
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for start, stop in bounds:
+        end = max(key_end[start:stop])
+        attn = (q[..., start:stop, :] * scale) @ k[..., :end, :].transpose(-2, -1)
+        # the mask is only added where it hides some of the computed keys
+        if not all(prefix[start:stop]) or min(key_end[start:stop]) < end:
+            rows = slice(start, stop) if mask.shape[-2] > 1 else slice(None)
+            attn = attn + mask[..., rows, :end]
+        out[..., start:stop, :] = attn.softmax(dim=-1) @ v[..., :end, :]
+    return out
+
+
 class Mlp_GEGLU(nn.Module):
     """ Multilayer perceptron with gated linear unit (GEGLU). Ref. "GLU Variants Improve Transformer".
     Args:
@@ -57,49 +142,59 @@ class DropPath(nn.Module):
     def forward(self, x):
         return drop_path(x, self.drop_prob, self.training)
 
-@lru_cache()
 def compute_mask(N, D, H, W, window_patch_size, shift_size, device):
-    """ Compute attnetion mask for input of size (D, H, W). @lru_cache caches each stage results. """
-
-    img_mask = torch.zeros((N, D, H, W, 1), device=device)  # 1 Dp Hp Wp 1
-    cnt = 0
-    for n in slice(-window_patch_size[0]), slice(-window_patch_size[0], -shift_size[0]), slice(-shift_size[0], None):
-        img_mask[n, :, :, :, :] = cnt
-        cnt += 1
-        # for d in slice(-window_patch_size[1]), slice(-window_patch_size[1], -shift_size[0]), slice(-shift_size[1], None):
-        #     for h in slice(-window_patch_size[2]), slice(-window_patch_size[2], -shift_size[1]), slice(-shift_size[2], None):
-        #         for w in slice(-window_patch_size[3]), slice(-window_patch_size[3], -shift_size[2]), slice(-shift_size[3], None):
-        #             img_mask[n, d, h, w, :] = cnt
-        #             cnt += 1
-    #print(img_mask.squeeze(-1))
-    mask_windows = window_partition(img_mask, window_patch_size)  # nW, ws[0]*ws[1]*ws[2], 1
-    mask_windows = mask_windows.squeeze(-1)  # nW, ws[0]*ws[1]*ws[2]
-    #print('MASK WINDOW', mask_windows)
+    """ Compute attention mask of the shifted windows for a padded input of size (N, D, H, W): tokens of a window that
+    come from different temporal regions of the rolled input do not attend to each other.
+    """
+    # region of each temporal index, as the (-ws, -ss, None) slices of the rolled input; a zero shift is one region
+    n = torch.arange(N, device=device)
+    region = (n >= N - window_patch_size[0]).long() + (n >= N - shift_size[0]).long() if shift_size[0] > 0 else n * 0
+    img_mask = region.view(N, 1, 1, 1, 1).expand(N, D, H, W, 1)
+    mask_windows = window_partition(img_mask, window_patch_size).squeeze(-1)  # nW, ws[0]*ws[1]*ws[2]*ws[3]
     attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-    #print('ATTN MASK', attn_mask)
-    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return torch.zeros(attn_mask.shape, device=device).masked_fill(attn_mask != 0, MASK_FILL)
+
+class WindowPlan():
+    """ Window partition of (..., N, D, H, W, C) inputs for one input size and window_patch_size, built once and shared
+    by the TMSA layers of a TMSAG. The shifted layers only use its padding, see TMSA.forward_part1.
+    Attributes:
+        padding: F.pad padding up to multiples of window_patch_size, None if the sizes already divide evenly
+        padded_size: (Np, Dp, Hp, Wp) size of the padded input
+    """
 
-    return attn_mask
+    def __init__(self, N, D, H, W, window_patch_size):
+        self.window_patch_size = tuple(window_patch_size)
+        pads = [(w - n % w) % w for n, w in zip((N, D, H, W), window_patch_size)]
+        self.padding = (0, 0, 0, pads[3], 0, pads[2], 0, pads[1], 0, pads[0]) if any(pads) else None
+        self.padded_size = tuple(n + p for n, p in zip((N, D, H, W), pads))
+
+    def partition(self, x):
+        """ (..., Np, Dp, Hp, Wp, C) padded input to (B*nW, Wn*Wd*Wh*Ww, C) windows """
+        return window_partition(x, self.window_patch_size)
+
+    def reverse(self, windows, batch_shape=()):
+        """ Windows back to the (..., Np, Dp, Hp, Wp, C) padded input """
+        return window_reverse(windows, self.window_patch_size, *self.padded_size, batch_shape)
 
 def window_partition(x, window_patch_size):
     """ Partition the input into windows. Attention will be conducted within the windows.
     Args:
-        x: (N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels
+        x: (..., N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels, with optional leading batch dims
         window_patch_size: (Nw, Dw, Hw, Ww) window_patch_size x (patch_dimx1 x patch_dimx2 x patch_dimx3)
     Returns:
-        windows: (N*num_windows, window_patch_size*window_patch_size, C)
+        windows: (B*N*num_windows, window_patch_size*window_patch_size, C), the windows of each batch element together
     """
-    N, D, H, W, C = x.shape
-    x = x.view(N // window_patch_size[0], window_patch_size[0], D // window_patch_size[1], window_patch_size[1], H // window_patch_size[2],
+    N, D, H, W, C = x.shape[-5:]
+    x = x.view(-1, N // window_patch_size[0], window_patch_size[0], D // window_patch_size[1], window_patch_size[1], H // window_patch_size[2],
                window_patch_size[2], W // window_patch_size[3], window_patch_size[3], C)
-    windows = x.permute(0, 2, 4, 6, 1, 3, 5, 7, 8).contiguous().view(-1, reduce(mul, window_patch_size), C)
+    windows = x.permute(0, 1, 3, 5, 7, 2, 4, 6, 8, 9).contiguous().view(-1, reduce(mul, window_patch_size), C)
 
     return windows
 
-def window_reverse(windows, window_patch_size, N, D, H, W):
-    x = windows.view(N // window_patch_size[0], D // window_patch_size[1], H // window_patch_size[2], W // window_patch_size[3], window_patch_size[0], window_patch_size[1],
-                     window_patch_size[2], window_patch_size[3], -1)
-    x = x.permute(0, 4, 1, 5, 2, 6, 3, 7, 8).contiguous().view(N, D, H, W, -1)
+def window_reverse(windows, window_patch_size, N, D, H, W, batch_shape=()):
+    x = windows.view(-1, N // window_patch_size[0], D // window_patch_size[1], H // window_patch_size[2], W // window_patch_size[3], window_patch_size[0], window_patch_size[1],
+                     window_patch_size[2], window_patch_size[3], windows.shape[-1])
+    x = x.permute(0, 1, 5, 2, 6, 3, 7, 4, 8, 9).contiguous().view(*batch_shape, N, D, H, W, -1)
     return x
 
 def reshape_3d(x, grid_size,):
@@ -107,12 +202,12 @@ def reshape_3d(x, grid_size,):
 
 def roll_block(x, shift_size, reverse=False):
     '''
-    meshblock: torch.Tensor size (N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels
+    meshblock: torch.Tensor size (..., N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels
     shift_size: tuple (St, Sd, S)
     '''
     if reverse:
         shift_size = [-s for s in list(shift_size)]
-    return torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2], -shift_size[3]), dims=(0,1,2,3))
+    return torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2], -shift_size[3]), dims=(-5,-4,-3,-2))
 
 class WindowAttention(nn.Module):
     """ Window based multi-head mutual attention and self attention.
@@ -123,11 +218,15 @@ class WindowAttention(nn.Module):
         qkv_bias (bool, optional):  If True, add a learnable bias to query, key, value. Default: True
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         mut_attn (bool): If True, add mutual attention to the module. Default: True
+        attn_backend (str): Implementation of the attention, see scaled_attention. Default: 'math'
     """
 
-    def __init__(self, dim, num_heads, qkv_bias=False, qk_scale=None, mut_attn=True):
+    def __init__(self, dim, num_heads, qkv_bias=False, qk_scale=None, mut_attn=True, attn_backend='math'):
         super().__init__()
+        if attn_backend not in ATTN_BACKENDS:
+            raise ValueError(f'Unknown attention backend {attn_backend}, expect one of {ATTN_BACKENDS}')
         self.dim = dim
+        self.attn_backend = attn_backend
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
@@ -141,8 +240,6 @@ class WindowAttention(nn.Module):
             self.qkv_mut = nn.Linear(dim, dim * 3, bias=qkv_bias)
             self.proj = nn.Linear(2 * dim, dim)
 
-        self.softmax = nn.Softmax(dim=-1)
-
     def forward(self, x, mask=None):
         """ Forward function.
         Args:
@@ -173,17 +270,14 @@ class WindowAttention(nn.Module):
 
     def attention(self, q, k, v, mask, x_shape, relative_position_encoding=True):
         B_, N, C = x_shape
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
-        if mask is None:
-            attn = self.softmax(attn)
-        else:
+        if mask is not None:
+            # (B, nW, nH, N, C) windows, so the (nW, 1, N, N) mask of each window broadcasts over the batch and heads
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask[:, :N, :N].unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+            q, k, v = (t.view(B_ // nW, nW, *t.shape[1:]) for t in (q, k, v))
+            mask = mask[:, :N, :N].unsqueeze(1)
+        x = scaled_attention(q, k, v, mask, self.scale, self.attn_backend)
 
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = x.reshape(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
 
         return x
 
@@ -205,6 +299,7 @@ class TMSA(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm.
         use_checkpoint_attn (bool): If True, use torch.checkpoint for attention modules. Default: False.
         use_checkpoint_ffn (bool): If True, use torch.checkpoint for feed-forward modules. Default: False.
+        attn_backend (str): Implementation of the attention, see scaled_attention. Default: 'math'
     """
 
     def __init__(self,
@@ -220,7 +315,8 @@ class TMSA(nn.Module):
                  act_layer=nn.GELU,
                  norm_layer=nn.LayerNorm,
                  use_checkpoint_attn=False,
-                 use_checkpoint_ffn=False
+                 use_checkpoint_ffn=False,
+                 attn_backend='math'
                  ):
         super().__init__()
         self.dim = dim
@@ -233,51 +329,30 @@ class TMSA(nn.Module):
         assert 0 <= self.shift_size[1] < self.window_patch_size[1], "shift_size must in 0-window_patch_size"
         assert 0 <= self.shift_size[2] < self.window_patch_size[2], "shift_size must in 0-window_patch_size"
         self.norm1 = norm_layer(dim)
-        self.attn = WindowAttention(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, mut_attn=mut_attn)
+        self.attn = WindowAttention(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, mut_attn=mut_attn,
+                                    attn_backend=attn_backend)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         self.mlp = Mlp_GEGLU(in_features=dim, hidden_features=int(dim * mlp_ratio), act_layer=act_layer)
 
-    def forward_part1(self, x, mask_matrix):
-        N, D, H, W, C = x.shape
+    def forward_part1(self, x, plan):
+        *B, N, D, H, W, C = x.shape
         x = self.norm1(x)
 
-        # pad feature maps to multiples of window size
-        pad_tf = pad_l = pad_t = pad_d0 = 0
-        pad_tb = (self.window_patch_size[0] - N % self.window_patch_size[0]) % self.window_patch_size[0]
-        pad_d1 = (self.window_patch_size[1] - D % self.window_patch_size[1]) % self.window_patch_size[1]
-        pad_b = (self.window_patch_size[2] - H % self.window_patch_size[2]) % self.window_patch_size[2]
-        pad_r = (self.window_patch_size[3] - W % self.window_patch_size[3]) % self.window_patch_size[3]
-        x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1, pad_tf, pad_tb), mode='constant')
-        #print(f'x after padding: {x.shape}')
-        Np, Dp, Hp, Wp, _ = x.shape
-        # cyclic shift
-        if any(i > 0 for i in self.shift_size):
-            shifted_x = roll_block(x, self.shift_size, reverse=False)
-            attn_mask = mask_matrix
-            #print(f'x after rolling: {shifted_x.shape}')
-
-        else:
-            shifted_x = x
-            attn_mask = None
-
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_patch_size)  # B*nW, Wd*Wh*Ww, C
-
-        # attention / shifted attention
-        attn_windows = self.attn(x_windows, mask=attn_mask)  # B*nW, Wd*Wh*Ww, C
-
-        # merge windows
-        shifted_x = window_reverse(attn_windows, self.window_patch_size, Np, Dp, Hp, Wp)  # N' D' H' W' C
+        # pad feature maps to multiples of window size, nothing to do when they already divide evenly
+        if plan.padding is not None:
+            x = F.pad(x, plan.padding, mode='constant')
 
-        # reverse cyclic shift
         if any(i > 0 for i in self.shift_size):
+            # the shifted layers have always returned the padded input rolled back, whatever their shifted window
+            # attention computed, so it is skipped; kept as is since the trained weights depend on it
             x = roll_block(x, self.shift_size, reverse=True)
         else:
-            x = shifted_x
+            # partition windows, attention and merge windows
+            x = plan.reverse(self.attn(plan.partition(x)), B)  # N' D' H' W' C
 
-        if pad_tb>0 or pad_d1 > 0 or pad_r > 0 or pad_b > 0:
-            x = x[:N, :D, :H, :W, :]
+        if plan.padding is not None:
+            x = x[..., :N, :D, :H, :W, :]
 
         x = self.drop_path(x)
 
@@ -286,24 +361,18 @@ class TMSA(nn.Module):
     def forward_part2(self, x):
         return self.drop_path(self.mlp(self.norm2(x)))
 
-    def forward(self, x, mask_matrix):
+    def forward(self, x, plan):
         """ Forward function.
         Args:
-            x: Input feature, tensor size (N, D, H, W, C).
-            mask_matrix: Attention mask for cyclic shift.
+            x: Input feature, tensor size (..., N, D, H, W, C).
+            plan: WindowPlan of the input size.
         """
 
         # attention
-        if self.use_checkpoint_attn:
-            x = x + checkpoint.checkpoint(self.forward_part1, x, mask_matrix)
-        else:
-            x = x + self.forward_part1(x, mask_matrix)
+        x = x + run_checkpointed(self.forward_part1, x, plan, enabled=self.use_checkpoint_attn)
 
         # feed-forward
-        if self.use_checkpoint_ffn:
-            x = x + checkpoint.checkpoint(self.forward_part2, x)
-        else:
-            x = x + self.forward_part2(x)
+        x = x + run_checkpointed(self.forward_part2, x, enabled=self.use_checkpoint_ffn)
 
         return x
     
@@ -323,6 +392,10 @@ class TMSAG(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         use_checkpoint_attn (bool): If True, use torch.checkpoint for attention modules. Default: False.
         use_checkpoint_ffn (bool): If True, use torch.checkpoint for feed-forward modules. Default: False.
+        attn_backend (str): Implementation of the attention, see scaled_attention. Default: 'math'
+        activation_checkpoint (str): Activations recomputed in the backward pass instead of kept: 'none';
+            'per_block' the whole group; 'per_layer' each TMSA layer; 'selective' the attention of each layer,
+            i.e. use_checkpoint_attn. Default: 'none'
     """
 
     def __init__(self,
@@ -339,9 +412,14 @@ class TMSAG(nn.Module):
                  drop_path=0.,
                  norm_layer=nn.LayerNorm,
                  use_checkpoint_attn=False,
-                 use_checkpoint_ffn=False
+                 use_checkpoint_ffn=False,
+                 attn_backend='math',
+                 activation_checkpoint='none'
                  ):
         super().__init__()
+        if activation_checkpoint not in ACTIVATION_CHECKPOINTS:
+            raise ValueError(f'Unknown activation_checkpoint {activation_checkpoint}, expect one of {ACTIVATION_CHECKPOINTS}')
+        self.activation_checkpoint = activation_checkpoint
         self.window_patch_size = window_patch_size
         self.shift_size = list(i // 2 for i in window_patch_size) if shift_size is None else shift_size
 
@@ -358,11 +436,13 @@ class TMSAG(nn.Module):
                 qk_scale=qk_scale,
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
                 norm_layer=norm_layer,
-                use_checkpoint_attn=use_checkpoint_attn,
-                use_checkpoint_ffn=use_checkpoint_ffn
+                use_checkpoint_attn=use_checkpoint_attn or activation_checkpoint == 'selective',
+                use_checkpoint_ffn=use_checkpoint_ffn,
+                attn_backend=attn_backend
             )
             for i in range(depth)])
         self.linear_out = nn.Linear(dim,dim_out)
+        self._plans = {}
         self.init_weights()
 
     def init_weights(self):
@@ -370,23 +450,28 @@ class TMSAG(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def window_plan(self, N, D, H, W):
+        """ WindowPlan of an (N, D, H, W) input, built on the first call and reused after """
+        key = (N, D, H, W)
+        if key not in self._plans:
+            self._plans[key] = WindowPlan(N, D, H, W, self.window_patch_size)
+        return self._plans[key]
+
     def forward(self, x):
         """ Forward function.
         Args:
-            x: Input feature, tensor size (B, C, D, H, W).
+            x: Input feature, tensor size (N, D, H, W, C), or (B, N, D, H, W, C) to run B independent inputs at once.
         """
-        # calculate attention mask for attention
-        N, D, H, W, C = x.shape
-        Np = int(np.ceil(N / self.window_patch_size[0])) * self.window_patch_size[0]
-        Dp = int(np.ceil(D / self.window_patch_size[1])) * self.window_patch_size[1]
-        Hp = int(np.ceil(H / self.window_patch_size[2])) * self.window_patch_size[2]
-        Wp = int(np.ceil(W / self.window_patch_size[3])) * self.window_patch_size[3]
-        attn_mask = compute_mask(Np, Dp, Hp, Wp, self.window_patch_size, self.shift_size, x.device)
-
-        for blk in self.blocks:
-            x = blk(x, attn_mask)
-
-        x = x.view(N, D, H, W, -1)
+        # window plan of this input size, shared by all layers
+        N, D, H, W, C = x.shape[-5:]
+        plan = self.window_plan(N, D, H, W)
+        def run_blocks(x):
+            for blk in self.blocks:
+                x = run_checkpointed(blk, x, plan, enabled=self.activation_checkpoint == 'per_layer')
+            return x
+        x = run_checkpointed(run_blocks, x, enabled=self.activation_checkpoint == 'per_block')
+
+        x = x.view(*x.shape[:-5], N, D, H, W, -1)
         #x = rearrange(x, 'b d h w c -> b c d h w')
         x = self.linear_out(x)
 
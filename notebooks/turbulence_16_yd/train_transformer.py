@@ -16,7 +16,7 @@ import seaborn as sns
 import time
 import random
 import os
-from transformer import Transformer, block_to_patch, patch_to_block
+from transformer import Transformer, block_to_patch, patch_to_block, precision_dtype, autocast
 from utils import *
 
 
@@ -28,6 +28,13 @@ class early_stopping():
         self.best_loss = None
         self.counter = 0
         self.best_model = None
+
+    def state_dict(self):
+        ### best_model is the trained model itself, it is saved with it
+        return {'early_stop': self.early_stop, 'best_loss': self.best_loss, 'counter': self.counter}
+
+    def load_state_dict(self, state):
+        self.early_stop, self.best_loss, self.counter = state['early_stop'], state['best_loss'], state['counter']
     
     def __call__(self, model, val_loss):
         if self.best_loss is None:
@@ -44,48 +51,50 @@ class early_stopping():
             print(f'----Current loss {val_loss} higher than best loss {self.best_loss}, early stop counter {self.counter}----')
 
 
-def evaluate(model,data_loader,criterion, patch_size,scaler,noise_std,predict_res):
-    patch_length = 4*4*4
+def evaluate(model, dataset, criterion, scaler, noise_std, predict_res, pred_size=1, precision='fp32', max_steps=None):
+    '''
+    Autoregressive rollout over the windows of dataset, every step fed the blocks predicted so far; returns the mse, r2
+    and explained variance of the predicted blocks in the unscaled variables
+    precision: of the model, the inputs are cast to its dtype and the outputs back to fp32 before the scaler
+    max_steps: stop the rollout after max_steps windows, a cheap estimate of the metrics for intermediate reports
+    '''
     model.eval()
-    test_result = torch.Tensor(0) 
-    truth = torch.Tensor(0) 
-    test_ts = torch.Tensor(0)
-    test_coord = torch.Tensor(0)
+    dtype = precision_dtype(precision)
+    predictions, truths = [], []
     device = "cpu"
     if torch.cuda.is_available():
         device = "cuda:0"
+    ### the last window has no next window as target
+    num_steps = len(dataset)-1 if max_steps is None else min(max_steps, len(dataset)-1)
     
     with torch.no_grad():
-        for i, ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) in enumerate(data_loader):
-
+        for i in range(num_steps):
+            (src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts) = dataset[i]
             src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), src_coord.to(device),\
                                                                             tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
             if i==0:
-                B, N, C = src.shape
-                enc_in = src
                 test_rollout = src
-            else:
-                enc_in = test_rollout[:,-N:,:]
+            enc_in = test_rollout[-src.shape[0]:]
 
-            # dec_rollout = reduce(enc_in.view(B,window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-            # dec_rollout = torch.zeros((enc_in.shape[0],patch_length,enc_in.shape[2])).float().to(device)
             if predict_res:
-                res = torch.roll(enc_in,-patch_length,1)-enc_in
-                res_rollout = torch.cat([res[:,:-patch_length,:],res[:,-patch_length*2:-patch_length,:]],dim=1) + (torch.empty(enc_in.shape).normal_(mean=0,std=noise_std/10)).to(device)###repeat the second to the last patch of residuals
-                output = model(enc_in,res_rollout,src_coord,tgt_coord,src_ts,tgt_ts,{})
-                output = output + enc_in
+                ###residuals of the window with the last residual repeated
+                dec_in = build_dec_in(enc_in.unsqueeze(0), 'residual_repeat', pred_size)[0]
+                dec_in = dec_in + (torch.empty(dec_in.shape).normal_(mean=0,std=noise_std/10)).to(device)
             else:
-                dec_rollout = enc_in[:,-patch_length:,:]
-                dec_in = torch.cat([enc_in[:,patch_length:,:], dec_rollout], dim=1).float()
+                dec_in = build_dec_in(enc_in[pred_size:].unsqueeze(0), 'repeat', pred_size)[0]
                 dec_in = dec_in + (torch.empty(dec_in.shape).normal_(mean=0,std=noise_std)).to(device)
-                output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts, {})
-            test_rollout = torch.cat([test_rollout,output[:,-patch_length:,:]], dim=1)
-            truth = torch.cat((truth, tgt[:,-patch_length:,:].flatten().detach().cpu()), 0)
-            test_result = torch.cat((test_result, output[:,-patch_length:,:].flatten().detach().cpu()), 0)
-
-    test_result = torch.Tensor(scaler.inverse_transform(test_result.unsqueeze(-1)))
-    truth = torch.Tensor(scaler.inverse_transform(truth.unsqueeze(-1)))
-    prediction, truth = test_result.numpy(), truth.numpy()
+            with autocast(precision, device):
+                output = model(enc_in.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts)
+            output = output.float()
+            if predict_res:
+                output = output + enc_in
+            test_rollout = torch.cat([test_rollout, output[-pred_size:]], dim=0)
+            predictions.append(output[-pred_size:].reshape(-1, output.shape[-1]).cpu())
+            truths.append(tgt[-pred_size:].reshape(-1, tgt.shape[-1]).cpu())
+
+    prediction, truth = torch.cat(predictions).numpy(), torch.cat(truths).numpy()
+    if scaler is not None:
+        prediction, truth = scaler.inverse_transform(prediction), scaler.inverse_transform(truth)
     val_loss = mean_squared_error(truth, prediction)
     r2 = r2_score(truth, prediction)
     explained_variance = explained_variance_score(truth, prediction)
@@ -93,7 +102,15 @@ def evaluate(model,data_loader,criterion, patch_size,scaler,noise_std,predict_re
     return val_loss, r2, explained_variance
 
 
-def train(config, checkpoint_dir):
+def train(config, checkpoint_dir=None, snapshots=None, prepared=None):
+    '''
+    One tune trial. The training checkpoints (model, optimizer, scheduler, early stopping, rng and position in the
+    epoch) go with every report, so a trial paused or failed can be resumed from checkpoint_dir.
+    snapshots: output of load_snapshots shared by the trials, see get_data_loaders
+    prepared: dict scaler_type -> output of prepare_series, shared by the trials instead of each fitting its scaler
+    config: besides the model and data parameters, report_interval training steps between intermediate reports,
+            from a validation rollout of report_eval_steps steps
+    '''
     root_dir = '/scratch/yd1008/nyu_capstone_2/notebooks/turbulence_16_yd/tune_results_2/'
     torch.cuda.manual_seed(1008)
     torch.cuda.manual_seed_all(1008)  
@@ -136,11 +153,12 @@ def train(config, checkpoint_dir):
 
 
     conv_config = {'num_layer':unet_num_layer, 'start_filts':unet_start_filts, 'conv_type': 'UNet'}
-    tmsa_config = {'use_tmsa':True, 'use_tgt_tmsa':True, 'window_patch_size': tmsa_window_patch_size, 'shift_size': tmsa_shift_size, 'depth': tmsa_depth, 'num_heads':num_heads}
+    tmsa_config = {'pos_insert': config.get('pos_insert', 'both'), 'use_tmsa':True, 'use_tgt_tmsa':True, 'window_patch_size': tmsa_window_patch_size, 'shift_size': tmsa_shift_size, 'depth': tmsa_depth, 'num_heads':num_heads, 'attn_backend': 'math'}
     data_config = {'scale': True, 'noise_std':noise_std, 'window_size': window_size, 'option': 'patch', 'predict_res': predict_res, 'scaler_type':scaler_type,'patch_size': (4,4,4),}
     best_config = {'epochs':40, 'pe_type': '3d_temporal', 'batch_size': 64, 'feature_size': feature_size, 'num_enc_layers': num_enc_layers\
                 , 'num_dec_layers': num_dec_layers, 'num_head': num_heads, 'd_ff': d_ff, 'dropout': dropout, 'lr': lr, 'lr_decay': lr_decay, 'loss_type':loss_type, 'delta': delta\
-                , 'mask_type':'patch','decoder_only':False, 'reg_var':reg_var}
+                , 'mask_type':'patch','decoder_only':False, 'reg_var':reg_var\
+                , 'activation_checkpoint': config.get('activation_checkpoint', 'none'), 'precision': config.get('precision', 'fp32')}
 
     pe_type = best_config['pe_type']
     batch_size = best_config['batch_size']
@@ -157,6 +175,9 @@ def train(config, checkpoint_dir):
     delta = best_config['delta']
     reg_var = best_config['reg_var']
     loss_type = best_config['loss_type']
+    activation_checkpoint = best_config['activation_checkpoint']
+    precision = best_config['precision']
+    dtype = precision_dtype(precision)
 
     patch_size = data_config['patch_size']
     noise_std = data_config['noise_std']
@@ -185,15 +206,21 @@ def train(config, checkpoint_dir):
     print('-'*50, flush=True)
     best_config.update(data_config)
 
-    ### SPECIFYING use_coords=True WILL RETURN DATALOADERS FOR COORDS
-    train_loader, val_loader, _, scaler, data = get_data_loaders(train_proportion, test_proportion, val_proportion,\
-        pred_size = pred_size, batch_size = batch_size, num_workers = 1, pin_memory = False, use_coords = True, use_time = True,\
+    report_interval = config.get('report_interval', 200)
+    report_eval_steps = config.get('report_eval_steps', 20)
+
+    ### get_data_loaders gives the window datasets here, every item is one (window_size, nx1, nx2, nx3, C) sequence
+    ### the 3d_temporal embedding of the grid is precomputed by the model (fixed_coords), so coords are left out
+    train_set, val_set, _, scaler, data = get_data_loaders(train_proportion, test_proportion, val_proportion,\
+        pred_size = pred_size, batch_size = batch_size, num_workers = 1, pin_memory = False, use_coords = pe_type != '3d_temporal', use_time = True,\
         test_mode = False, scale = scale, window_size = window_size, patch_size = patch_size, option = option, predict_res = False,\
-        noise_std = noise_std, scaler_type = scaler_type)
+        noise_std = noise_std, scaler_type = scaler_type, snapshots = snapshots, \
+        prepared = prepared[scaler_type] if prepared is not None else None)
     
     model = Transformer(data, feature_size=feature_size,num_enc_layers=num_enc_layers,num_dec_layers = num_dec_layers,\
         d_ff = d_ff, dropout=dropout,num_head=num_head,pe_type=pe_type,grid_size=(grid_size,)*3,mask_type=mask_type,\
-        patch_size=patch_size,window_size=window_size,pred_size=pred_size,decoder_only=decoder_only, tmsa_config = tmsa_config, conv_config = conv_config)
+        patch_size=patch_size,window_size=window_size,pred_size=pred_size,decoder_only=decoder_only, tmsa_config = tmsa_config, conv_config = conv_config,\
+        activation_checkpoint=activation_checkpoint, precision=precision)
 
 
     device = "cpu"
@@ -216,48 +243,81 @@ def train(config, checkpoint_dir):
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=lr_decay)
     #writer = tensorboard.SummaryWriter('/scratch/yd1008/tensorboard_output/')
 
-    time_map_indices = train_loader.dataset.time_map_indices
-
     epochs = best_config['epochs']
     tolerance = 10
     best_test_loss = float('inf')
     Early_Stopping = early_stopping(patience=tolerance)
     counter_old = 0
-    x1, x2, x3 = patch_size
-
+    ### the last window has no next window as target
+    num_steps = len(train_set)-1
+
+    start_epoch, start_step, start_loss = 1, 0, 0.
+    if checkpoint_dir:
+        checkpoint = torch.load(os.path.join(checkpoint_dir, "checkpoint"), map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        Early_Stopping.load_state_dict(checkpoint['early_stopping'])
+        counter_old = checkpoint['counter_old']
+        start_epoch, start_step, start_loss = checkpoint['epoch'], checkpoint['step'], checkpoint['total_loss']
+        set_rng_states(checkpoint['rng'])
+        if Early_Stopping.early_stop:
+            return
+
+    def save(epoch, step, total_loss):
+        '''Checkpoint attached to the next tune.report, written in place since tune takes the directory over once its block exits'''
+        state = {'epoch': epoch, 'step': step, 'total_loss': total_loss, 'model': model.state_dict(), \
+                 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'early_stopping': Early_Stopping.state_dict(), \
+                 'counter_old': counter_old, 'rng': rng_states()}
+        with tune.checkpoint_dir(step=(epoch-1)*num_steps+step) as directory:
+            save_checkpoint(state, os.path.join(directory, "checkpoint"))
 
     if os.path.exists(root_dir+'/best_model.pth') and skip_training:
         model.load_state_dict(torch.load(root_dir+'/best_model.pth'))
     else:
-        for epoch in range(1, epochs + 1):    
+        for epoch in range(start_epoch, epochs + 1):    
             model.train() 
-            total_loss = 0.
+            total_loss = torch.tensor(start_loss, device=device)
             start_time = time.time()
 
-            for i, ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) in enumerate(train_loader):
+            for i in range(start_step, num_steps):
+                (src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts) = train_set[i]
                 src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), src_coord.to(device),\
                                                                             tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
-                # dec_rollout = reduce(src.view(src.shape[0],window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-                # dec_rollout = torch.zeros((src.shape[0],patch_length,src.shape[2])).float().to(device)
                 if predict_res:
                     res = tgt - src
-                    res_rollout = torch.cat([res[:,:-patch_length,:],res[:,-patch_length*2:-patch_length,:]],dim=1) + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std/10)).to(device)###repeat the second to the last patch of residuals
-                    output = model(src,res_rollout,src_coord,tgt_coord,src_ts,tgt_ts,time_map_indices)
-                    output = output + src
+                    ###repeat the last known residual
+                    res_rollout = build_dec_in(res[:-pred_size].unsqueeze(0), 'repeat', pred_size)[0] + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std/10)).to(device)
+                    with autocast(precision, device):
+                        output = model(src.to(dtype),res_rollout.to(dtype),src_coord,tgt_coord,src_ts,tgt_ts)
+                    output = output.float() + src
                 else:
-                    dec_rollout = src[:,-patch_length:,:]
-                    dec_in = torch.cat([src[:,patch_length:,:], dec_rollout], dim=1).float()
+                    dec_in = build_dec_in(src[pred_size:].unsqueeze(0), 'repeat', pred_size)[0]
                     dec_in = dec_in + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std)).to(device) 
-                    output = model(src, dec_in, src_coord, tgt_coord, src_ts, tgt_ts, time_map_indices)
-                loss = criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:]) + reg_var*torch.abs((torch.var(tgt[:,-x1*x2*x3:,:].detach(),1)-torch.var(output[:,-x1*x2*x3:,:],1))).mean()# - 0.1*torch.std(output,dim=1).mean()
-                total_loss += loss.item()
+                    with autocast(precision, device):
+                        output = model(src.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts)
+                    output = output.float()
+                ### the loss and the residuals are computed in fp32 whatever the precision of the model
+                ### on the predicted blocks, the variance regularization is over the cells of each block
+                loss = criterion(output[-pred_size:], tgt[-pred_size:]) + reg_var*torch.abs((torch.var(tgt[-pred_size:].detach(),(1,2,3))-torch.var(output[-pred_size:],(1,2,3)))).mean()
+                total_loss += loss.detach()
                 loss.backward()
                 optimizer.step()
 
-            avg_train_loss = total_loss/len(train_loader.dataset)
-            val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size, scaler = scaler, noise_std=noise_std, predict_res = predict_res)
+                if (i+1)%report_interval == 0 and i+1 < num_steps:
+                    val_loss, r2, explained_variance = evaluate(model, val_set, criterion, scaler = scaler, noise_std = noise_std, predict_res = predict_res, \
+                                                                pred_size = pred_size, precision = precision, max_steps = report_eval_steps)
+                    model.train()
+                    save(epoch, i+1, total_loss.item())
+                    tune.report(train_loss = total_loss.item()/(i+1), val_loss = val_loss, r2 = r2, explained_variance = explained_variance, \
+                                epoch = epoch-1+(i+1)/num_steps)
+            start_step, start_loss = 0, 0.
+
+            avg_train_loss = total_loss.item()/num_steps
+            val_loss, r2, explained_variance = evaluate(model, val_set, criterion, scaler = scaler, noise_std = noise_std, predict_res = predict_res, \
+                                                        pred_size = pred_size, precision = precision)
             #val_loss = total_val_loss
 
             print(f'Epoch: {epoch}, train_loss: {avg_train_loss}, test_loss: {val_loss}, lr: {scheduler.get_last_lr()}, training time: {time.time()-start_time} s', flush=True)
@@ -267,10 +327,10 @@ def train(config, checkpoint_dir):
             if counter_new != counter_old:
                 scheduler.step()  # update lr if early stop
                 counter_old = counter_new
+            save(epoch+1, 0, 0.)
+            tune.report(train_loss = avg_train_loss, val_loss = val_loss, r2 = r2, explained_variance = explained_variance, epoch=epoch)
             if Early_Stopping.early_stop:
                 break
-            if Early_Stopping.best_loss>=val_loss:
-                tune.report(train_loss = avg_train_loss, val_loss = val_loss, r2 = r2, explained_variance = explained_variance, epoch=epoch)
 
             
 
@@ -326,12 +386,21 @@ if __name__ == "__main__":
 
 
     ray.init(ignore_reinit_error=False, include_dashboard=True, dashboard_host='0.0.0.0')
+    ### Read the run and fit the scaler of every scaler_type choice once; tune.with_parameters puts them in the object
+    ### store and every trial maps them zero-copy
+    data_path, coarse_grid_size = get_data_path(res_size='16', seed=1)
+    snapshots = load_snapshots(data_path, grid_size=coarse_grid_size)
+    prepared = {scaler_type: prepare_series(scale=True, scaler_type=scaler_type, snapshots=snapshots) \
+                for scaler_type in config_1['scaler_type'].categories}
+    ### trials report every report_interval steps with the epoch as a fraction, so ASHA stops bad trials within their first epochs
     sched = ASHAScheduler(
+            time_attr='epoch',
             max_t=30,
-            grace_period=10,
+            grace_period=2,
             reduction_factor=2)
-    analysis = tune.run(tune.with_parameters(train), config=config_1, num_samples=num_samples, metric='val_loss', mode='min',\
-          scheduler=sched, resources_per_trial={"cpu": 10,"gpu": 1}, max_concurrent_trials = 4, queue_trials = True, max_failures=0, local_dir="/scratch/yd1008/ray_results")
+    analysis = tune.run(tune.with_parameters(train, prepared=prepared), config=config_1, num_samples=num_samples, metric='val_loss', mode='min',\
+          scheduler=sched, resources_per_trial={"cpu": 10,"gpu": 1}, max_concurrent_trials = 4, queue_trials = True, max_failures=3, \
+          keep_checkpoints_num=2, checkpoint_score_attr='min-val_loss', local_dir="/scratch/yd1008/ray_results")
 
     best_trail = analysis.get_best_config(mode='min')
     print('The best configs are: ',best_trail, flush=True)
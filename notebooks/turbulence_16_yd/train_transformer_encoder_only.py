@@ -17,7 +17,7 @@ import seaborn as sns
 import time
 import random
 import os
-from transformer import Transformer, block_to_patch, patch_to_block
+from transformer import Transformer, block_to_patch, patch_to_block, precision_dtype, autocast
 from utils import *
 
 
@@ -55,9 +55,11 @@ def get_roll_strides(stride,dim=3):
         return list(product(stride+[0],repeat=dim))
 
 
-def evaluate(model,data_loader,criterion, patch_size,scaler,noise_std,temporal_insert_layer):
+def evaluate(model,data_loader,criterion, patch_size,scaler,noise_std,temporal_insert_layer,precision='fp32'):
+    '''precision: of the model, the inputs are cast to its dtype and the outputs back to fp32'''
     pred_size = 1
     model.eval()
+    dtype = precision_dtype(precision)
     test_result = torch.Tensor(0) 
     truth = torch.Tensor(0) 
     test_ts = torch.Tensor(0)
@@ -80,11 +82,11 @@ def evaluate(model,data_loader,criterion, patch_size,scaler,noise_std,temporal_i
                 enc_in = test_rollout[-N:]
 
             # dec_rollout = reduce(enc_in.view(B,window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-            dec_rollout = torch.zeros_like(enc_in[:pred_size]) 
-            dec_in = torch.cat([enc_in[pred_size:], dec_rollout], dim=0).float()
+            dec_in = build_dec_in(enc_in[pred_size:].unsqueeze(0), 'zero', pred_size)[0].float()
             # dec_in = dec_in + (torch.empty(dec_in.shape).normal_(mean=0,std=noise_std)).to(device)
-            output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts,temporal_insert_layer = temporal_insert_layer)
-            output = output + enc_in
+            with autocast(precision, device):
+                output = model(enc_in.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts,temporal_insert_layer = temporal_insert_layer)
+            output = output.float() + enc_in
 
             test_rollout = torch.cat([test_rollout,output[-pred_size:,:,:,:,:]], dim=0)
             truth = torch.cat((truth, tgt[-pred_size:,:,:,:,0].flatten().detach().cpu()), 0)
@@ -141,6 +143,8 @@ def train(config, checkpoint_dir):
     temporal_insert_layer = config['temporal_insert_layer']
     decoder_only = config['decoder_only']
     encoder_decoder_type = config['encoder_decoder_type']
+    precision = config.get('precision', 'fp32') ### 'fp32', 'bf16_autocast' or 'bf16', see Transformer
+    dtype = precision_dtype(precision)
 
 
     conv_config = {'num_layer':unet_num_layer, 'start_filts':unet_start_filts, 'conv_type': 'UNet'}
@@ -202,7 +206,8 @@ def train(config, checkpoint_dir):
     
     model = Transformer(data, feature_size=feature_size,num_enc_layers=num_enc_layers,num_dec_layers = num_dec_layers,\
         d_ff = d_ff, dropout=dropout,num_head=num_head,pe_type=pe_type,encoder_decoder_type = encoder_decoder_type,grid_size=(grid_size,)*3,mask_type=mask_type,\
-        patch_size=patch_size,window_size=window_size,pred_size=pred_size,decoder_only=decoder_only, tmsa_config = tmsa_config, conv_config = conv_config)
+        patch_size=patch_size,window_size=window_size,pred_size=pred_size,decoder_only=decoder_only, tmsa_config = tmsa_config, conv_config = conv_config,\
+        precision=precision)
 
 
     device = "cpu"
@@ -248,12 +253,14 @@ def train(config, checkpoint_dir):
                 seed += 1
                 optimizer.zero_grad()
 
-                dec_rollout = torch.zeros_like(src[:pred_size])
-                dec_in = torch.cat([src[pred_size:], dec_rollout], dim=0).float()
+                dec_in = build_dec_in(src[pred_size:].unsqueeze(0), 'zero', pred_size)[0].float()
 
                 dec_in = dec_in + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std,generator = g_cpu.manual_seed(seed))).to(device)
                 enc_in = src + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std,generator = g_cpu.manual_seed(seed*100))).to(device)
-                output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts, temporal_insert_layer = temporal_insert_layer)
+                with autocast(precision, device):
+                    output = model(enc_in.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts, temporal_insert_layer = temporal_insert_layer)
+                ### the loss and the residuals are computed in fp32 whatever the precision of the model
+                output = output.float()
                 res = tgt-src
                 loss = criterion(output[-pred_size:,:,:,:,:], res[-pred_size:,:,:,:,:]) + reg_var*torch.abs((torch.var(res.detach(),(0,-1))-torch.var(output,(0,-1)))).mean()
                 
@@ -262,7 +269,8 @@ def train(config, checkpoint_dir):
                 optimizer.step()
 
             avg_train_loss = total_loss
-            val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size, scaler = scaler, noise_std=noise_std, temporal_insert_layer = temporal_insert_layer)
+            val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size, scaler = scaler, noise_std=noise_std, temporal_insert_layer = temporal_insert_layer, \
+                                                        precision = precision)
             #val_loss = total_val_loss
 
             print(f'Epoch: {epoch}, train_loss: {avg_train_loss}, test_loss: {val_loss}, lr: {scheduler.get_last_lr()}, training time: {time.time()-start_time} s', flush=True)
@@ -10,29 +10,41 @@ import numpy as np
 import math
 import time
 
-from tmsa import TMSAG
+from tmsa import TMSAG, ACTIVATION_CHECKPOINTS, run_checkpointed
 from unet_3d import UNet
 
+PRECISIONS = ('fp32', 'bf16_autocast', 'bf16')
+
+def precision_dtype(precision):
+    '''dtype of the weights and inputs of a model at precision, one of PRECISIONS; 'bf16_autocast' keeps fp32 weights'''
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expect one of {PRECISIONS}')
+    return torch.bfloat16 if precision == 'bf16' else torch.float32
+
+def autocast(precision, device):
+    '''bfloat16 autocast of the forward for 'bf16_autocast', a no-op for the other precisions'''
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16_autocast')
+
 # def reshape_3d(x, grid_size,):
 #     return x.reshape((-1,)+grid_size)
 
 def roll_block(x, shift_size, reverse=False):
     '''
-    meshblock: torch.Tensor size (N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels
+    meshblock: torch.Tensor size (..., N, D, H, W, C) #meshblocks x (nx1 x nx2 x nx3) x #channels
     shift_size: tuple (Sn, Sd, Sh, Sw)
     '''
     if reverse:
         shift_size = [-s for s in list(shift_size)]
-    return torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2], -shift_size[3]), dims=(0,1,2,3))
+    return torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2], -shift_size[3]), dims=(-5,-4,-3,-2))
 
 def block_to_patch(x, patch_size, pad_size=1, stride_size = None):
     '''
-    x: (N,H,D,W,C) input data
+    x: (N,H,D,W,C) input data, or (..., N,H,D,W,C) with pad_size=0
     return:
         patched_src: (num_patch_x1 x num_patch_x2 x num_patch_x3, window_size x patch_size_1 x patch_size_2 x patch_size_3, num_channel)
         patched_tgt: patched_src shifted by pred_size, with mean padding on the predicted patches
     '''
-    N, _, _, _, _ = x.shape
+    N = x.shape[-5]
     stride_size = stride_size or patch_size
     p1, p2, p3 = patch_size
     s1, s2, s3 = stride_size
@@ -44,21 +56,113 @@ def block_to_patch(x, patch_size, pad_size=1, stride_size = None):
         out_x, out_y = rearrange(x_padded, 'nb n1 n2 n3 c b p1 p2 p3 -> nb (n1 n2 n3) (b p1 p2 p3) c')
         return out_x, out_y
     if pad_size==0:
-        x_padded = x.unfold(1,p1,s1).unfold(2,p2,s2).unfold(3,p3,s3)
-        out_x = rearrange(x_padded, 'b n1 n2 n3 c p1 p2 p3 -> (n1 n2 n3) (b p1 p2 p3) c')
+        ### leading batch dims of x (e.g. a stack of shifted copies) are folded into the patch dim
+        d = x.dim()-4 ### first grid dim
+        x_padded = x.unfold(d,p1,s1).unfold(d+1,p2,s2).unfold(d+2,p3,s3)
+        out_x = rearrange(x_padded, '... b n1 n2 n3 c p1 p2 p3 -> (... n1 n2 n3) (b p1 p2 p3) c')
         return out_x
 
 def patch_to_block(x, window_size, patch_size, grid_size):
     '''
     Inverse of block_to_patch, refer to block_to_patch documentation
+    x: (n1 x n2 x n3, ...) patches of one block, or (K x n1 x n2 x n3, ...) of K blocks, returned as (K, window_size, g1, g2, g3, c)
     '''
     _, _, c = x.shape
     p1, p2, p3 = patch_size
     g1, g2, g3 = grid_size
     n1, n2, n3 = g1//p1, g2//p2, g3//p3
-    rearranged = rearrange(x, '(n1 n2 n3) (b p1 p2 p3) c -> b n1 n2 n3 c p1 p2 p3', \
+    k = x.shape[0]//(n1*n2*n3)
+    rearranged = rearrange(x, '(k n1 n2 n3) (b p1 p2 p3) c -> k b n1 n2 n3 c p1 p2 p3', \
                        p1=p1, p2=p2, p3=p3, b=window_size, n1=n1, n2=n2, n3=n3)
-    return rearranged.permute(0,1,5,2,6,3,7,4).reshape(window_size,g1,g2,g3,c)  
+    block = rearranged.permute(0,1,2,6,3,7,4,8,5).reshape(k,window_size,g1,g2,g3,c)
+    return block[0] if x.shape[0] == n1*n2*n3 else block
+
+def add_patch_embedding(x, embedding):
+    '''
+    x: (K x n1 x n2 x n3, N x p1 x p2 x p3, C) patches of K blocks from block_to_patch
+    embedding: tensor of the same shape, or (n1 x n2 x n3, p1 x p2 x p3, C) broadcast over the N steps of the window
+               and the K blocks, or (K x n1 x n2 x n3, p1 x p2 x p3, C) broadcast over the N steps
+    '''
+    if embedding.shape == x.shape:
+        return x + embedding
+    return (x.view(-1, embedding.shape[0], x.shape[1]//embedding.shape[1], *embedding.shape[1:]) + embedding.unsqueeze(1)).view(x.shape)
+
+def grid_patch_coords(grid_size, patch_size, shift_size=(0,0,0)):
+    '''
+    Grid indices of the cells of every cuboid patch, in the block_to_patch layout of one time step
+    shift_size: (s1, s2, s3) roll of the grid as in roll_block, the cell at i holds the coordinate (i+s) % grid_size
+    return: (n1 x n2 x n3, p1 x p2 x p3, 3) long tensor
+    '''
+    grid_size = (grid_size,)*3 if type(grid_size) == int else tuple(grid_size)
+    axes = [(torch.arange(g)+s) % g for g, s in zip(grid_size, shift_size)]
+    coord = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1)
+    (g1, g2, g3), (p1, p2, p3) = grid_size, patch_size
+    coord = coord.view(g1//p1, p1, g2//p2, p2, g3//p3, p3, 3).permute(0,2,4,1,3,5,6)
+    return coord.reshape(-1, p1*p2*p3, 3)
+
+class KVRing():
+    '''
+    Keys and values of the last num_blocks blocks seen by one attention layer of an incremental rollout, in
+    preallocated buffers that the projections of new blocks overwrite in place, like RingContext
+    block_length: tokens per block, e.g. the patch length
+    '''
+    def __init__(self, num_blocks, block_length):
+        self.num_blocks = num_blocks
+        self.block_length = block_length
+        self.keys = self.values = None
+        self.head = 0 ### slot of the oldest block
+
+    def push(self, keys, values, rewind=0):
+        '''
+        Write the (batch x heads, n x block_length, head_dim) keys and values of n new blocks over the oldest ones,
+        after dropping the newest rewind blocks (e.g. decoder padding that the new blocks replace)
+        '''
+        if self.keys is None:
+            self.keys = keys.new_empty((keys.shape[0], self.num_blocks*self.block_length, keys.shape[2]))
+            self.values = torch.empty_like(self.keys)
+        self.head = (self.head - rewind) % self.num_blocks
+        blocks = (self.head + torch.arange(keys.shape[1]//self.block_length, device=keys.device)) % self.num_blocks
+        index = (blocks.unsqueeze(1)*self.block_length + torch.arange(self.block_length, device=keys.device)).view(-1)
+        self.keys.index_copy_(1, index, keys)
+        self.values.index_copy_(1, index, values)
+        self.head = (self.head + len(blocks)) % self.num_blocks
+
+    def positions(self):
+        '''Window position of the block in each key slot, 0 for the oldest'''
+        slots = torch.arange(self.keys.shape[1], device=self.keys.device)//self.block_length
+        return (slots - self.head) % self.num_blocks
+
+def cached_attention(attn, query, memory, ring, query_pos, shift=0, rewind=0):
+    '''
+    nn.MultiheadAttention attn of the new query tokens over the window of key/value tokens cached in ring,
+    after the projections of the new memory tokens are pushed to it
+        query: (Lq, batch, E) tokens of new blocks, at window positions query_pos (Lq,)
+        memory: (Lm, batch, E) key/value tokens of new blocks
+        shift: a query at window position i sees the keys at positions <= i+shift, None for all (the patch masks of forward)
+    '''
+    E = query.shape[-1]
+    head_dim = E//attn.num_heads
+    def split_heads(x):
+        return x.reshape(x.shape[0], -1, head_dim).transpose(0,1)
+    w_q, w_k, w_v = attn.in_proj_weight.split(E)
+    b_q, b_k, b_v = attn.in_proj_bias.split(E) if attn.in_proj_bias is not None else (None,)*3
+    ring.push(split_heads(F.linear(memory, w_k, b_k)), split_heads(F.linear(memory, w_v, b_v)), rewind)
+    scores = torch.bmm(split_heads(F.linear(query, w_q, b_q))*head_dim**-0.5, ring.keys.transpose(1,2))
+    if shift is not None:
+        scores = scores.masked_fill(ring.positions() > query_pos.unsqueeze(1)+shift, float('-inf'))
+    output = torch.bmm(scores.softmax(-1), ring.values)
+    return attn.out_proj(output.transpose(0,1).reshape(query.shape))
+
+def encoder_layer_step(layer, x, ring, pos):
+    '''nn.TransformerEncoderLayer (post-norm) on the new tokens x at window positions pos, see cached_attention'''
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, x, x, ring, pos)))
+    return layer.norm2(x + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+
+def decoder_layer_step(layer, x, memory, self_ring, cross_ring, pos, memory_shift=0, rewind=0):
+    '''nn.TransformerDecoderLayer (post-norm) on the new tokens x at window positions pos with the new memory tokens'''
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, x, x, self_ring, pos, rewind=rewind)))
+    x = layer.norm2(x + layer.dropout2(cached_attention(layer.multihead_attn, x, memory, cross_ring, pos, memory_shift)))
+    return layer.norm3(x + layer.dropout3(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
 
 class PositionalEncoding(nn.Module):
 
@@ -133,6 +237,15 @@ class PositionalEmbedding3D(nn.Module):
         xs,ys,zs = coords[0].long(),coords[1].long(),coords[2].long()
         return self.pe[xs,ys,zs].view(batch.shape[0],-1,self.d_model_)  #torch.stack([self.pe[i,j,k] for i,j,k in zip(xs,ys,zs)]).view(batch.shape[0],-1,self.d_model_)
 
+    def patch_embedding(self, patch_coords):
+        '''
+        Embedding of a fixed patch layout, looked up once instead of per batch
+        :param patch_coords: (num_patches, patch_length, 3) grid indices of the cells of each patch, see grid_patch_coords
+        :return: (num_patches, patch_length, d_model_)
+        '''
+        xs, ys, zs = torch.as_tensor(patch_coords).to(self.pe.device).long().unbind(-1)
+        return self.pe[xs,ys,zs]
+
 class conv_3d(nn.Module):
     def __init__(self, dim, dim_out, num_layer = 3, kernel_size = 5, stride = 1, padding = 2, dilation = 1, padding_mode = 'reflect'):
         super().__init__()
@@ -202,38 +315,76 @@ class TemporalEmbedding(nn.Module):
 
     def forward(self, x):
         #x = x.unsqueeze(2)
-        x = self.l1(x)
-        x = self.fc1(x)
+        ### the sin of absolute times is computed in fp32 at any precision, see Transformer._set_precision
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = self.l1(x.to(self.w.dtype))
+        x = self.fc1(x.to(self.fc1.weight.dtype))
         return x
 
 class Transformer_Decoder(nn.Module):
-    def __init__(self,feature_size,num_layers, decoder_layer):
+    def __init__(self,feature_size,num_layers, decoder_layer, activation_checkpoint='none'):
+        '''
+        activation_checkpoint: 'per_block' recomputes the whole stack in the backward pass, 'per_layer' each layer
+        '''
         super().__init__()
         self.num_layers = num_layers
         self.layers = nn.ModuleList([copy.deepcopy(decoder_layer) for i in range(num_layers)])
         self.norm = nn.LayerNorm(feature_size, eps=1e-5)
+        self.activation_checkpoint = activation_checkpoint
     
     def forward(self,tgt,memory,tgt_mask,memory_mask,embedding,embedding_insert_layer):
         assert embedding_insert_layer <= self.num_layers
         assert embedding.shape == tgt.shape
-        output = tgt
-        for i,layer in enumerate(self.layers):
-            if embedding_insert_layer == (i+1):
-                output = output + embedding
-            output = layer(output,memory,tgt_mask,memory_mask)
+        def run_layers(output, memory, embedding):
+            for i,layer in enumerate(self.layers):
+                if embedding_insert_layer == (i+1):
+                    output = output + embedding
+                output = run_checkpointed(layer, output, memory, tgt_mask, memory_mask, \
+                                          enabled=self.activation_checkpoint == 'per_layer')
+            return output
+        output = run_checkpointed(run_layers, tgt, memory, embedding, enabled=self.activation_checkpoint == 'per_block')
 
         output = self.norm(output)
         
         return output
 
+    def forward_incremental(self,tgt,memory,cache,pos,memory_shift,embedding,embedding_insert_layer,rewind=0):
+        '''
+        forward on the tokens of new window blocks only, over the keys and values of the earlier blocks cached in
+        cache['self'] and cache['cross'] (a KVRing per layer, see decoder_layer_step)
+            tgt, embedding: (L, batch, E) new tokens at window positions pos (L,); memory: new memory tokens
+            memory_shift: a token at window position i sees the memory at positions <= i+memory_shift, None for all
+        '''
+        assert embedding_insert_layer <= self.num_layers
+        assert embedding.shape == tgt.shape
+        output = tgt
+        for i,(layer,self_ring,cross_ring) in enumerate(zip(self.layers,cache['self'],cache['cross'])):
+            if embedding_insert_layer == (i+1):
+                output = output + embedding
+            output = decoder_layer_step(layer,output,memory,self_ring,cross_ring,pos,memory_shift,rewind)
+
+        return self.norm(output)
+
 class Transformer(nn.Module):
     def __init__(self,all_data,feature_size=250,num_enc_layers=1,num_dec_layers=1,d_ff = 256, dropout=0.1,num_head=2,pe_type='3d',encoder_decoder_type='conv',\
                 grid_size=(16,16,16),mask_type=None,patch_size=(2,2,2),window_size=5,pred_size=1,decoder_only=False,tmsa_config={},conv_config={},load_prev_acrc=False,\
-                ablation={'tmsa':True, 'temp_embed':True, 'encoder':True}):
+                ablation={'tmsa':True, 'temp_embed':True, 'encoder':True},fixed_coords=True,activation_checkpoint='none',precision='fp32'):
         '''
         mask_type: 'patch' if using cuboic patches, which masks by patch instead of elements. Default to None (square_subsequent mask)
+        fixed_coords: if True, the inputs always cover the regular grid, so the positional embedding is precomputed
+                      in the block_to_patch layout per (grid_size, patch_size, shift) and broadcast over the window.
+                      src_coord and tgt_coord are then not used and may be empty (WindowDataset with use_coords=False)
+        activation_checkpoint: activations recomputed in the backward pass instead of kept during training, to fit larger
+                      grids and feature_size in memory. 'none'; 'per_block' each of the TMSA group, encoder and decoder
+                      stacks as a whole; 'per_layer' each TMSA, encoder and decoder layer; 'selective' only the TMSA
+                      window attention, the largest activations as it runs on every grid cell instead of on patches
+        precision: 'fp32', 'bf16_autocast' (fp32 weights, run the forward under autocast) or 'bf16' (bf16 weights and
+                      inputs, see _set_precision). Default to 'fp32'
         '''
         super(Transformer, self).__init__()
+        if activation_checkpoint not in ACTIVATION_CHECKPOINTS:
+            raise ValueError(f'Unknown activation_checkpoint {activation_checkpoint}, expect one of {ACTIVATION_CHECKPOINTS}')
+        self.activation_checkpoint = activation_checkpoint
         self.encoder_decoder_type = encoder_decoder_type
         self.all_data = all_data
         self.feature_size = feature_size
@@ -277,7 +428,9 @@ class Transformer(nn.Module):
                             drop_path=0., #drop probability in drop_path
                             norm_layer=nn.LayerNorm,
                             use_checkpoint_attn=False,
-                            use_checkpoint_ffn=False
+                            use_checkpoint_ffn=False,
+                            attn_backend=tmsa_config.get('attn_backend','math'),
+                            activation_checkpoint=activation_checkpoint
                             )
                             
         if not decoder_only:
@@ -287,13 +440,18 @@ class Transformer(nn.Module):
 
         self.decoder_layer = nn.TransformerDecoderLayer(d_model=feature_size, \
             nhead=num_head, dropout=dropout, dim_feedforward = d_ff)  
-        self.transformer_decoder = Transformer_Decoder(feature_size,num_dec_layers,self.decoder_layer)
+        self.transformer_decoder = Transformer_Decoder(feature_size,num_dec_layers,self.decoder_layer, \
+            activation_checkpoint if activation_checkpoint != 'selective' else 'none')
 
         self.linear_decoder = nn.Sequential(nn.Linear(feature_size,feature_size//2),
                                                 nn.Linear(feature_size//2,5))
         self.ablation = ablation
+        self.fixed_coords = fixed_coords
+        ### (shape, device) key of each mask and embedding cached as a non-persistent buffer, see _cached_buffer
+        self._buffer_keys = {}
 
         self.init_weights()
+        self._set_precision(precision)
 
     def init_weights(self):
         initrange = 0.1    
@@ -306,19 +464,163 @@ class Transformer(nn.Module):
         except:
             print('Error in initializing decoder weights')
 
+    def _set_precision(self, precision):
+        '''
+        Weights and buffers in the dtype of precision, except the LayerNorm and BatchNorm weights and statistics (bf16
+        inputs are normalized with fp32 weights and accumulation) and the time weights of the TemporalEmbedding, as the
+        sin of absolute times needs fp32
+        '''
+        self.precision = precision
+        dtype = precision_dtype(precision)
+        if dtype == torch.float32:
+            return
+        for module in self.modules():
+            if isinstance(module, (nn.LayerNorm, nn.modules.batchnorm._BatchNorm)):
+                continue
+            time_weights = ('w0', 'b0', 'w', 'b') if isinstance(module, TemporalEmbedding) else ()
+            for name, tensor in list(module._parameters.items()) + list(module._buffers.items()):
+                if tensor is not None and tensor.is_floating_point() and name not in time_weights:
+                    tensor.data = tensor.data.to(dtype)
+
     def forward(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_size=(0,0,0,0), temporal_insert_layer=2):
-        
-        ###ROLL ALL INPUTS
-        src = roll_block(src, shift_size, reverse=False)
-        tgt = roll_block(tgt, shift_size, reverse=False)
-        src_coord = roll_block(src_coord, shift_size, reverse=False)
-        tgt_coord = roll_block(tgt_coord, shift_size, reverse=False)
-        src_ts = roll_block(src_ts, shift_size, reverse=False)
-        tgt_ts = roll_block(tgt_ts, shift_size, reverse=False)
+        inputs = [x.unsqueeze(0) for x in (src, tgt, src_coord, tgt_coord, src_ts, tgt_ts)]
+        return self.forward_batch(*inputs, shift_size, temporal_insert_layer)[0]
+
+    def forward_shifts(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_sizes=[(0,0,0,0)], temporal_insert_layer=2):
+        '''
+        One forward of the inputs rolled by each of shift_sizes, see forward_batch
+        return: (K, N, D, H, W, C) outputs, each rolled back to the original order
+        '''
+        inputs = [x.expand((len(shift_sizes),)+x.shape) for x in (src, tgt, src_coord, tgt_coord, src_ts, tgt_ts)]
+        return self.forward_batch(*inputs, list(shift_sizes), temporal_insert_layer)
+
+    def forward_batch(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_size=(0,0,0,0), temporal_insert_layer=2):
+        '''
+        One forward of K independent inputs (e.g. trajectories, or shifted copies of one input) stacked on a leading dim,
+        which the conv encoder and TMSA treat as batch and block_to_patch folds into the patch (transformer batch) dim
+        src, tgt, src_ts, tgt_ts: (K, N, D, H, W, C) inputs, src_coord, tgt_coord the same or empty with fixed_coords
+        shift_size: one shift for all K inputs, or a list of the shift of each
+        return: (K, N, D, H, W, C) outputs, rolled back to the original order
+        '''
+        src, tgt, tgt_ts_embed, roll_shifts = self._embed_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_size)
+        device = src.device
+        ### masks only depend on (patch_size, window_size, shift), built once per shape and device
+        if self.src_mask == 'patch':
+            self.mask = self._cached_buffer('patch_mask', (self.patch_size,self.window_size,0,device), \
+                lambda: self._generate_patch_mask(self.patch_size,self.window_size,0).to(device))
+            self.dec_src_mask = self.mask
+
+        elif self.src_mask is None or self.src_mask.size(0) != len(src):
+            self.mask = self._cached_buffer('square_mask', (src.shape[0],device), \
+                lambda: self._generate_square_subsequent_mask(src.shape[0]).to(device))
+
+        if self.decoder_only:
+            output_dec = self.transformer_decoder(tgt,src,self.mask,None, tgt_ts_embed, temporal_insert_layer)
+            # output_dec = self.decoder_layer(tgt,src,self.mask,self.dec_src_mask)
+        else:
+            output_enc = self._encode(src)
+            output_dec = self.transformer_decoder(tgt,output_enc,self.mask, self.dec_src_mask, tgt_ts_embed, temporal_insert_layer)
+        # print(f'output patch transformer shape: {output_dec.shape}')
+        # print(f'output patch transformer: {output_dec[:27,-2,0]}')
+        # print(f'output patch shape: {output.shape}')
+        # print(f'output patch: {output[:27,-2,0]}')
+        return self._output_blocks(output_dec, roll_shifts)
 
+    def forward_incremental(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, cache=None, shift_size=(0,0,0,0), temporal_insert_layer=2):
+        '''
+        Incremental inference for autoregressive rollouts with the patch mask: the keys and values of every layer of the
+        transformer encoder and decoder are cached per window block (see KVRing), so a step only attends the tokens of the
+        blocks that are new since the previous call, and the oldest blocks are evicted as the window slides. The conv
+        encoder still embeds the whole window; TMSA partitions the window relative to its start, so it has to be disabled.
+        Inputs are full (K, N, D, H, W, C) windows, as for forward_batch, with the same shifts for the whole rollout.
+        With cache=None every block is new and the output equals forward_batch; otherwise the windows slid by pred_size
+        blocks, so the newest pred_size blocks of src are new, and the newest 2 x pred_size of tgt (the prediction that
+        replaced the padding of the previous decoder input, and the new padding, see build_dec_in).
+        Only the keys and values of the first attention layer depend on their block alone: the states of any deeper layer
+        (and the encoder output) depend on the earlier blocks of the window, evicted ones included, so the steps equal
+        forward_batch for models with a single attention layer (decoder_only with one decoder layer) only.
+        return: (K, new tgt blocks, D, H, W, C) outputs of the newest tgt blocks, and the cache for the next step
+        '''
+        shift_sizes = shift_size if isinstance(shift_size, list) else [shift_size]
+        if self.src_mask != 'patch' or any(s[0] != 0 for s in shift_sizes):
+            raise ValueError('incremental decoding needs mask_type="patch" and no temporal shift')
+        if self.ablation['tmsa']:
+            ### its temporal windows start at the first block, so every block is embedded differently once the window slides
+            raise ValueError('incremental decoding needs the TMSA block disabled (ablation["tmsa"]=False)')
+        encoder_layers = [] if self.decoder_only else self.transformer_encoder.layers
+        decoder_layers = self.transformer_decoder.layers
+        if len(encoder_layers) + len(decoder_layers) != 1:
+            raise ValueError(f'incremental decoding is only exact with a single attention layer, the model has '
+                             f'{len(encoder_layers)} encoder and {len(decoder_layers)} decoder layers')
+        src, tgt, tgt_ts_embed, roll_shifts = self._embed_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_size)
+        patch_length = int(self.patch_length)
+        if cache is None:
+            cache = {'encoder': [KVRing(self.window_size, patch_length) for _ in encoder_layers], \
+                     'self': [KVRing(self.window_size, patch_length) for _ in decoder_layers], \
+                     'cross': [KVRing(self.window_size, patch_length) for _ in decoder_layers]}
+            num_src = num_tgt = self.window_size
+        else:
+            num_src, num_tgt = self.pred_size, 2*self.pred_size
+        def positions(num_blocks):
+            return torch.arange(self.window_size-num_blocks, self.window_size, device=src.device).repeat_interleave(patch_length)
+
+        memory = src[-num_src*patch_length:]
+        for layer, ring in zip(encoder_layers, cache['encoder']):
+            memory = encoder_layer_step(layer, memory, ring, positions(num_src))
+        if not self.decoder_only and self.transformer_encoder.norm is not None:
+            memory = self.transformer_encoder.norm(memory)
+        length = num_tgt*patch_length
+        ### dec_src_mask is the patch mask, and decoder_only attends the whole memory
+        output_dec = self.transformer_decoder.forward_incremental(tgt[-length:], memory, cache, positions(num_tgt), \
+                                                                  None if self.decoder_only else 0, tgt_ts_embed[-length:], \
+                                                                  temporal_insert_layer, rewind=num_tgt-num_src)
+        return self._output_blocks(output_dec, roll_shifts), cache
+
+    def _encode(self, src):
+        '''transformer_encoder(src, self.mask) under the activation_checkpoint policy'''
+        if self.activation_checkpoint == 'per_layer':
+            for layer in self.transformer_encoder.layers:
+                src = run_checkpointed(layer, src, self.mask)
+            return src
+        return run_checkpointed(self.transformer_encoder, src, self.mask, enabled=self.activation_checkpoint == 'per_block')
+
+    def _embed_batch(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, shift_size=(0,0,0,0)):
+        '''
+        Front end of forward_batch: the rolled (K, N, D, H, W, C) inputs through the conv encoder, TMSA and the embeddings
+        return: src, tgt and the temporal embedding of tgt as (N x p1 x p2 x p3, K x n1 x n2 x n3, feature_size) tokens,
+                and the roll of the inputs (roll_shifts(x, reverse=True) rolls outputs back)
+        '''
         device = src.device
-        src_coord_patch = block_to_patch(src_coord, self.patch_size, pad_size=0)   
-        tgt_coord_patch = block_to_patch(tgt_coord, self.patch_size, pad_size=0) 
+        num_shifts = src.shape[0]
+        shift_sizes = shift_size if isinstance(shift_size, list) else [shift_size]*num_shifts
+        same_shift = all(shift_size == shift_sizes[0] for shift_size in shift_sizes)
+        cache_pos_embed = self.fixed_coords and self.pe_type == '3d_temporal'
+        if cache_pos_embed:
+            ### embedding of each rolled grid in block (K, 1, nx1, nx2, nx3, C) and patch (K x n1 x n2 x n3, p1 x p2 x p3, C) layout,
+            ### both broadcast over the window and only rebuilt when the spatial shifts change; a single one if all shifts are equal
+            grid_shifts = tuple(tuple(shift_size[1:4]) for shift_size in (shift_sizes[:1] if same_shift else shift_sizes))
+            pos_embed_b = self._cached_buffer('pos_embed_block', (self.grid_size,grid_shifts,device), \
+                lambda: torch.stack([torch.roll(self.pos3d_encoder.pe, shifts=tuple(-s for s in grid_shift), dims=(0,1,2)) \
+                                     for grid_shift in grid_shifts]).unsqueeze(1))
+            pos_embed_patch = self._cached_buffer('pos_embed_patch', (self.grid_size,self.patch_size,grid_shifts,device), \
+                lambda: torch.cat([self.pos3d_encoder.patch_embedding(grid_patch_coords(self.grid_size, self.patch_size, grid_shift)) \
+                                   for grid_shift in grid_shifts]))
+
+        ###ROLL ALL INPUTS
+        def roll_shifts(x, reverse=False):
+            if same_shift:
+                return roll_block(x, shift_sizes[0], reverse=reverse)
+            return torch.stack([roll_block(xk, shift_size, reverse=reverse) for xk, shift_size in zip(x, shift_sizes)])
+        src = roll_shifts(src)
+        tgt = roll_shifts(tgt)
+        if not cache_pos_embed:
+            src_coord = roll_shifts(src_coord)
+            tgt_coord = roll_shifts(tgt_coord)
+        src_ts = roll_shifts(src_ts)
+        tgt_ts = roll_shifts(tgt_ts)
+
+        src_coord_patch = block_to_patch(src_coord, self.patch_size, pad_size=0) if not cache_pos_embed else None
+        tgt_coord_patch = block_to_patch(tgt_coord, self.patch_size, pad_size=0) if not cache_pos_embed else None
         src_ts_patch = block_to_patch(src_ts, self.patch_size, pad_size=0)   
         tgt_ts_patch = block_to_patch(tgt_ts, self.patch_size, pad_size=0)
 
@@ -335,9 +637,13 @@ class Transformer(nn.Module):
             tgt = tgt + self.pos3d_encoder(tgt_coord)
             
         elif self.pe_type == '3d_temporal':
-            src_pos_embed = self.pos3d_encoder(src_coord_patch) 
+            if cache_pos_embed:
+                src_pos_embed_b = tgt_pos_embed_b = pos_embed_b
+                src_pos_embed = tgt_pos_embed = pos_embed_patch
+            else:
+                src_pos_embed = self.pos3d_encoder(src_coord_patch) 
+                tgt_pos_embed = self.pos3d_encoder(tgt_coord_patch) 
             src_ts_embed = self.temporal_encoder(src_ts_patch)
-            tgt_pos_embed = self.pos3d_encoder(tgt_coord_patch) 
             tgt_ts_embed = self.temporal_encoder(tgt_ts_patch)
         
         if not self.ablation['temp_embed']:
@@ -347,13 +653,14 @@ class Transformer(nn.Module):
             
         ### conv encoder to change demension from 5 to feature_size
 
-        src = self.norm1_src(self.conv_encoder(src,self.grid_size)) #+ src_pos_temp_block
-        tgt = self.norm1_src(self.conv_encoder(tgt,self.grid_size)) #+ tgt_pos_temp_block
+        src = self.norm1_src(self.conv_encoder(src,self.grid_size)).view(num_shifts, -1, *self.grid_size, self.feature_size) #+ src_pos_temp_block
+        tgt = self.norm1_src(self.conv_encoder(tgt,self.grid_size)).view(num_shifts, -1, *self.grid_size, self.feature_size) #+ tgt_pos_temp_block
 
 
 
-        src_pos_embed_b = patch_to_block(src_pos_embed, self.window_size, self.patch_size, self.grid_size)
-        tgt_pos_embed_b = patch_to_block(tgt_pos_embed, self.window_size, self.patch_size, self.grid_size)
+        if not cache_pos_embed:
+            src_pos_embed_b = patch_to_block(src_pos_embed, self.window_size, self.patch_size, self.grid_size)
+            tgt_pos_embed_b = patch_to_block(tgt_pos_embed, self.window_size, self.patch_size, self.grid_size)
 
         #if not self.tmsa_with_conv:
         if self.ablation['tmsa']:
@@ -368,8 +675,8 @@ class Transformer(nn.Module):
             tgt_tmsa_embedded = tgt
 
         if self.pos_insert in ['transformer','both']:
-            src = block_to_patch(src + src_tmsa_embedded, self.patch_size, pad_size=0) + src_pos_embed #+ src_ts_embed
-            tgt = block_to_patch(tgt + tgt_tmsa_embedded, self.patch_size, pad_size=0) + tgt_pos_embed #+ tgt_ts_embed
+            src = add_patch_embedding(block_to_patch(src + src_tmsa_embedded, self.patch_size, pad_size=0), src_pos_embed) #+ src_ts_embed
+            tgt = add_patch_embedding(block_to_patch(tgt + tgt_tmsa_embedded, self.patch_size, pad_size=0), tgt_pos_embed) #+ tgt_ts_embed
         else:
             src = block_to_patch(src + src_tmsa_embedded, self.patch_size, pad_size=0)  
             tgt = block_to_patch(tgt + tgt_tmsa_embedded, self.patch_size, pad_size=0) 
@@ -378,36 +685,21 @@ class Transformer(nn.Module):
         ### Transformer
         src = src.permute(1,0,2)
         tgt = tgt.permute(1,0,2)
-        if self.src_mask == 'patch':
-            self.mask = self._generate_patch_mask(self.patch_size,self.window_size,0).to(device)
-            self.dec_src_mask = self._generate_patch_mask(self.patch_size,self.window_size,0).to(device)
-
-        elif self.src_mask is None or self.src_mask.size(0) != len(src):
-            device = src.device
-            self.mask = self._generate_square_subsequent_mask(src.shape[0]).to(device)
+        return src, tgt, tgt_ts_embed.permute(1,0,2), roll_shifts
 
-        if self.decoder_only:
-            output_dec = self.transformer_decoder(tgt,src,self.mask,None, tgt_ts_embed.permute(1,0,2), temporal_insert_layer)
-            # output_dec = self.decoder_layer(tgt,src,self.mask,self.dec_src_mask)
-        else:
-            output_enc = self.transformer_encoder(src,self.mask) 
-            output_dec = self.transformer_decoder(tgt,output_enc,self.mask, self.dec_src_mask, tgt_ts_embed.permute(1,0,2), temporal_insert_layer)
-        # print(f'output patch transformer shape: {output_dec.shape}')
-        # print(f'output patch transformer: {output_dec[:27,-2,0]}')
-        # print(f'output patch shape: {output.shape}')
-        # print(f'output patch: {output[:27,-2,0]}')
+    def _output_blocks(self, output_dec, roll_shifts):
+        '''(n x p1 x p2 x p3, K x n1 x n2 x n3, feature_size) decoder tokens of n window blocks -> (K, n, D, H, W, C) outputs'''
+        num_blocks = output_dec.shape[0]//self.patch_length
+        num_shifts = output_dec.shape[1]*self.patch_length//self.grid_dim
         output = output_dec.permute(1,0,2)
 
-        output = patch_to_block(output, self.window_size, self.patch_size, self.grid_size)
+        output = patch_to_block(output, num_blocks, self.patch_size, self.grid_size).view(num_shifts, num_blocks, *self.grid_size, -1)
 
         output = self.linear_decoder(output)
         # output = self.linear_decoder(output)
 
-        # print(f'output block: {output[-2,:3,:3,:3,0]}')
         ###ROLL BACK TO ORIGINAL ORDER
-        output = roll_block(output, shift_size, reverse=True)
-
-        return output
+        return roll_shifts(output, reverse=True)
 
     # def generate_cov3d_embedding(self, data):
     #     return self.conv_embedding(data, self.grid_size)
@@ -440,6 +732,21 @@ class Transformer(nn.Module):
         time_coord_indices = time_coord_indices.long()
         return conv_embedded_blocks[time_coord_indices.transpose(0,1).chunk(chunks=4, dim=0)].squeeze(0) #shape NxC get corresponding conv embeddings on timestamp and coords, 4 for 4 dimensional indices
 
+    def _cached_buffer(self, name, key, build):
+        '''
+        Return the non-persistent buffer `name`, (re)building it with build() when its key changes
+        key: hashable description of the shape and device the buffer is built for
+        '''
+        ### DataParallel replicas share the plain attributes of the module but own copies of its buffers, so each
+        ### replica keeps its own copy of the keys, matching the buffers it was given
+        if getattr(self, '_is_replica', False) and '_replica_buffer_keys' not in self.__dict__:
+            self._replica_buffer_keys = dict(self._buffer_keys)
+        keys = self.__dict__.get('_replica_buffer_keys', self._buffer_keys)
+        if keys.get(name) != key or name not in self._buffers:
+            self.register_buffer(name, build(), persistent=False)
+            keys[name] = key
+        return getattr(self, name)
+
     def _generate_square_subsequent_mask(self, sz):
         mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
         mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
@@ -13,7 +13,7 @@ import seaborn as sns
 import time
 import random
 import os
-from transformer import Transformer
+from transformer import Transformer, precision_dtype, autocast
 from utils import *
 
 class early_stopping():
@@ -49,7 +49,7 @@ def get_roll_strides(stride,dim=3):
     elif type(stride) == list:
         return list(set(product(stride+[0],repeat=dim)))
 
-def evaluate(model,data_loader,criterion, patch_size, predict_res = False):
+def evaluate(model,data_loader,criterion, patch_size, predict_res = False, dec_method = 'zero'):
     model.eval()    
     test_rollout = torch.Tensor(0)   
     test_result = torch.Tensor(0)  
@@ -73,8 +73,7 @@ def evaluate(model,data_loader,criterion, patch_size, predict_res = False):
                 enc_in = test_rollout[-N:]
 
              # dec_rollout = reduce(enc_in.view(B,window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-            dec_rollout = torch.zeros_like(enc_in[:pred_size]) 
-            dec_in = torch.cat([enc_in[pred_size:], dec_rollout], dim=0).float()
+            dec_in = build_dec_in(enc_in[pred_size:].unsqueeze(0), dec_method, pred_size)[0].float()
             # dec_in = torch.cat([(enc_in.roll(-1,0)-enc_in)[:-pred_size], dec_rollout], dim=0).float()
 
             enc_in = enc_in + (torch.empty(enc_in.shape).normal_(mean=0,std=noise_std)).to(device)
@@ -100,13 +99,23 @@ def predict_model(model, test_loader, epoch, config={},\
     parameters:
         plot_range: [a,b], 0<=a<b<=1, where a is the proportion that determines the start point to plot, b determines the end point. 
         final_prediction: True, if done with training and using the trained/saved model to predict the final result
-        config: dictionary, the config of this plot, used for saving distinguishable plots for each trail
+        config: dictionary, the config of this plot, used for saving distinguishable plots for each trail,
+                config['dec_method'] selects the decoder input of the rollout steps (see build_dec_in), default 'zero'
+                config['roll_strides'] the get_roll_strides strides of the shift ensemble averaged at every step, default [0]
+                config['shift_chunk_size'] shifts per batched forward, default as many as fit the free device memory (all on cpu)
+                config['kv_cache'] if True, steps only attend the new blocks over cached keys/values (needs the TMSA block
+                disabled and a single attention layer, see Transformer.forward_incremental), default False
+                the inputs are cast to the dtype of the model precision (see Transformer), the ensemble moments, the
+                rollout and the scaler inverse transform stay in fp32
     '''
     model.eval()
-    test_result = torch.Tensor(0) 
-    truth = torch.Tensor(0) 
-    test_ts = torch.Tensor(0)
-    test_coord = torch.Tensor(0)
+    precision = getattr(getattr(model, 'module', model), 'precision', 'fp32')
+    dtype = precision_dtype(precision)
+    ### WindowDataset items stop one window before len (tgt is the next window), each predicts pred_size blocks
+    num_steps = len(test_loader)-1 if isinstance(test_loader, WindowDataset) else len(test_loader)
+    shift_sizes = [(0,)+shift_size for shift_size in get_roll_strides(config.get('roll_strides', [0]))]
+    chunk_size = config.get('shift_chunk_size')
+    kv_cache = None ### attention cache of the rollout with config['kv_cache'], see Transformer.forward_incremental
     device = "cpu"
     if torch.cuda.is_available():
         device = "cuda:0"
@@ -118,65 +127,49 @@ def predict_model(model, test_loader, epoch, config={},\
 
             src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), src_coord.to(device),\
                                                                             tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
-            
-            temp_rollout = []
-            for shift_size in get_roll_strides([0]):
-                shift_size = (0,) + shift_size
-                if i==0:
-                    N,D,H,W,C = src.shape
-                    enc_in = src
-                    test_rollout = src
-                    # src_block = src_block.to(device)
+            if i==0:
+                writer = RolloutWriter(num_steps*pred_size*int(np.prod(src.shape[1:4])), \
+                                       {'time': 0, 'coord': 3, 'prediction': 0, 'truth': 0, 'ensemble_std': 0})
+                N,D,H,W,C = src.shape
+                enc_in = src
+                ### the last N blocks of the rollout, the only part of it the model reads
+                test_rollout = RingContext(src, dim=0)
+            else:
+                enc_in = test_rollout.get()
+            # dec_rollout = reduce(enc_in.view(B,window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
+            dec_in = build_dec_in(enc_in[pred_size:].unsqueeze(0), config.get('dec_method', 'zero'), pred_size)[0].float()
+            # dec_in = dec_in + (torch.empty(dec_in.shape).normal_(mean=0,std=noise_std)).to(device)
+            inputs = (enc_in.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts)
+            with autocast(precision, device):
+                if config.get('kv_cache', False):
+                    ### each shifted copy keeps its own cached blocks, so all shifts go through one incremental forward
+                    shifted = [x.expand((len(shift_sizes),)+x.shape) for x in inputs]
+                    outputs, kv_cache = getattr(model, 'module', model).forward_incremental(*shifted, kv_cache, shift_sizes, temporal_insert_layer)
+                    ensemble = RunningMoments()
+                    ensemble.update(outputs)
+                    output = ensemble.mean + enc_in[-outputs.shape[1]:]
                 else:
-                    enc_in = test_rollout[-N:]
-                # dec_rollout = reduce(enc_in.view(B,window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-                dec_rollout = torch.zeros_like(enc_in[:pred_size]) 
-                dec_in = torch.cat([enc_in[pred_size:], dec_rollout], dim=0).float()
-                # dec_in = dec_in + (torch.empty(dec_in.shape).normal_(mean=0,std=noise_std)).to(device)
-                output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts, shift_size, temporal_insert_layer)
-
-                output = output + enc_in
-                temp_rollout.append(output)
-
-            output = torch.stack(temp_rollout, dim=0).mean(dim=0)
-            test_rollout = torch.cat([test_rollout,output[-pred_size:,:,:,:,:]], dim=0)
-            test_ts = torch.cat((test_ts, tgt_ts[-pred_size:,:,:,:,:].flatten().detach().cpu()), 0)
-            test_coord = torch.cat((test_coord, tgt_coord[-pred_size:,:,:,:,:].reshape(-1,3).detach().cpu()), 0)
-            truth = torch.cat((truth, tgt[-pred_size:,:,:,:,0].flatten().detach().cpu()), 0)
-            test_result = torch.cat((test_result, output[-pred_size:,:,:,:,0].flatten().detach().cpu()), 0)
+                    if chunk_size is None:
+                        chunk_size = shift_chunk_size(model, inputs, shift_sizes, temporal_insert_layer)
+                    ### all shifted copies in batched forwards, their mean and variance accumulated in place
+                    ensemble = shift_ensemble(model, inputs, shift_sizes, chunk_size, temporal_insert_layer)
+                    output = ensemble.mean + enc_in
+            test_rollout.push(output[-pred_size:,:,:,:,:])
+            writer.write(time=tgt_ts[-pred_size:,:,:,:,:], coord=tgt_coord[-pred_size:,:,:,:,:], \
+                         prediction=output[-pred_size:,:,:,:,0], truth=tgt[-pred_size:,:,:,:,0], \
+                         ensemble_std=ensemble.var[-pred_size:,:,:,:,0].sqrt())
+
+        rollout = writer.result()
+        test_ts, test_coord, test_result, truth = rollout['time'], rollout['coord'], rollout['prediction'], rollout['truth']
+        ### band of one ensemble std around the forecast, mapped through the scaler like the forecast
+        bounds = [test_result-rollout['ensemble_std'], test_result+rollout['ensemble_std']]
         
 
-        # if predict_res:
-        #     residuals = pd.DataFrame.from_dict(final_result)
-        #     truth = pd.read_csv('tune_results/data_original.csv',index_col=0)
-        #     ### Group by time since last timestamp is duplicated
-        #     truth.time = np.round(truth.time.values,5)
-        #     residuals.time = np.round(residuals.time.values,5)
-        #     residuals = residuals.groupby(['time','x1','x2','x3']).mean().reset_index()
-        #     truth = truth.groupby(['time','x1','x2','x3']).mean().reset_index()
-        #     ### Reconstruct predictions, truth is also reconstructed to validate answer
-        #     pred_timestamps = residuals.time.unique()
-        #     pred_start_time = residuals.time[0]
-        #     pred_start_truth = truth[truth['time']==truth.time.unique()[-len(pred_timestamps)]]
-        #     for i,(t1,t2) in enumerate(zip(pred_timestamps,truth.time.unique()[-len(pred_timestamps):])):
-        #         truth_values = truth.loc[truth['time']==t2].truth_original.values
-        #         pred_values = residuals.loc[residuals['time']==t1].prediction.values
-        #         truth_check_values = residuals.loc[residuals['time']==t1].truth.values
-        #         if i==0:
-        #             prev_truth_plus_residual = pred_values+truth_values
-        #         else:
-        #             prev_truth_plus_residual = pred_values+prev_truth_plus_residual
-        #         residuals.loc[residuals['time']==t1,'prediction']= prev_truth_plus_residual
-        #         residuals.loc[residuals['time']==t1,'truth'] = truth_check_values+truth_values
-        #     final_result = residuals
 
     if plot==True:
         a = torch.cat([test_ts.unsqueeze(-1), test_coord, test_result.unsqueeze(-1), truth.unsqueeze(-1)], dim=-1)
         a = a.numpy()
-        a = a[np.argsort(a[:, 3])]
-        a = a[np.argsort(a[:, 2], kind='stable')]
-        a = a[np.argsort(a[:, 1], kind='stable')]
-        a = a[np.argsort(a[:, 0], kind='stable')]
+        a = sort_grid_rows(a)
         final_result_unscaled = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5]}
 
         fig, ax = plt.subplots(nrows =1, ncols=1, figsize=(20,10))
@@ -196,17 +189,25 @@ def predict_model(model, test_loader, epoch, config={},\
         if config['scale']==True:
             test_result = torch.Tensor(scaler.inverse_transform(test_result.unsqueeze(-1)))
             truth = torch.Tensor(scaler.inverse_transform(truth.unsqueeze(-1)))
+            bounds = [torch.Tensor(scaler.inverse_transform(bound.unsqueeze(-1))) for bound in bounds]
         else:
             test_result = test_result.unsqueeze(-1)
             truth = truth.unsqueeze(-1)
+            bounds = [bound.unsqueeze(-1) for bound in bounds]
 
-        a = torch.cat([test_ts.unsqueeze(-1), test_coord, test_result, truth], dim=-1)
+        a = torch.cat([test_ts.unsqueeze(-1), test_coord, test_result, truth] + bounds, dim=-1)
         a = a.numpy()
-        a = a[np.argsort(a[:, 3])]
-        a = a[np.argsort(a[:, 2], kind='stable')]
-        a = a[np.argsort(a[:, 1], kind='stable')]
-        a = a[np.argsort(a[:, 0], kind='stable')]
-        final_result = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5]}
+        if predict_res:
+            ### residuals -> absolute values, accumulated from the last observed snapshot of the unscaled series
+            dataset = test_loader if isinstance(test_loader, WindowDataset) else test_loader.dataset
+            if getattr(dataset, 'origin', None) is None:
+                raise ValueError('predict_res needs the absolute series of the test set, see WindowDataset origin')
+            a = reconstruct_residual_rows(a, dataset.origin, dataset.times)
+            final_result = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5]}
+        else:
+            a = sort_grid_rows(a)
+            final_result = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5], \
+                            'lower': a[:,6], 'upper': a[:,7]}
         
 
         # plot a part of the result
@@ -215,6 +216,9 @@ def predict_model(model, test_loader, epoch, config={},\
         plot_end = int(len(final_result['prediction'])*plot_range[1])
         ax.plot(final_result['truth'][plot_start:plot_end],label = 'truth')
         ax.plot(final_result['prediction'][plot_start:plot_end],label='forecast')
+        if 'lower' in final_result:
+            ax.fill_between(np.arange(plot_end-plot_start), final_result['lower'][plot_start:plot_end], \
+                            final_result['upper'][plot_start:plot_end], alpha=0.3, label='shift ensemble std')
         ax.plot(final_result['prediction'][plot_start:plot_end] - final_result['truth'][plot_start:plot_end],ls='--',label='residual')            
         #ax.grid(True, which='both')
         ax.axhline(y=0)
@@ -299,7 +303,7 @@ if __name__ == "__main__":
 
 
     conv_config = {'num_layer':4, 'start_filts':32, 'conv_type': 'UNet'}
-    tmsa_config = {'tmsa_with_conv': False, 'use_tmsa':True, 'use_tgt_tmsa':True, 'window_patch_size': (2,2,2,2), 'shift_size': (1,0,0,0), 'depth': 6, 'num_heads':4}
+    tmsa_config = {'tmsa_with_conv': False, 'use_tmsa':True, 'use_tgt_tmsa':True, 'window_patch_size': (2,2,2,2), 'shift_size': (1,0,0,0), 'depth': 6, 'num_heads':4, 'attn_backend': 'math'}
     data_config = {'scale': False, 'noise_std':0.0, 'window_size': 4, 'option': 'patch', 'predict_res': False, 'scaler_type':'standard','patch_size': (4,4,4),}
     best_config = {'epochs':30, 'pe_type': '3d_temporal', 'batch_size': 1, 'feature_size': 288*4, 'num_enc_layers': 2\
                 , 'num_dec_layers': 4, 'temporal_insert_layer' : 3, 'num_head': 4, 'd_ff': 512, 'dropout': 0.2, 'lr': 1e-4, 'lr_decay': 0.8, 'loss_type':'smooth_l1', 'delta': 0.1\
@@ -428,8 +432,7 @@ if __name__ == "__main__":
                 # for shift_size in get_roll_strides(2): ### Add shift size as model input if uncommenting this
                 #     shift_size = (0,) + shift_size
                     #dec_rollout = reduce(src.view(src.shape[0],window_size,patch_length,-1), 'b n p c -> b p c', 'mean')
-                dec_rollout = torch.zeros_like(src[:pred_size])
-                dec_in = torch.cat([src[pred_size:], dec_rollout], dim=0).float()
+                dec_in = build_dec_in(src[pred_size:].unsqueeze(0), 'zero', pred_size)[0].float()
                 # dec_in = torch.cat([(tgt-src)[:-pred_size], dec_rollout], dim=0).float()
 
                 dec_in = dec_in + (torch.empty(tgt.shape).normal_(mean=0,std=noise_std,generator = g_cpu.manual_seed(seed))).to(device)
@@ -544,4 +547,17 @@ if __name__ == "__main__":
                             plot_anime = True, img_dir = img_dir, config=best_config, file_prefix=file_prefix) 
     
     # save_pred(train_loader, 'train')
-    save_pred(test_loader, 'test')
\ No newline at end of file
+    save_pred(test_loader, 'test')
+
+    ### Ensemble evaluation: the test part of every run of eval_seeds rolled out together, one batched forward per step
+    eval_seeds = []
+    if eval_seeds:
+        runs, run_times = load_runs(eval_seeds, res_size=str(grid_size), scaler=scaler)
+        starts = [(run, int(len(series)*(1-test_proportion))) for run, series in enumerate(runs)]
+        num_steps = min(len(series)-start-window_size for (_, start), series in zip(starts, runs))//pred_size
+        start_time = time.time()
+        ensemble_metrics = rollout_trajectories(model, runs, run_times, starts, window_size, num_steps, pred_size=pred_size, \
+                                                temporal_insert_layer=temporal_insert_layer)
+        print(f'Time to roll out {len(starts)} trajectories of {num_steps} steps: {time.time()-start_time} s', flush=True)
+        for seed, mse, mae in zip(eval_seeds, ensemble_metrics['mse'], ensemble_metrics['mae']):
+            print(f'seed {seed}: MSE: {mse.mean().item()}, MAE: {mae.mean().item()}', flush=True)
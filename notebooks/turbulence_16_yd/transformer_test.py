@@ -4,6 +4,8 @@ import torch.nn as nn
 import numpy as np
 import math
 
+from tmsa import scaled_attention, AttentionMask, ATTN_BACKENDS
+
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_model, dropout= 0.1, max_len= 5000):
@@ -119,14 +121,20 @@ class TemporalEmbedding(nn.Module):
         return x
 
 class multihead_attn(nn.Module):
-    def __init__(self, embed_dim, num_head):
+    def __init__(self, embed_dim, num_head, attn_backend='math'):
+        '''
+        attn_backend: 'math', 'sdpa', 'chunked' or 'block_sparse', see tmsa.scaled_attention; all but 'math' never build the
+                      full score tensor, and 'block_sparse' computes only the past and current blocks of the patch mask
+        '''
         super().__init__()
         self.embed_dim = embed_dim
         self.num_head = num_head
         self.head_dim = embed_dim // num_head
         assert self.embed_dim == self.head_dim*self.num_head, f'embedding dimension {self.embed_dim} is not divisible by num_head {self.num_head}'
+        if attn_backend not in ATTN_BACKENDS:
+            raise ValueError(f'Unknown attention backend {attn_backend}, expect one of {ATTN_BACKENDS}')
+        self.attn_backend = attn_backend
         
-        self.softmax = nn.Softmax(dim=-1)
         self.query_proj = nn.Linear(embed_dim, embed_dim)
         self.key_proj = nn.Linear(embed_dim, embed_dim)
         self.value_proj = nn.Linear(embed_dim, embed_dim)
@@ -149,23 +157,15 @@ class multihead_attn(nn.Module):
         B, H, L, E = q.shape 
         _, H, K, _ = k.shape 
         
-        attn = q/np.sqrt(E)@k.transpose(-1,-2) #BxHxLxE @ BxHxExK -> BxHxLxK
-
-        if attn_mask is not None:
-            if attn_mask.dim() == 2:  #broadcast 2D mask
-                attn_mask = attn_mask.unsqueeze(0)
-            attn = attn+attn_mask
-            
-        attn = self.softmax(attn) #BxHxLxK
-        
-        out = attn@v #BxHxLxK @ BxHxKxE -> BxHxLxE
+        ### softmax(q/sqrt(E) @ k^T + attn_mask) @ v, the (L, K) mask broadcast over B and H
+        out = scaled_attention(q, k, v, attn_mask, 1/np.sqrt(E), self.attn_backend) #BxHxLxE
         return out
 
 class decoder_layer(nn.Module):
-    def __init__(self, embed_dim, num_head, ff_dim, dropout):
+    def __init__(self, embed_dim, num_head, ff_dim, dropout, attn_backend='math'):
         super().__init__()
-        self.self_attention = multihead_attn(embed_dim, num_head)
-        self.cross_attention = multihead_attn(embed_dim, num_head)
+        self.self_attention = multihead_attn(embed_dim, num_head, attn_backend)
+        self.cross_attention = multihead_attn(embed_dim, num_head, attn_backend)
         self.norm1 = nn.LayerNorm(embed_dim)
         self.norm2 = nn.LayerNorm(embed_dim)
         self.norm3 = nn.LayerNorm(embed_dim)
@@ -203,9 +203,11 @@ class decoder(nn.Module):
         return out
 
 class Transformer(nn.Module):
-    def __init__(self,feature_size=250,num_enc_layers=1,num_dec_layers=1,d_ff = 256, dropout=0.1,num_head=2,pe_type='3d',grid_size=16,mask_type=None,patch_size=(2,2,2),window_size=5,decoder_only=False):
+    def __init__(self,feature_size=250,num_enc_layers=1,num_dec_layers=1,d_ff = 256, dropout=0.1,num_head=2,pe_type='3d',grid_size=16,mask_type=None,patch_size=(2,2,2),window_size=5,decoder_only=False,attn_backend='math'):
         '''
         mask_type: 'patch' if using cuboic patches, which masks by patch instead of elements. Default to None (square_subsequent mask)
+        attn_backend: attention of the decoder layers, 'math' (explicit scores), 'sdpa', 'chunked' or 'block_sparse'
+                      (memory-efficient, see tmsa.scaled_attention). Default to 'math'
         '''
         super().__init__()
         self.patch_size = patch_size
@@ -221,9 +223,11 @@ class Transformer(nn.Module):
         self.encoder_layer = nn.TransformerEncoderLayer(d_model=feature_size, \
             nhead=num_head, dropout=dropout, dim_feedforward = d_ff)
         self.transformer_encoder = nn.TransformerEncoder(self.encoder_layer, num_layers=num_enc_layers)      
-        self.decoder_layer = decoder_layer(embed_dim = feature_size, num_head = num_head, ff_dim = d_ff, dropout = dropout)  
+        self.decoder_layer = decoder_layer(embed_dim = feature_size, num_head = num_head, ff_dim = d_ff, dropout = dropout, attn_backend = attn_backend)  
         self.transformer_decoder = decoder(self.decoder_layer, num_layers=num_dec_layers)
         self.decoder = nn.Linear(feature_size,1)
+        ### AttentionMask of each (mask type, shape, device)
+        self._masks = {}
         self.init_weights()
 
     def init_weights(self):
@@ -255,13 +259,18 @@ class Transformer(nn.Module):
             # src = src.permute(1,0,2)
             # tgt = tgt.permute(1,0,2)
 
-        ### generate patch mask
+        ### generate patch mask, once per shape and device with the keys its queries see (see tmsa.AttentionMask)
+        device = src.device
         if self.tgt_mask == 'patch':
-            device = src.device
-            tgt_mask = self._generate_patch_mask(self.patch_size,self.window_size).to(device)
+            key = ('patch', self.patch_size, self.window_size, device)
+            if key not in self._masks:
+                self._masks[key] = AttentionMask(self._generate_patch_mask(self.patch_size,self.window_size).to(device))
+            tgt_mask = self._masks[key]
         elif self.tgt_mask is None or self.tgt_mask.size(0) != len(src):
-            device = src.device
-            tgt_mask = self._generate_square_subsequent_mask(src.shape[0]).to(device)
+            key = ('square', src.shape[0], device)
+            if key not in self._masks:
+                self._masks[key] = AttentionMask(self._generate_square_subsequent_mask(src.shape[0]).to(device))
+            tgt_mask = self._masks[key]
             print(f'USING TRIANGULAR MASK!')
         # print('PE out shape: ',self.pos_encoder(src).shape)
         # print('PE out shape: ',self.pos_encoder(src).shape)
@@ -10,6 +10,7 @@ import math
 import time
 
 from unet_3d import UNet
+from tmsa import ACTIVATION_CHECKPOINTS, run_checkpointed
 
 
 class conv_3d(nn.Module):
@@ -83,9 +84,16 @@ class TemporalEmbedding(nn.Module):
         return x
 
 class Unet(nn.Module):
-    def __init__(self,feature_size=250, conv_config={}):
-
+    def __init__(self,feature_size=250, conv_config={}, activation_checkpoint='none'):
+        '''
+        activation_checkpoint: activations of the UNet recomputed in the backward pass instead of kept during training,
+                      'per_block' for the whole UNet, 'per_layer' for each down and up conv (UNet.forward_gradcp);
+                      'selective' only covers attention, so it keeps everything here like 'none'
+        '''
         super(Unet, self).__init__()
+        if activation_checkpoint not in ACTIVATION_CHECKPOINTS:
+            raise ValueError(f'Unknown activation_checkpoint {activation_checkpoint}, expect one of {ACTIVATION_CHECKPOINTS}')
+        self.activation_checkpoint = activation_checkpoint
 
         self.feature_size = feature_size
 
@@ -123,11 +131,23 @@ class Unet(nn.Module):
     
         src_block = self.conv_encoder(src.permute(0,4,1,2,3)) 
         ### CONV EMBEDDING
-        src_conv_embedded = self.conv_embedding(src_block)
+        if self.activation_checkpoint == 'per_layer' and torch.is_grad_enabled():
+            src_conv_embedded = self.conv_embedding.forward_gradcp(src_block)
+        else:
+            src_conv_embedded = run_checkpointed(self.conv_embedding, src_block, enabled=self.activation_checkpoint == 'per_block')
 
         src_conv_embedded = self.conv_decoder(src_conv_embedded).permute(0,2,3,4,1)
  
         return src_conv_embedded
-        
+
+    def forward_batch(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, *args):
+        '''
+        Same interface as Transformer.forward_batch for K independent (N, D, H, W, C) inputs stacked on a leading dim;
+        every snapshot is convolved on its own, so K is folded into the conv batch. The shift args are not used
+        return: (K, N, D, H, W, C) outputs
+        '''
+        output = self.forward(src.flatten(0,1), None, None, None, None, None)
+        return output.view(src.shape[:2]+output.shape[1:])
+
 
    
\ No newline at end of file
@@ -890,13 +890,13 @@ class UNet(nn.Module):
         encoder_outs = []
         i = 0
         for module in self.down_convs:
-            x, before_pool = checkpoint(module, x)
+            x, before_pool = checkpoint(module, x, use_reentrant=True)
             encoder_outs.append(before_pool)
             i += 1
         i = 0
         for module in self.up_convs:
             before_pool = encoder_outs[-(i+2)]
-            x = checkpoint(module, before_pool, x)
+            x = checkpoint(module, before_pool, x, use_reentrant=True)
             i += 1
         x = self.conv_final(x)
         # self.feature_maps = [x]  # Currently disabled to save memory
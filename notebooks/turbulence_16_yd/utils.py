@@ -1,5 +1,7 @@
 #!/bin/bash python
 import os
+import random
+import warnings
 import numpy as np
 import pandas as pd
 import math
@@ -10,6 +12,7 @@ import matplotlib.animation as animation
 from matplotlib import patches
 from _arfima import arfima
 from athena_read import *
+from transformer import precision_dtype, autocast
 from sklearn.preprocessing import StandardScaler, PowerTransformer, RobustScaler, QuantileTransformer
 from sklearn.metrics import mean_absolute_error, mean_squared_error, explained_variance_score, r2_score
 
@@ -17,29 +20,67 @@ from sklearn.metrics import mean_absolute_error, mean_squared_error, explained_v
 # dict_keys(['Coordinates', 'DatasetNames', 'MaxLevel', 'MeshBlockSize', 'NumCycles', \
 # 'NumMeshBlocks', 'NumVariables', 'RootGridSize', 'RootGridX1', 'RootGridX2', 'RootGridX3', \
 # 'Time', 'VariableNames', 'x1f', 'x1v', 'x2f', 'x2v', 'x3f', 'x3v', 'rho', 'press', 'vel1', 'vel2', 'vel3'])
-def get_rho(data_path, predict_res = False, noise_std = 0.01, var_name = 'rho'):
-    np.random.seed(1008)
+def get_data_path(res_size = '16', seed = 1, source_res_size = None):
+    '''
+    Directory of the run used for res_size, and the grid size to coarsen it to (None for no coarsening)
+    source_res_size: resolution of the run to read; if given, its snapshots are coarsened to res_size
+    '''
+    coarse_grid_size = None
+    if source_res_size is not None and int(source_res_size) != int(res_size):
+        coarse_grid_size = int(res_size)
+        data_path=f'/scratch/yd1008/tnt/athena/data_turb_dedt1_{str(source_res_size)}'
+    else:
+        data_path=f'/scratch/yd1008/tnt/athena/data_turb_dedt1_{str(res_size)}'
+    if seed:
+        data_path = data_path+f'{seed}'
+    return data_path, coarse_grid_size
+
+def load_snapshots(data_path, var_names = ['rho','vel1','vel2','vel3','press'], num_workers = 8, grid_size = None, coarsen_method = 'mean'):
+    '''
+    Read the run once into a compact dict that can be shared between DataLoader workers and Ray Tune trials
+    (e.g. tune.with_parameters(train, snapshots=snapshots) puts it in the Ray object store once, and each trial
+    maps the arrays zero-copy); pass it as snapshots= to get_snapshots, get_rho or get_data_loaders
+    return:
+        {'data': (T, nx1, nx2, nx3, C) float32 array, 'time': (T,) array, 'var_names': var_names}
+    '''
     lst = sorted(os.listdir(data_path))[4:-1]
-    rho = []
-    coords = []
-    timestamps = []
-    for name in lst:
-        path = data_path+'/'+name
-        d = athdf(path)
-        nx1 = len(d['x1v'])
-        nx2 = len(d['x2v'])
-        nx3 = len(d['x3v'])
-        coord = np.transpose(np.array(np.meshgrid(np.arange(nx1),np.arange(nx2),np.arange(nx3))), axes=[2,1,3,0]).reshape(-1,3)
-        rho.append(d[var_name])
-        timestamp_repeated = [d['Time']]*(np.prod(d[var_name].shape))
-        timestamps.extend(timestamp_repeated) 
-        coords.extend(coord)
-        #print(f"Name: {name}, keys: {d.keys()}", flush=True)#x1v: {d['x1v']}, x2v: {d['x2v']}, x3v:{d['x3v']}
-
-    rho = np.array(rho)
+    series = athdf_series([data_path+'/'+name for name in lst], var_names, num_workers=num_workers, \
+                          grid_size=grid_size, coarsen_method=coarsen_method)
+    return {'data': series['data'].astype(np.float32, copy=False), 'time': series['Time'], 'var_names': list(var_names)}
+
+def select_vars(snapshots, var_names):
+    '''(T, nx1, nx2, nx3, len(var_names)) data of snapshots, a view if var_names are all the stored variables in order'''
+    if list(var_names) == snapshots['var_names']:
+        return snapshots['data']
+    return snapshots['data'][..., [snapshots['var_names'].index(v) for v in var_names]]
+
+def get_snapshots(data_path, var_names = ['rho','vel1','vel2','vel3','press'], num_workers = 8, grid_size = None, coarsen_method = 'mean', snapshots = None):
+    '''
+    Read all variables of every snapshot in data_path in one pass per file
+    grid_size: if given, coarsen each snapshot to (grid_size, grid_size, grid_size) while reading
+    coarsen_method: 'mean', 'max' or 'volume', see athena_read.coarsen
+    snapshots: preloaded output of load_snapshots; if given, data_path is not read
+    return:
+        data: (T, nx1, nx2, nx3, C) array, C in the order of var_names
+        meshed_blocks: (nx1, nx2, nx3)
+        coords: (T x nx1 x nx2 x nx3, 3) grid indices of each cell
+        timestamps: (T x nx1 x nx2 x nx3,) simulation time of each cell
+    '''
+    if snapshots is None:
+        snapshots = load_snapshots(data_path, var_names, num_workers, grid_size, coarsen_method)
+    data = select_vars(snapshots, var_names)
+    nx1, nx2, nx3 = data.shape[1:4]
+    coord = np.transpose(np.array(np.meshgrid(np.arange(nx1),np.arange(nx2),np.arange(nx3))), axes=[2,1,3,0]).reshape(-1,3)
     meshed_blocks = (nx1, nx2, nx3)
-    timestamps = np.array(timestamps)
-    coords = np.array(coords)
+    timestamps = np.repeat(snapshots['time'], np.prod(data.shape[1:-1]))
+    coords = np.tile(coord, (data.shape[0],1))
+    return data, meshed_blocks, coords, timestamps
+
+def get_rho(data_path, predict_res = False, noise_std = 0.01, var_name = 'rho', num_workers = 8, grid_size = None, coarsen_method = 'mean', snapshots = None):
+    np.random.seed(1008)
+    rho, meshed_blocks, coords, timestamps = get_snapshots(data_path, var_names=[var_name], num_workers=num_workers, \
+                                                           grid_size=grid_size, coarsen_method=coarsen_method, snapshots=snapshots)
+    nx1, nx2, nx3 = meshed_blocks
     rho_original = rho.flatten()
     #rho_original = rho_original + np.random.normal(0,noise_std,len(rho_original))
 
@@ -48,8 +89,8 @@ def get_rho(data_path, predict_res = False, noise_std = 0.01, var_name = 'rho'):
         rho_residual = (np.roll(rho_original,-nx1*nx2*nx3)-rho_original)[:-nx1*nx2*nx3] ### Residual
         timestamps = timestamps[nx1*nx2*nx3:]
         coords = coords[nx1*nx2*nx3:]
-        #rho_original = rho_original[:-nx1*nx2*nx3] ### to reconstruct truth from residuals, take the first meshblock of rho_original and add the residuals.
-        return rho_original[nx1*nx2*nx3:], rho_residual, meshed_blocks, coords, timestamps
+        ### rho_original keeps the first block, residual t goes from block t to block t+1 of it (see reconstruct_residual_rows)
+        return rho_original, rho_residual, meshed_blocks, coords, timestamps
     else: 
         return rho_original, meshed_blocks, coords, timestamps
     # print(f'rho shape: {rho_original.shape}, coords shape: {coords.shape}')
@@ -180,35 +221,45 @@ def to_windowed(x, block_size, window_size, feature_size):
     
 #     return train_data,val_data,test_data,scaler
 
+def fit_scaler(data, scaler_type='standard'):
+    if scaler_type not in ['standard','power_box','power_yeo','robust']:
+        scaler_type = 'standard'
+    if scaler_type == 'standard':
+        scaler = StandardScaler()
+    elif scaler_type == 'power_box':
+        scaler = PowerTransformer(method='box-cox',standardize=True)
+    elif scaler_type == 'power_yeo':
+        scaler = PowerTransformer(method='yeo-johnson',standardize=True)
+    elif scaler_type == 'robust':
+        scaler = RobustScaler(with_centering=False,with_scaling=True,quantile_range=(25.0, 75.0),copy=True,unit_variance=False)
+    elif scaler_type == 'quantile':
+        scaler = QuantileTransformer(output_distribution='normal')
+    print(f'Using scaler: {scaler_type}')
+    data = scaler.fit_transform(data)
+    return data, scaler
+
+def split_windows(total_len, train_proportion = 0.6, val_proportion = 0.2):
+    '''
+    Window index ranges [start, stop) of the train, val and test sets, stop=None for up to the last window
+    '''
+    train_len = int(total_len*train_proportion)
+    val_len = int(total_len*val_proportion)
+    return (0, train_len), (train_len, train_len+val_len), (train_len+val_len, None)
+
 def train_test_val_split(data, meshed_blocks, train_proportion = 0.6, val_proportion = 0.2, test_proportion = 0.2\
               , pred_size = 1, feature_size = 5, scale = False, window_size = 10, patch_size=(1,1,16), option='patch', scaler_type='standard'):
     
     if scale == True:
-        if scaler_type not in ['standard','power_box','power_yeo','robust']:
-            scaler_type = 'standard'
-        if scaler_type == 'standard':
-            scaler = StandardScaler()
-        elif scaler_type == 'power_box':
-            scaler = PowerTransformer(method='box-cox',standardize=True)
-        elif scaler_type == 'power_yeo':
-            scaler = PowerTransformer(method='yeo-johnson',standardize=True)
-        elif scaler_type == 'robust':
-            scaler = RobustScaler(with_centering=False,with_scaling=True,quantile_range=(25.0, 75.0),copy=True,unit_variance=False)
-        elif scaler_type == 'quantile':
-            scaler = QuantileTransformer(output_distribution='normal')
-        print(f'Using scaler: {scaler_type}')
-        data = scaler.fit_transform(data)
+        data, scaler = fit_scaler(data, scaler_type)
     else:
         scaler = None
     
     data_windowed = to_windowed(data, meshed_blocks, window_size, feature_size) #already float tensors
 
-    total_len = data_windowed.shape[0]
-    train_len = int(total_len*train_proportion)
-    val_len = int(total_len*val_proportion)
+    (_, train_len), (_, val_stop), _ = split_windows(data_windowed.shape[0], train_proportion, val_proportion)
     train_data = data_windowed[0:train_len]
-    val_data = data_windowed[train_len:(train_len+val_len)]
-    test_data = data_windowed[(train_len+val_len):]
+    val_data = data_windowed[train_len:val_stop]
+    test_data = data_windowed[val_stop:]
     
     return train_data,val_data,test_data,scaler
 
@@ -235,25 +286,418 @@ class CustomDataset(torch.utils.data.Dataset):
                 (src_timestamp, tgt_timestamp) )
 
 
-def get_data_loaders(train_proportion = 0.5, test_proportion = 0.25, val_proportion = 0.25, \
-                        pred_size =1, batch_size = 16, num_workers = 1, pin_memory = True, \
-                        use_coords = True, use_time = True, test_mode = False, scale = False, \
-                        window_size = 10, patch_size=(1,1,16), grid_size=(16,16,16), option='patch',\
-                        predict_res=False, noise_std=0.01, scaler_type='standard', seed = 1, res_size='16'): 
-    np.random.seed(1008)
-    
-    data_path=f'/scratch/yd1008/tnt/athena/data_turb_dedt1_{str(res_size)}'
-    if seed:
-        data_path = data_path+f'{seed}'
+def _shift_right(z, bits):
+    '''Logical right shift of int64 tensors, as for their uint64 bits'''
+    return (z >> bits).bitwise_and_((1 << (64-bits)) - 1)
+
+def _splitmix64(z):
+    '''splitmix64 finalizer of int64 tensors, in place, the products wrapping around as uint64 ones'''
+    z = (z ^ _shift_right(z, 30)).mul_(-4658895280553007687) ### 0xBF58476D1CE4E5B9
+    z = (z ^ _shift_right(z, 27)).mul_(-7723592293110705685) ### 0x94D049BB133111EB
+    return z.bitwise_xor_(_shift_right(z, 31))
+
+def counter_normal(seed, keys, shape):
+    '''
+    (len(keys), *shape) float32 standard normal values, those of each key a function of (seed, key) only, so they are
+    drawn in one vectorised op without a generator per key: the splitmix64 hash of every (key, pair of elements)
+    counter is split into two 24-bit uniforms and Box-Muller transformed into the pair
+    '''
+    size = int(np.prod(shape))
+    pairs = (size+1)//2
+    counter = torch.as_tensor(np.asarray(keys), dtype=torch.int64).view(-1, 1)*pairs + torch.arange(1, pairs+1)
+    ### the splitmix64 sequence of the hashed seed, 0x9E3779B97F4A7C15 apart, at each counter
+    z = _splitmix64(counter.mul_(-7046029254386353131).add_(_splitmix64(torch.tensor(seed, dtype=torch.int64))))
+    u1 = _shift_right(z, 40).float().add_(0.5).mul_(2**-24)
+    angle = z.bitwise_and_(0xFFFFFF).float().mul_(2*math.pi*2**-24)
+    radius = u1.log_().mul_(-2).sqrt_()
+    normal = torch.cat([radius*torch.cos(angle), radius*torch.sin(angle)], dim=1)[:, :size]
+    return normal.reshape((len(counter),) + tuple(shape))
+
+
+class WindowDataset(torch.utils.data.Dataset):
+    '''
+    Same items as CustomDataset, computed on the fly from the base series instead of windowed copies
+    of data, coords and timestamps: src and tgt are time windows of data starting at idx and idx+1,
+    coords are the grid indices of the cells and timestamps the times of the window steps.
+    parameters:
+        data: (T, nx1, nx2, nx3, C) float tensor, shared by all sets
+        times: (T,) time of each snapshot
+        window_range: (start, stop) window indices of this set, stop=None for up to the last window
+        noise_std: std of gaussian noise added to src and tgt, a function of seed and the window index only
+                   (see counter_normal) so it is the same every epoch; None for no noise (val/test)
+        use_coords: if False, items hold empty coords, for models that precompute the embedding of the grid
+                    (Transformer with fixed_coords)
+        origin: if data are residuals between consecutive snapshots, the (T+1, nx1, nx2, nx3) absolute snapshots
+                they were taken from, kept to reconstruct predicted residuals (see reconstruct_residual_rows)
+    '''
+    def __init__(self, data, times, window_size, window_range=(0,None), noise_std=None, seed=1008, use_coords=True, origin=None):
+        start, stop = window_range
+        self.start = start
+        self.windows = data.unfold(0,window_size,1).permute(0,5,1,2,3,4)[start:stop]
+        self.times = torch.as_tensor(np.asarray(times), dtype=torch.float32)
+        nx1, nx2, nx3 = data.shape[1:4]
+        coord = torch.stack(torch.meshgrid(torch.arange(nx1),torch.arange(nx2),torch.arange(nx3),indexing='ij'),dim=-1).float()
+        self.coords = coord.expand(window_size,nx1,nx2,nx3,3).contiguous()
+        self.item_coords = self.coords if use_coords else torch.empty(0)
+        self.window_size = window_size
+        self.noise_std = noise_std
+        self.seed = seed
+        self.origin = origin
+ 
+    def __len__(self):
+        return self.windows.shape[0]
+
+    def timestamp(self, idx):
+        t = self.times[self.start+idx:self.start+idx+self.window_size]
+        return t.view(-1,1,1,1,1).expand(self.coords.shape[:-1]+(1,)).contiguous()
+
+    def __getitem__(self,idx):
+        if idx+1 >= len(self): ### tgt is the next window
+            raise IndexError(f'window index {idx} out of range')
+        src_x, tgt_x = self.windows[idx], self.windows[idx+1]
+        if self.noise_std is not None:
+            ### the noise of src and tgt in one draw, keyed by the index of the window in the full series
+            noise = self.noise_std*counter_normal(self.seed, [self.start+idx], (2,)+tuple(src_x.shape))[0]
+            src_x, tgt_x = src_x + noise[0], tgt_x + noise[1]
+        return( (src_x, tgt_x),\
+                (self.item_coords, self.item_coords),\
+                (self.timestamp(idx), self.timestamp(idx+1)) )
+
+
+DEC_IN_METHODS = ('mean', 'repeat', 'zero', 'residual_repeat')
+
+def build_dec_in(context, method='zero', pred_blocks=1):
+    '''
+    Decoder input of an autoregressive step for the whole batch at once: the known context blocks followed
+    by pred_blocks padding blocks standing in for the blocks to predict
+    context: (B, K, *block_shape, C) known blocks, a block is one patch (patch_length, ) or one snapshot (nx1, nx2, nx3)
+    method:
+        'mean': every cell of the padding is the mean of that cell over the K context blocks and the C channels
+        'repeat': the last context block repeated
+        'zero': zeros
+        'residual_repeat': the K-1 residuals between consecutive context blocks, followed by the last residual repeated
+    returns: (B, K+pred_blocks, *block_shape, C), K-1+pred_blocks blocks for 'residual_repeat'
+    '''
+    if method not in DEC_IN_METHODS:
+        raise ValueError(f'Unknown decoder input method {method}, expect one of {DEC_IN_METHODS}')
+    if method == 'residual_repeat':
+        context = context[:,1:] - context[:,:-1]
+    if method == 'mean':
+        padding = context.mean(dim=(1,-1), keepdim=True)
+    elif method in ['repeat', 'residual_repeat']:
+        padding = context[:,-1:]
+    else:
+        padding = context.new_zeros((1,1)+tuple(context.shape[2:]))
+    padding = padding.expand((context.shape[0], pred_blocks)+tuple(context.shape[2:]))
+    return torch.cat([context, padding], dim=1)
+
+class RingContext():
+    '''
+    Fixed-size autoregressive context: the last num_blocks blocks of a rollout along dim, kept in one
+    preallocated tensor that new blocks overwrite in place instead of growing the history with torch.cat
+    init: first context, num_blocks = init.shape[dim]
+    '''
+    def __init__(self, init, dim=0):
+        self.dim = dim
+        self.buffer = init.clone()
+        self.num_blocks = init.shape[dim]
+        self.head = 0 ### position of the oldest block
+
+    def push(self, blocks):
+        '''Replace the oldest blocks.shape[dim] blocks by blocks'''
+        index = (self.head + torch.arange(blocks.shape[self.dim], device=self.buffer.device)) % self.num_blocks
+        self.buffer.index_copy_(self.dim, index, blocks.to(self.buffer.dtype))
+        self.head = (self.head + blocks.shape[self.dim]) % self.num_blocks
+
+    def get(self):
+        '''The context in time order, oldest block first'''
+        if self.head == 0:
+            return self.buffer
+        return torch.roll(self.buffer, -self.head, dims=self.dim)
+
+
+class RolloutWriter():
+    '''
+    Preallocated host buffers for the per-step outputs of a rollout whose length is known up front.
+    With cuda the buffers are pinned and device-to-host copies are asynchronous, result() waits for them
+    columns: {name: width} of each output, a width of 0 gives a 1-d buffer
+    '''
+    def __init__(self, num_rows, columns, dtype=torch.float32):
+        self.pin = torch.cuda.is_available()
+        self.buffers = {name: torch.empty((num_rows, width) if width else (num_rows,), dtype=dtype, pin_memory=self.pin) \
+                        for name, width in columns.items()}
+        self.num_rows = num_rows
+        self.pos = 0
+
+    def write(self, **outputs):
+        '''Append the rows of each named output, flattened to the width of its column'''
+        num_rows = None
+        for name, x in outputs.items():
+            buffer = self.buffers[name]
+            rows = x.detach().reshape((-1,) + tuple(buffer.shape[1:]))
+            num_rows = rows.shape[0] if num_rows is None else num_rows
+            if rows.shape[0] != num_rows or self.pos + num_rows > self.num_rows:
+                raise ValueError(f'{rows.shape[0]} rows of {name} do not fit the rollout buffers at row {self.pos} of {self.num_rows}')
+            buffer[self.pos:self.pos+num_rows].copy_(rows, non_blocking=self.pin)
+        self.pos += num_rows or 0
+
+    def result(self):
+        '''The written rows of every output'''
+        if self.pin:
+            torch.cuda.synchronize()
+        return {name: buffer[:self.pos] for name, buffer in self.buffers.items()}
+
+
+class RunningMoments():
+    '''
+    Mean and variance over the leading dim of a stream of chunks, e.g. the members of an ensemble computed a
+    chunk at a time. Each chunk is merged into the running moments in place (pairwise update of Chan et al.),
+    so the members are never stacked. The moments are kept in fp32 whatever the dtype of the chunks
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None ### sum of squared deviations from the mean
+
+    def update(self, x):
+        x = x.float()
+        count = x.shape[0]
+        mean = x.mean(0)
+        m2 = (x-mean).pow_(2).sum(0)
+        if self.mean is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count+count
+        delta = mean.sub_(self.mean)
+        self.mean.add_(delta, alpha=count/total)
+        self.m2.add_(m2).add_(delta.pow_(2), alpha=self.count*count/total)
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2/self.count
+
+
+def shift_chunk_size(model, inputs, shift_sizes, temporal_insert_layer=2, memory_fraction=0.8):
+    '''
+    Number of shifted copies per Transformer.forward_shifts call that fit in memory_fraction of the free device
+    memory, from the peak memory of a one-shift forward. All of them on cpu, which has no peak memory statistics to
+    size them from; pass an explicit chunk_size to shift_ensemble to bound the host memory instead
+    inputs: (src, tgt, src_coord, tgt_coord, src_ts, tgt_ts) of the model
+    '''
+    device = inputs[0].device
+    if device.type != 'cuda':
+        return len(shift_sizes)
+    model = getattr(model, 'module', model)
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    allocated = torch.cuda.memory_allocated(device)
+    with torch.no_grad():
+        model.forward_shifts(*inputs, shift_sizes[:1], temporal_insert_layer)
+    per_shift = max(torch.cuda.max_memory_allocated(device)-allocated, 1)
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    return int(min(len(shift_sizes), max(1, memory_fraction*free_memory//per_shift)))
+
+def shift_ensemble(model, inputs, shift_sizes, chunk_size=None, temporal_insert_layer=2):
+    '''
+    Moments of the model outputs over the copies of inputs rolled by each of shift_sizes, chunk_size shifts
+    per batched forward (see Transformer.forward_shifts), None for all at once
+    inputs: (src, tgt, src_coord, tgt_coord, src_ts, tgt_ts) of the model
+    returns: RunningMoments of the (N, D, H, W, C) outputs
+    '''
+    model = getattr(model, 'module', model) ### DataParallel would split the shifted copies along the window
+    chunk_size = chunk_size or len(shift_sizes)
+    ensemble = RunningMoments()
+    for start in range(0, len(shift_sizes), chunk_size):
+        ensemble.update(model.forward_shifts(*inputs, shift_sizes[start:start+chunk_size], temporal_insert_layer))
+    return ensemble
+
+
+def rng_states():
+    '''RNG states of python, numpy, torch and the cuda devices, restored by set_rng_states'''
+    ### the numpy keys as a tensor, so checkpoints holding the states load with torch.load(weights_only=True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    states = {'python': random.getstate(), 'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian), \
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def save_checkpoint(state, path):
+    '''torch.save to a temporary file renamed over path, so path is never left holding a partly written file'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_runs(seeds, res_size = '16', var_names = ['rho','vel1','vel2','vel3','press'], num_workers = 8, \
+              source_res_size = None, coarsen_method = 'mean', scaler = None):
+    '''
+    Snapshots of the runs of several seeds (see get_data_path), e.g. for rollout_trajectories
+    scaler: fitted scaler of the training run (get_data_loaders), applied to every run; None to keep them unscaled
+    return:
+        list of (T, nx1, nx2, nx3, C) float32 tensors and list of their (T,) times, one of each per seed
+    '''
+    runs, times = [], []
+    for seed in seeds:
+        data_path, coarse_grid_size = get_data_path(res_size, seed, source_res_size)
+        snapshots = load_snapshots(data_path, var_names, num_workers, coarse_grid_size, coarsen_method)
+        data = snapshots['data']
+        if scaler is not None:
+            data = scaler.transform(data.reshape(-1, data.shape[-1])).reshape(data.shape)
+        runs.append(torch.as_tensor(np.asarray(data), dtype=torch.float32))
+        times.append(np.asarray(snapshots['time']))
+    return runs, times
+
+def rollout_trajectories(model, runs, times, starts, window_size, num_steps, pred_size = 1, batch_size = None, \
+                         dec_method = 'zero', residual = True, shift_size = (0,0,0,0), temporal_insert_layer = 2, return_fields = False):
+    '''
+    Autoregressive rollout of several independent trajectories stepped together, one batched forward
+    (Transformer.forward_batch or Unet.forward_batch) per step for all of them, each with its own context and metrics
+        runs, times: list of (T, nx1, nx2, nx3, C) series and list of their (T,) times, see load_runs
+        starts: (run index, snapshot index) of each trajectory, its first window_size snapshots are the ground
+                truth context and the num_steps x pred_size following ones are predicted
+        batch_size: trajectories per forward, None for all at once
+        residual: if True the model predicts the change of the window and the context is added back, as in predict_model
+        the inputs are cast to the dtype of the model precision (see Transformer), the context and metrics stay in fp32
+    return:
+        {'mse', 'mae': (num_trajectories, num_steps, C) error of each trajectory, step and variable,
+         'prediction': (num_trajectories, num_steps x pred_size, nx1, nx2, nx3, C) predicted snapshots if return_fields}
+    '''
+    device = next(model.parameters()).device
+    model = getattr(model, 'module', model)
+    model.eval()
+    precision = getattr(model, 'precision', 'fp32')
+    dtype = precision_dtype(precision)
+    horizon = window_size + num_steps*pred_size
+    for run, start in starts:
+        if start < 0 or start + horizon > runs[run].shape[0]:
+            raise ValueError(f'trajectory from snapshot {start} of run {run} needs {horizon} snapshots, the run has {runs[run].shape[0]}')
+    grid, num_vars = tuple(runs[0].shape[1:4]), runs[0].shape[-1]
+    coord = torch.stack(torch.meshgrid(*[torch.arange(n) for n in grid], indexing='ij'), dim=-1).float().to(device)
+    ### metrics stay on the device until the end, so the steps never wait for the host
+    metrics = {name: torch.empty((len(starts), num_steps, num_vars), device=device) for name in ('mse', 'mae')}
+    fields = torch.empty((len(starts), num_steps*pred_size)+grid+(num_vars,), pin_memory=device.type=='cuda') if return_fields else None
+    batch_size = batch_size or len(starts)
+    with torch.no_grad():
+        for first in range(0, len(starts), batch_size):
+            batch = starts[first:first+batch_size]
+            B = len(batch)
+            truth = torch.stack([runs[run][start:start+horizon] for run, start in batch])
+            ts = torch.stack([torch.as_tensor(np.asarray(times[run][start:start+horizon]), dtype=torch.float32) for run, start in batch])
+            ts = ts.view(ts.shape+(1,1,1,1)).expand(ts.shape+grid+(1,)).to(device)
+            coords = coord.expand((B, window_size)+coord.shape)
+            ### the last window_size snapshots of every trajectory
+            context = RingContext(truth[:,:window_size].to(device), dim=1)
+            for step in range(num_steps):
+                t = step*pred_size
+                enc_in = context.get()
+                dec_in = build_dec_in(enc_in[:,pred_size:], dec_method, pred_size).float()
+                with autocast(precision, device):
+                    output = model.forward_batch(enc_in.to(dtype), dec_in.to(dtype), coords, coords, ts[:,t:t+window_size], \
+                                                 ts[:,t+pred_size:t+pred_size+window_size], shift_size, temporal_insert_layer)
+                output = output.float()
+                if residual:
+                    output = output + enc_in
+                pred = output[:,-pred_size:]
+                context.push(pred)
+                error = pred - truth[:,window_size+t:window_size+t+pred_size].to(device, non_blocking=True)
+                metrics['mse'][first:first+B, step] = error.pow(2).mean(dim=(1,2,3,4))
+                metrics['mae'][first:first+B, step] = error.abs().mean(dim=(1,2,3,4))
+                if fields is not None:
+                    fields[first:first+B, t:t+pred_size].copy_(pred, non_blocking=True)
+    result = {name: metric.cpu() for name, metric in metrics.items()}
+    if fields is not None:
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        result['prediction'] = fields
+    return result
+
+
+def sort_grid_rows(a):
+    '''
+    Rows of a (N, 4+k) table of (time, x1, x2, x3, values...) in (time, x1, x2, x3) order, the order of
+    chained stable argsorts on x3, x2, x1 and time. Rows of a complete grid are scattered straight to their
+    linear index in O(N); duplicated or missing cells, or non-integer coordinates, fall back to np.lexsort
+    '''
+    a = np.asarray(a)
+    ### rank of each row's time among the distinct times, by hashing instead of sorting all rows
+    time_codes, times = pd.factorize(a[:,0])
+    time_rank = np.empty(len(times), dtype=np.int64)
+    time_rank[np.argsort(times, kind='stable')] = np.arange(len(times))
+    coords = a[:,1:4].astype(np.int64)
+    if len(a) and np.array_equal(coords, a[:,1:4]) and coords.min() >= 0:
+        shape = (len(times),) + tuple(coords.max(axis=0)+1)
+        if np.prod(shape) == len(a):
+            linear = np.ravel_multi_index((time_rank[time_codes],) + tuple(coords.T), shape)
+            order = np.full(len(a), -1, dtype=np.int64)
+            order[linear] = np.arange(len(a))
+            if (order >= 0).all(): ### every cell exactly once
+                return a[order]
+    return a[np.lexsort((a[:,3], a[:,2], a[:,1], a[:,0]))]
+
+def reconstruct_residual_rows(a, origin, times):
+    '''
+    Absolute values of a (N, 6) table of (time, x1, x2, x3, prediction, truth) residual rows, residual[t] = x[t]-x[t-1].
+    Rows are averaged per (time, cell) onto a (T, nx1*nx2*nx3) grid, which is accumulated over time from the
+    last observed block before the first predicted time, so nothing is read back from disk
+        origin: (len(times)+1, nx1, nx2, nx3) absolute blocks of the series, residual block t goes from origin[t] to origin[t+1]
+        times: (len(times),) time of each residual block of the series
+    returns: (T*nx1*nx2*nx3, 6) table in (time, x1, x2, x3) order, truth is reconstructed the same way as a check
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    origin = np.asarray(origin, dtype=np.float64)
+    grid = origin.shape[1:]
+    num_cells = int(np.prod(grid))
+    pred_times, time_index = np.unique(a[:,0], return_inverse=True)
+    ### position of the first predicted time in the series, the predicted blocks have to follow it to be accumulated
+    times = np.asarray(times, dtype=np.float64)
+    start = np.searchsorted(times, pred_times[0])
+    if not np.array_equal(times[start:start+len(pred_times)], pred_times):
+        raise ValueError('residual rows have to cover consecutive blocks of the series')
+    cell = np.ravel_multi_index(tuple(a[:,1:4].astype(np.int64).T), grid)
+    linear = time_index.reshape(-1)*num_cells + cell
+    counts = np.bincount(linear, minlength=len(pred_times)*num_cells).reshape(len(pred_times), num_cells)
+    if (counts == 0).any():
+        raise ValueError('residual rows have to cover every cell of every predicted block')
+    seed = origin[start].reshape(-1)
+    columns = [seed + np.cumsum(np.bincount(linear, weights=a[:,j], minlength=counts.size).reshape(counts.shape)/counts, axis=0) \
+               for j in (4, 5)]
+    coord = np.stack(np.unravel_index(np.arange(num_cells), grid), axis=1)
+    return np.hstack([np.repeat(pred_times, num_cells).reshape(-1,1), np.tile(coord, (len(pred_times),1))] + \
+                     [c.reshape(-1,1) for c in columns])
+
+def prepare_series(predict_res=False, scale=False, noise_std=0.01, scaler_type='standard', seed = 1, res_size='16', num_load_workers=8, \
+                   source_res_size=None, coarsen_method='mean', snapshots=None):
+    '''
+    The (T x nx1 x nx2 x nx3, C) series of get_data_loaders, scaled, before it is split into windows. It only depends on
+    these arguments, so a tuning driver can prepare it once per setting and share it with the trials (prepared of
+    get_data_loaders) instead of each trial fitting its own scaler
+    returns: (series, scaler, data, times, meshed_blocks, origin), series a float32 numpy array
+    '''
+    var_names = ['rho','vel1','vel2','vel3','press']
+    if snapshots is None:
+        data_path, coarse_grid_size = get_data_path(res_size, seed, source_res_size)
+        snapshots = load_snapshots(data_path, var_names if not predict_res else ['rho'], num_load_workers, coarse_grid_size, coarsen_method)
     if predict_res:
-        data_original, data, meshed_blocks, coords, timestamps = get_rho(data_path, predict_res=predict_res, noise_std =noise_std, var_name='rho')
+        data_original, data, meshed_blocks, coords, timestamps = get_rho(None, predict_res=predict_res, noise_std =noise_std, var_name='rho', snapshots=snapshots)
+        origin = torch.from_numpy(np.array(data_original, dtype=np.float32)).view((-1,)+tuple(meshed_blocks))
     else:
-        density, meshed_blocks, coords, timestamps = get_rho(data_path, predict_res=predict_res, noise_std=noise_std, var_name='rho') 
-        vel1, _, _, _ = get_rho(data_path, predict_res=predict_res, noise_std=noise_std, var_name='vel1') 
-        vel2, _, _, _ = get_rho(data_path, predict_res=predict_res, noise_std=noise_std, var_name='vel2') 
-        vel3, _, _, _ = get_rho(data_path, predict_res=predict_res, noise_std=noise_std, var_name='vel3') 
-        press, _, _, _ = get_rho(data_path, predict_res=predict_res, noise_std=noise_std, var_name='press') 
-        data = np.stack((density, vel1, vel2, vel3, press), axis=-1)
+        origin = None
+        ### (T x nx1 x nx2 x nx3, C) view of the shared snapshots; coords are only needed for predict_res
+        snapshot_data = select_vars(snapshots, var_names)
+        meshed_blocks = snapshot_data.shape[1:4]
+        data = snapshot_data.reshape(-1, snapshot_data.shape[-1])
         print(f'data shape: {data.shape}')
 
 
@@ -262,79 +706,62 @@ def get_data_loaders(train_proportion = 0.5, test_proportion = 0.25, val_proport
     ###FOR ARFIMA TEST
     #data = arfima([0.5,0.4],0.3,[0.2,0.1],10000,warmup=2^10)
 
-    if use_coords:
-        print('-'*20,'split for coords')
-        train_coords,val_coords,test_coords, _ = train_test_val_split(\
-            coords, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
-            , val_proportion = val_proportion, test_proportion = test_proportion\
-            , pred_size = pred_size, feature_size = 3,scale = False, window_size = window_size, patch_size = patch_size, option = option)
-        print(f'train_coords: {train_coords.shape}, val_coords: {val_coords.shape}, test_coords: {test_coords.shape}')
-
-
-    if use_time:
-        print('-'*20,'split for timestamp')
-        train_timestamps,val_timestamps,test_timestamps, _ = train_test_val_split(\
-            timestamps, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
-            , val_proportion = val_proportion, test_proportion = test_proportion\
-            , pred_size = pred_size, feature_size = 1 ,scale = False, window_size = window_size, patch_size = patch_size, option = option)
-        print(f'train_timestamps: {train_timestamps.shape}, val_timestamps: {val_timestamps.shape}, test_timestamps: {test_timestamps.shape}')
-
-    print('-'*20,'split for data')
-    train_data,val_data,test_data, scaler = train_test_val_split(\
-        data, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
-        , val_proportion = val_proportion, test_proportion = test_proportion\
-        , pred_size = pred_size, feature_size = 5,scale = scale, window_size = window_size, patch_size = patch_size, option = option, scaler_type = scaler_type)
-    print(f'train_data: {train_data.shape}, val_data: {val_data.shape}, test_data: {test_data.shape}')
-
-#----------------------------------------------------------------
-### Save the original data table for reconstructing from residual predictions. May need to be optimized?
-    if predict_res: 
-        a = np.hstack([timestamps.reshape(-1,1), coords, data_original.reshape(-1,1)])
-        a = a[np.argsort(a[:, 3])]
-        a = a[np.argsort(a[:, 2], kind='stable')]
-        a = a[np.argsort(a[:, 1], kind='stable')]
-        a = a[np.argsort(a[:, 0], kind='stable')]
-        if scale==True:
-            data_origin_dict = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'truth_original':scaler.inverse_transform(a[:,4])}
-        elif scale==False:
-            data_origin_dict = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'truth_original':a[:,4]}
-        data_origin_df = pd.DataFrame.from_dict(data_origin_dict)
-        data_origin_df.to_csv('/scratch/yd1008/nyu-capstone/notebooks/turbulence_16_yd/tune_results/' + '/data_original.csv')
-        #print(data_origin_df,flush=True)
- #----------------------------------------------------------------   
+    nx1, nx2, nx3 = meshed_blocks
+    times = timestamps[::nx1*nx2*nx3] if predict_res else snapshots['time']
+    if scale == True:
+        scaled, scaler = fit_scaler(data.reshape(len(times)*nx1*nx2*nx3, -1), scaler_type)
+    else:
+        scaled, scaler = data, None
+    ### zero-copy if the (possibly shared, read-only) snapshots are used unscaled
+    series = np.asarray(scaled, dtype=np.float32)
+    return series, scaler, data, times, tuple(meshed_blocks), origin
 
+def get_data_loaders(train_proportion = 0.5, test_proportion = 0.25, val_proportion = 0.25, \
+                        pred_size =1, batch_size = 16, num_workers = 1, pin_memory = True, \
+                        use_coords = True, use_time = True, test_mode = False, scale = False, \
+                        window_size = 10, patch_size=(1,1,16), grid_size=(16,16,16), option='patch',\
+                        predict_res=False, noise_std=0.01, scaler_type='standard', seed = 1, res_size='16', num_load_workers=8, \
+                        source_res_size=None, coarsen_method='mean', snapshots=None, prepared=None): 
+    '''
+    source_res_size: resolution of the run to read; if given, its snapshots are coarsened to res_size
+                     while loading instead of reading a separately preprocessed res_size run
+    snapshots: preloaded output of load_snapshots, shared by all trials/workers; if given, no file is read
+    prepared: output of prepare_series for the same predict_res, scale and scaler_type; if given, neither
+              snapshots nor files are read and no scaler is fit
+    use_coords: False to leave the coordinates out of the items, see WindowDataset
+    predict_res: if True, the sets hold the rho residuals between consecutive snapshots and the unscaled
+                 absolute rho stays in memory as WindowDataset origin
+    '''
+    np.random.seed(1008)
+    
+    if prepared is None:
+        prepared = prepare_series(predict_res, scale, noise_std, scaler_type, seed, res_size, num_load_workers, \
+                                  source_res_size, coarsen_method, snapshots)
+    scaled, scaler, data, times, meshed_blocks, origin = prepared
+
+    ### Only the (T, nx1, nx2, nx3, C) series is kept; windows, coords and timestamps are built per item
+    nx1, nx2, nx3 = meshed_blocks
+    with warnings.catch_warnings():
+        ### the shared snapshots are read-only; the series is only ever read, so it may alias them
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+        series = torch.as_tensor(scaled).view(len(times), nx1, nx2, nx3, -1)
+    if num_workers > 0 and (scale == True or data.dtype != np.float32):
+        series.share_memory_() ### DataLoader workers map this private copy instead of receiving their own
+    train_range, val_range, test_range = split_windows(series.shape[0]-window_size+1, train_proportion, val_proportion)
+    print(f'series: {tuple(series.shape)}, train windows: {train_range}, val windows: {val_range}, test windows: {test_range}')
+
+
+    ### the unscaled series: the shared tensor itself if it holds it, else a float32 copy of data
+    unscaled = series.view(-1, series.shape[-1]) if scaled is data else torch.tensor(data, dtype=torch.float32)
     if test_mode:
-        train_val_data = torch.cat((train_data,val_data),0)
-        train_val_coords = torch.cat((train_coords,val_coords),0)
-        train_val_timestamps = torch.cat((train_timestamps,val_timestamps),0)
-
-        ### Get the first block in test_original to perform rollout that gives back the original data based on predicted residuals
-
-        dataset_train_val, dataset_test = CustomDataset(train_val_data,train_val_coords,train_val_timestamps,data,grid_size,window_size)\
-                                    , CustomDataset(test_data,test_coords,test_timestamps,data,grid_size,window_size)
-        train_val_loader = torch.utils.data.DataLoader(dataset_train_val, batch_size=batch_size, \
-                                        drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                        persistent_workers=True, prefetch_factor = 16)
-        test_loader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size, \
-                                        drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                        persistent_workers=True, prefetch_factor = 16) 
-        return dataset_train_val, dataset_test, scaler, torch.from_numpy(data).float()
+        dataset_train_val, dataset_test = WindowDataset(series, times, window_size, (train_range[0], val_range[1]), use_coords=use_coords, origin=origin)\
+                                    , WindowDataset(series, times, window_size, test_range, use_coords=use_coords, origin=origin)
+        return dataset_train_val, dataset_test, scaler, unscaled
     if not test_mode:                           
-        dataset_train, dataset_test, dataset_val = CustomDataset(train_data,train_coords,train_timestamps,data,grid_size,window_size)\
-                                                ,CustomDataset(test_data,test_coords,test_timestamps,data,grid_size,window_size)\
-                                                , CustomDataset(val_data,val_coords,val_timestamps,data,grid_size,window_size)
-
-        train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-        test_loader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-        val_loader = torch.utils.data.DataLoader(dataset_val, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-       
-        return dataset_train,dataset_val, dataset_test, scaler, torch.from_numpy(data).float()
+        dataset_train, dataset_test, dataset_val = WindowDataset(series, times, window_size, train_range, use_coords=use_coords, origin=origin)\
+                                                ,WindowDataset(series, times, window_size, test_range, use_coords=use_coords, origin=origin)\
+                                                , WindowDataset(series, times, window_size, val_range, use_coords=use_coords, origin=origin)
+        return dataset_train,dataset_val, dataset_test, scaler, unscaled
 
 # img_dir = 'figs' ###dir to save images to
 # pred_df = pd.read_csv('transformer_prediction_coords.csv',index_col=0) ###dir of csv file, or pandas dataframe
@@ -0,0 +1,65 @@
+#!/bin/bash python
+import os
+import time
+import tempfile
+import numpy as np
+import h5py
+from athena_read import athdf
+
+def write_synthetic_athdf(filename, root_grid_size=(128,128,128), block_size=(16,16,16), \
+                          variable_names=('rho','press','vel1','vel2','vel3'), seed=0):
+    '''
+    Write a uniform-level, multi-MeshBlock .athdf file with random cell data
+    parameters:
+        root_grid_size: (nx1, nx2, nx3) number of cells of the root grid
+        block_size: (bx1, bx2, bx3) number of cells of each MeshBlock
+        variable_names: names of the variables stored in the single 'prim' dataset
+    '''
+    rng = np.random.default_rng(seed)
+    nblocks_dim = [n//b for n,b in zip(root_grid_size, block_size)]
+    num_blocks = int(np.prod(nblocks_dim))
+    ### Athena++ orders MeshBlocks with x1 varying fastest
+    locations = np.array([(i,j,k) for k in range(nblocks_dim[2]) for j in range(nblocks_dim[1]) for i in range(nblocks_dim[0])], dtype=np.int64)
+    with h5py.File(filename, 'w') as f:
+        f.attrs['Coordinates'] = np.bytes_('cartesian')
+        f.attrs['DatasetNames'] = np.array([b'prim'])
+        f.attrs['MaxLevel'] = np.int32(0)
+        f.attrs['MeshBlockSize'] = np.array(block_size, dtype=np.int32)
+        f.attrs['NumCycles'] = np.int32(0)
+        f.attrs['NumMeshBlocks'] = np.int32(num_blocks)
+        f.attrs['NumVariables'] = np.array([len(variable_names)], dtype=np.int32)
+        f.attrs['RootGridSize'] = np.array(root_grid_size, dtype=np.int32)
+        for d in range(3):
+            f.attrs[f'RootGridX{d+1}'] = np.array([0.0, 1.0, 1.0], dtype=np.float32)
+        f.attrs['Time'] = np.float32(0.0)
+        f.attrs['VariableNames'] = np.array([v.encode('ascii') for v in variable_names])
+        f['Levels'] = np.zeros(num_blocks, dtype=np.int32)
+        f['LogicalLocations'] = locations
+        for d in range(3):
+            faces = np.linspace(0.0, 1.0, root_grid_size[d]+1, dtype=np.float32)
+            block_faces = np.stack([faces[l*block_size[d]:(l+1)*block_size[d]+1] for l in locations[:,d]])
+            f[f'x{d+1}f'] = block_faces
+            f[f'x{d+1}v'] = 0.5*(block_faces[:,1:]+block_faces[:,:-1])
+        f['prim'] = rng.standard_normal((len(variable_names), num_blocks, block_size[2], block_size[1], block_size[0])).astype(np.float32)
+
+def benchmark(root_grid_size, block_size, repeats=3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'synthetic.out1.00000.athdf')
+        write_synthetic_athdf(filename, root_grid_size, block_size)
+        timings = {}
+        results = {}
+        for vectorized in [False, True]:
+            start_time = time.time()
+            for _ in range(repeats):
+                results[vectorized] = athdf(filename, vectorized=vectorized)
+            timings[vectorized] = (time.time()-start_time)/repeats
+        for q in ['rho','press','vel1','vel2','vel3']:
+            assert np.array_equal(results[False][q], results[True][q]), f'Mismatch in {q}'
+    num_blocks = int(np.prod([n//b for n,b in zip(root_grid_size, block_size)]))
+    print(f'grid {root_grid_size}, block {block_size} ({num_blocks} blocks): loop {timings[False]:.4f} s, '\
+          f'vectorized {timings[True]:.4f} s, speedup {timings[False]/timings[True]:.1f}x', flush=True)
+
+if __name__ == "__main__":
+    for root_grid_size, block_size in [((32,32,32),(16,16,16)), ((64,64,64),(16,16,16)), \
+                                        ((128,128,128),(16,16,16)), ((128,128,128),(8,8,8))]:
+        benchmark(root_grid_size, block_size)
@@ -0,0 +1,48 @@
+#!/bin/bash python
+import time
+import numpy as np
+import torch
+from utils import *
+
+def per_sample_loader(data, times, meshed_blocks, batch_size, window_size, patch_size, num_workers):
+    '''
+    The per-sample path: materialized (num_windows, 2, L[, 3]) windows of data, coords and timestamps,
+    collated one CustomDataset item at a time by the DataLoader workers
+    '''
+    block = int(np.prod(meshed_blocks))
+    coord = np.transpose(np.array(np.meshgrid(*[np.arange(n) for n in meshed_blocks])), axes=[2,1,3,0]).reshape(-1,3)
+    coords = np.tile(coord, (len(times),1))
+    timestamps = np.repeat(times, block)
+    def flat_windows(x):
+        windows, patches_per_block = to_windowed(x, meshed_blocks, 1, window_size, patch_size, 'patch')
+        return windows.reshape((windows.shape[0]*patches_per_block, 2, -1) + tuple(windows.shape[9:])).contiguous()
+    dataset = CustomDataset(flat_windows(data), flat_windows(coords), flat_windows(timestamps))
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=16) if num_workers > 0 else {}
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, drop_last=False, \
+                                       num_workers=num_workers, pin_memory=False, **worker_kwargs)
+
+def throughput(loader, num_batches):
+    iterator = iter(loader)
+    next(iterator) ### start the workers
+    num_samples = 0
+    start_time = time.time()
+    for _, ((src, _), _, _) in zip(range(num_batches), iterator):
+        num_samples += src.shape[0]
+    return num_samples/(time.time()-start_time)
+
+def benchmark(grid_size=16, num_steps=100, window_size=10, patch_size=(4,4,4), batch_size=16, num_batches=2000):
+    meshed_blocks = (grid_size,)*3
+    data = np.random.default_rng(0).standard_normal(num_steps*grid_size**3).astype(np.float32)
+    times = np.arange(num_steps)*0.01
+    window_dataset = WindowDataset(data, times, meshed_blocks, 1, window_size, patch_size)
+    for num_workers in [0, 2]:
+        loader = per_sample_loader(data, times, meshed_blocks, batch_size, window_size, patch_size, num_workers)
+        print(f'per-sample CustomDataset, {num_workers} workers: {throughput(loader, num_batches):.0f} samples/s', flush=True)
+    for num_workers in [0, 2]:
+        loader = get_loader(window_dataset, batch_size, num_workers, pin_memory=False)
+        print(f'batched WindowDataset, {num_workers} workers: {throughput(loader, num_batches):.0f} samples/s', flush=True)
+
+if __name__ == "__main__":
+    for batch_size in [16, 128]:
+        print(f'batch size {batch_size}')
+        benchmark(batch_size=batch_size)
@@ -0,0 +1,46 @@
+#!/bin/bash python
+import time
+import numpy as np
+import torch
+from utils import RingContext, RolloutWriter
+
+def step(enc_in):
+    '''Stand-in for the model: one cheap op per block so the bookkeeping dominates'''
+    return enc_in[-1:]*0.5 + enc_in.mean(0, keepdim=True)
+
+def cat_rollout(src, horizon):
+    '''The torch.cat rollout of predict_model: history and outputs grow every step'''
+    N = src.shape[0]
+    test_rollout, test_result = src, torch.Tensor(0)
+    for _ in range(horizon):
+        output = step(test_rollout[-N:])
+        test_rollout = torch.cat([test_rollout, output], dim=0)
+        test_result = torch.cat((test_result, output[...,0].flatten().detach().cpu()), 0)
+    return test_result
+
+def ring_rollout(src, horizon):
+    '''RingContext of the last N blocks and preallocated RolloutWriter outputs'''
+    context = RingContext(src, dim=0)
+    writer = RolloutWriter(horizon*int(np.prod(src.shape[1:4])), {'prediction': 0})
+    for _ in range(horizon):
+        output = step(context.get())
+        context.push(output)
+        writer.write(prediction=output[...,0])
+    return writer.result()['prediction']
+
+def benchmark(horizons=(250, 500, 1000), window_size=5, grid_size=16, num_channels=5):
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    src = torch.randn((window_size,)+(grid_size,)*3+(num_channels,), device=device)
+    for horizon in horizons:
+        timings = {}
+        results = {}
+        for name, rollout in [('cat', cat_rollout), ('ring', ring_rollout)]:
+            start_time = time.time()
+            results[name] = rollout(src, horizon)
+            timings[name] = time.time()-start_time
+        assert torch.allclose(results['cat'], results['ring']), 'Mismatch between rollouts'
+        print(f'horizon {horizon}: torch.cat {timings["cat"]:.3f} s, ring buffer {timings["ring"]:.3f} s, '\
+              f'speedup {timings["cat"]/timings["ring"]:.1f}x', flush=True)
+
+if __name__ == "__main__":
+    benchmark()
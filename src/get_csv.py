@@ -1,5 +1,6 @@
 #!/bin/bash python
 import os
+import json
 import numpy as np
 import pandas as pd
 import math
@@ -11,47 +12,46 @@ from athena_read import *
 # dict_keys(['Coordinates', 'DatasetNames', 'MaxLevel', 'MeshBlockSize', 'NumCycles', \
 # 'NumMeshBlocks', 'NumVariables', 'RootGridSize', 'RootGridX1', 'RootGridX2', 'RootGridX3', \
 # 'Time', 'VariableNames', 'x1f', 'x1v', 'x2f', 'x2v', 'x3f', 'x3v', 'rho', 'press', 'vel1', 'vel2', 'vel3'])
-def get_csv(data_path, csv_dir, target_var = 'rho', downsample = True, grid_size = 16):
+def save_cache(cache_dir, name, data, times, var_names):
     """
-    grid_size: the size after downsampling if downsample=True, else the original size
+    Write a (T, nx1, nx2, nx3, C) tensor as '<name>.npy' plus a '<name>.json' sidecar holding
+    the snapshot times, variable names and the per-variable mean/std used by StandardScaler.
+    Coordinates and timestamps of every cell are implied by the grid shape, so they are not stored.
     """
-    lst = sorted(os.listdir(data_path))[4:-1]
-    data = []
-    coords = []
-    timestamps = []
-    for name in lst:
-        path = data_path+'/'+name
-        d = athdf(path)
-        coord = np.transpose(np.array(np.meshgrid(np.arange(grid_size),np.arange(grid_size),np.arange(grid_size))), axes=[2,1,3,0]).reshape(-1,3)
-        data.append(d[target_var])
-        timestamp_repeated = [d['Time']]*grid_size**3
-        timestamps.extend(timestamp_repeated) 
-        coords.extend(coord)
-        #print(f"Name: {name}, keys: {d.keys()}", flush=True)#x1v: {d['x1v']}, x2v: {d['x2v']}, x3v:{d['x3v']}
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    np.save(cache_dir + f'/{name}.npy', data)
+    flat = data.reshape(-1, data.shape[-1]).astype(np.float64)
+    metadata = {'shape': list(data.shape), 'time': [float(t) for t in times], 'var_names': list(var_names), \
+                'mean': flat.mean(axis=0).tolist(), 'std': flat.std(axis=0).tolist()}
+    with open(cache_dir + f'/{name}.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
 
-    data = np.array(data)
-    if downsample:
-        downsampled = 'downsampled'
-        data_downsampled = np.zeros([data.shape[0], grid_size, grid_size, grid_size])
-        coef = data.shape[1] // grid_size
-        for time in range(data.shape[0]):
-            for x1 in range(grid_size):
-                for x2 in range(grid_size):
-                    for x3 in range(grid_size):
-                        data_downsampled[time, x1, x2, x3] = data[time, x1:x1+coef, x2:x2+coef, x3:x3+coef].mean()
-        data_original = data_downsampled.flatten()
-    else:
-        downsampled = 'original'
-        data_original = data.flatten()
-    timestamps = np.array(timestamps)
-    coords = np.array(coords)
 
+def get_csv(data_path, csv_dir, target_var = 'rho', downsample = True, grid_size = 16, num_workers = 8, write_csv = False):
+    """
+    Save the (T, nx1, nx2, nx3, 1) tensor of target_var to '{target_var}_{downsampled}_{grid_size}.npy'
+    with its metadata sidecar, see save_cache
+    grid_size: the size after downsampling if downsample=True, else the original size
+    num_workers: number of processes reading the snapshot files
+    write_csv: if True, also export the (time, x1, x2, x3, target) table as csv
+    """
+    lst = sorted(os.listdir(data_path))[4:-1]
+    ### Each snapshot is block-averaged to grid_size as soon as it is read
+    series = athdf_series([data_path+'/'+name for name in lst], [target_var], num_workers=num_workers, \
+                          grid_size=grid_size if downsample else None, coarsen_method='mean')
+    data = series['data'][...,0]
+    downsampled = 'downsampled' if downsample else 'original'
+    save_cache(csv_dir, f'{target_var}_{downsampled}_{grid_size}', data[...,None], series['Time'], [target_var])
+    if not write_csv:
+        return
+    ### rows are built directly in (time, x1, x2, x3) order: snapshots sorted by time, each flattened x3-fastest like coord
+    time_order = np.argsort(series['Time'], kind='stable')
+    coord = np.transpose(np.array(np.meshgrid(np.arange(grid_size),np.arange(grid_size),np.arange(grid_size))), axes=[2,1,3,0]).reshape(-1,3)
+    timestamps = np.repeat(series['Time'][time_order], grid_size**3)
+    coords = np.tile(coord, (len(lst),1))
+    data_original = data[time_order].flatten()
 
     a = np.hstack([timestamps.reshape(-1,1), coords, data_original.reshape(-1,1)])
-    a = a[np.argsort(a[:, 3])]
-    a = a[np.argsort(a[:, 2], kind='stable')]
-    a = a[np.argsort(a[:, 1], kind='stable')]
-    a = a[np.argsort(a[:, 0], kind='stable')]
     
     original_dict = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'target': a[:,4]}
     df = pd.DataFrame.from_dict(original_dict)
@@ -63,4 +63,4 @@ if __name__ == "__main__":
     csv_dir = '/scratch/zh2095/nyu-capstone/data'
     start_time = time.time()
     get_csv(data_path=data_path, csv_dir=csv_dir, target_var='rho', downsample=True, grid_size=16)
-    print(f'time for generatig csv: {time.time()-start_time} s', flush=True)
\ No newline at end of file
+    print(f'time for generating cache: {time.time()-start_time} s', flush=True)
\ No newline at end of file
@@ -0,0 +1,45 @@
+#!/bin/bash python
+import os
+import sys
+import pytest
+import torch
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.modules.pop('transformer', None) ### the notebooks have their own transformer.py
+from transformer import Transformer
+
+def rollout_windows(blocks, coords, times, window_size):
+    '''src and tgt windows of a rollout over blocks (B, T, patch_length, 1), the tgt padded with the mean of its blocks'''
+    B, T, L, _ = blocks.shape
+    for t in range(T-window_size):
+        src = blocks[:,t:t+window_size]
+        tgt = torch.cat([blocks[:,t+1:t+window_size], blocks[:,t+1:t+window_size].mean(1, keepdim=True)], dim=1)
+        ts = times[:,t:t+window_size].view(B, window_size, 1, 1).expand(B, window_size, L, 1).reshape(B, -1, 1)
+        tgt_ts = times[:,t+1:t+window_size+1].view(B, window_size, 1, 1).expand(B, window_size, L, 1).reshape(B, -1, 1)
+        yield src.reshape(B, -1, 1), tgt.reshape(B, -1, 1), coords, coords, ts, tgt_ts
+
+def make_model(**kwargs):
+    torch.manual_seed(0)
+    config = dict(feature_size=12, num_enc_layers=1, num_dec_layers=1, d_ff=16, dropout=0., num_head=2, pe_type='3d_temporal', \
+                  grid_size=4, mask_type='patch', patch_size=(2,2,2), window_size=4)
+    config.update(kwargs)
+    return Transformer(**config).eval()
+
+def test_forward_incremental_matches_forward():
+    model = make_model(decoder_only=True)
+    B, T, L, W = 3, 10, 8, model.window_size
+    blocks = torch.randn(B, T, L, 1)
+    coords = torch.randint(0, 4, (B, L, 3)).float().repeat(1, W, 1)
+    times = torch.rand(B, T).cumsum(1)
+    cache = None
+    with torch.no_grad():
+        for inputs in rollout_windows(blocks, coords, times, W):
+            expected = model(*inputs)[:,-L:]
+            output, cache = model.forward_incremental(*inputs, cache)
+            assert torch.allclose(output[:,-L:], expected, atol=1e-5)
+
+@pytest.mark.parametrize('kwargs', [{}, {'decoder_only': True, 'num_dec_layers': 2}])
+def test_forward_incremental_rejects_several_layers(kwargs):
+    model = make_model(**kwargs)
+    inputs = next(rollout_windows(torch.randn(1, 5, 8, 1), torch.zeros(1, 32, 3), torch.rand(1, 5), model.window_size))
+    with pytest.raises(ValueError):
+        model.forward_incremental(*inputs)
@@ -9,7 +9,7 @@ import ray
 from ray import tune
 from ray.tune.schedulers import AsyncHyperBandScheduler, ASHAScheduler
 from ray.tune.suggest.basic_variant import BasicVariantGenerator
-from transformer import Tranformer
+from transformer import Transformer, grid_patch_coords, precision_dtype, autocast
 from utils import *
 
 
@@ -21,6 +21,13 @@ class early_stopping():
         self.best_loss = None
         self.counter = 0
         self.best_model = None
+
+    def state_dict(self):
+        ### best_model is the trained model itself, it is saved with it
+        return {'early_stop': self.early_stop, 'best_loss': self.best_loss, 'counter': self.counter}
+
+    def load_state_dict(self, state):
+        self.early_stop, self.best_loss, self.counter = state['early_stop'], state['best_loss'], state['counter']
     
     def __call__(self, model, val_loss):
         if self.best_loss is None:
@@ -37,8 +44,10 @@ class early_stopping():
             print(f'----Current loss {val_loss} higher than best loss {self.best_loss}, early stop counter {self.counter}----', flush=True)
 
 
-def evaluate(model,data_loader,criterion, patch_size=(1,1,16)):
-    model.eval()    
+def evaluate(model,data_loader,criterion, patch_size=(1,1,16), dec_method='zero', precision='fp32'):
+    '''precision: of the model, the inputs are cast to its dtype and the outputs back to fp32'''
+    model.eval()
+    dtype = precision_dtype(precision)    
     test_rollout = torch.Tensor(0)   
     test_result = torch.Tensor(0)  
     truth = torch.Tensor(0)
@@ -57,13 +66,15 @@ def evaluate(model,data_loader,criterion, patch_size=(1,1,16)):
                 test_rollout = tgt
             else:
                 enc_in = test_rollout[:,-tgt.shape[1]:,:]
-                dec_in = torch.zeros([enc_in.shape[0], x1*x2*x3, enc_in.shape[-1]]).float()
-                dec_in = torch.cat([enc_in[:,:(tgt.shape[1]-x1*x2*x3),:], dec_in], dim=1).float()
+                context = enc_in[:,:-x1*x2*x3,:].reshape(enc_in.shape[0], -1, x1*x2*x3, enc_in.shape[-1])
+                dec_in = build_dec_in(context, dec_method).reshape(enc_in.shape).float()
                 #dec_in = enc_in[:,:(window_size-1),:]
-            enc_in, dec_in, tgt = enc_in.to(device), dec_in.to(device), tgt.to(device)
+            enc_in, dec_in, tgt = enc_in.to(device, dtype), dec_in.to(device, dtype), tgt.to(device)
             src_coord, tgt_coord, src_ts, tgt_ts = src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
             
-            output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts) 
+            with autocast(precision, device):
+                output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts)
+            output = output.float()
             test_rollout = torch.cat([test_rollout,output[:,-x1*x2*x3:,:].detach().cpu()],dim = 1)
             truth = torch.cat((truth, tgt[:,-x1*x2*x3:,:].flatten().detach().cpu()), 0)
             test_result = torch.cat((test_result, output[:,-x1*x2*x3:,:].flatten().detach().cpu()), 0)
@@ -89,6 +100,12 @@ def train(config, checkpoint_dir):
     pe_type = config['pe_type']
     feature_size = config['feature_size']
     batch_size = config['batch_size']
+    dec_method = config.get('dec_method', 'zero') ### decoder input padding, see build_dec_in
+    precision = config.get('precision', 'fp32') ### 'fp32', 'bf16_autocast' or 'bf16', see Transformer
+    dtype = precision_dtype(precision)
+    accumulation_steps = config.get('accumulation_steps', 1) ### mini-batches per optimizer step, see TrainEngine
+    use_compile = config.get('compile', False)
+    checkpoint_interval = config.get('checkpoint_interval', 200) ### optimizer steps between mid-epoch checkpoints
 
     scale = False
     num_enc_layers = 1
@@ -100,8 +117,10 @@ def train(config, checkpoint_dir):
     lr_decay = 0.9
     
     #model = Tranformer(feature_size=feature_size,num_layers=num_layer,dropout=dropout,num_head=num_head)
-    model = Tranformer(feature_size=feature_size,num_enc_layers=num_enc_layers,num_dec_layers = num_dec_layers,\
-            d_ff = d_ff, dropout=dropout,num_head=num_head,pe_type=pe_type)
+    ### 3d embeddings are precomputed per patch, so the loaders give patch indices instead of coordinates
+    model = Transformer(feature_size=feature_size,num_enc_layers=num_enc_layers,num_dec_layers = num_dec_layers,\
+            d_ff = d_ff, dropout=dropout,num_head=num_head,pe_type=pe_type,grid_size=grid_size,patch_size=patch_size,\
+            patch_coords=grid_patch_coords(grid_size, patch_size), precision=precision)
     device = "cpu"
     if torch.cuda.is_available():
         device = "cuda:0"
@@ -117,40 +136,58 @@ def train(config, checkpoint_dir):
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=lr_decay)
     writer = tensorboard.SummaryWriter('./test_logs')
         
-    # if checkpoint_dir:
-    #     checkpoint = os.path.join(checkpoint_dir, "checkpoint")
-    #     model_state, optimizer_state = torch.load(checkpoint)
-    #     model.load_state_dict(model_state)
-    #     optimizer.load_state_dict(optimizer_state)
             
     train_loader,val_loader, test_loader = get_data_loaders(train_proportion, test_proportion, val_proportion,\
-        pred_size = 1, batch_size = batch_size, num_workers = 2, pin_memory = False, use_coords = True, use_time = True,\
+        pred_size = 1, batch_size = batch_size, num_workers = 0, pin_memory = False, use_coords = False, use_time = True,\
         test_mode = False, scale = scale, window_size = window_size, patch_size = patch_size)
 
 
-    for epoch in range(1, epochs + 1):
-        model.train() 
-        total_loss = 0.
-
-        for i, ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) in enumerate(train_loader):
-            src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
-                                                            src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
-            optimizer.zero_grad()
-            dec_inp = torch.zeros([tgt.shape[0], x1*x2*x3, tgt.shape[-1]]).float().to(device)
-            dec_inp = torch.cat([tgt[:,:(tgt.shape[1]-x1*x2*x3),:], dec_inp], dim=1).float().to(device)
+    def loss_fn(batch):
+        ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) = batch
+        ### the model inputs in the dtype of precision, the target stays fp32 for the loss
+        src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device, dtype), tgt.to(device), \
+                                                        src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
+        context = tgt[:,:-x1*x2*x3,:].reshape(tgt.shape[0], -1, x1*x2*x3, tgt.shape[-1])
+        dec_inp = build_dec_in(context, dec_method).reshape(tgt.shape).to(dtype)
+        with autocast(precision, device):
             output = model(src, dec_inp, src_coord, tgt_coord, src_ts, tgt_ts)
-            loss = criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:])
-            total_loss += loss.item()
-            loss.backward()
-            optimizer.step()
+        return criterion(output[:,-x1*x2*x3:,:].float(), tgt[:,-x1*x2*x3:,:])
+    engine = TrainEngine(model, optimizer, loss_fn, accumulation_steps=accumulation_steps, use_compile=use_compile)
+
+    ### checkpoints of the whole trial, a restored trial resumes from the last one, mid-epoch included; they are
+    ### written in place since tune takes the checkpoint directory over once its block exits
+    start_epoch, start_batch, start_loss, start_rng = 1, 0, 0., None
+    if checkpoint_dir:
+        checkpoint = torch.load(os.path.join(checkpoint_dir, "checkpoint"), map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        Early_Stopping.load_state_dict(checkpoint['early_stopping'])
+        counter_old = checkpoint['counter_old']
+        start_epoch, start_batch, start_loss, start_rng = checkpoint['epoch'], checkpoint['batch'], checkpoint['total_loss'], checkpoint['rng']
+        if Early_Stopping.early_stop:
+            return
+
+    def save(epoch, num_batches, total_loss):
+        state = {'epoch': epoch, 'batch': num_batches, 'total_loss': total_loss, 'model': model.state_dict(), \
+                 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'early_stopping': Early_Stopping.state_dict(), \
+                 'counter_old': counter_old, 'rng': rng_states()}
+        with tune.checkpoint_dir(step=(epoch-1)*len(train_loader)+num_batches) as directory:
+            save_checkpoint(state, os.path.join(directory, "checkpoint"))
+
+    for epoch in range(start_epoch, epochs + 1):
+        def on_step(num_batches, total_loss):
+            if (num_batches//accumulation_steps) % checkpoint_interval == 0 and num_batches < len(train_loader):
+                save(epoch, num_batches, total_loss.item())
+        total_loss = engine.run_epoch(train_loader, start_batch, start_loss, start_rng, on_step=on_step)
+        start_batch, start_loss, start_rng = 0, 0., None
 
         train_loss = total_loss*batch_size/len(train_loader.dataset)
-        val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size)
+        val_loss, r2, explained_variance = evaluate(model, val_loader, criterion, patch_size=patch_size, dec_method=dec_method, \
+                                                   precision=precision)
 
 
         #print(f'Epoch: {epoch}, train_loss: {train_loss}, val_loss: {val_loss}', flush=True)
-            
-        tune.report(train_loss = train_loss, val_loss = val_loss, r2 = r2, explained_variance = explained_variance, epoch=epoch)
 
         writer.add_scalar('train_loss',train_loss,epoch)
         writer.add_scalar('val_loss',val_loss,epoch)
@@ -161,6 +198,9 @@ def train(config, checkpoint_dir):
         if counter_new != counter_old:
             scheduler.step()
             counter_old = counter_new
+        ### the checkpoint goes with the next report, so it is saved first
+        save(epoch+1, 0, 0.)
+        tune.report(train_loss = train_loss, val_loss = val_loss, r2 = r2, explained_variance = explained_variance, epoch=epoch)
         if Early_Stopping.early_stop:
             break
 
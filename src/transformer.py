@@ -1,9 +1,100 @@
 #!/bin/bash python
 import torch 
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import math
 
+PRECISIONS = ('fp32', 'bf16_autocast', 'bf16')
+
+def precision_dtype(precision):
+    '''dtype of the weights and inputs of a model at precision, one of PRECISIONS; 'bf16_autocast' keeps fp32 weights'''
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expect one of {PRECISIONS}')
+    return torch.bfloat16 if precision == 'bf16' else torch.float32
+
+def autocast(precision, device):
+    '''bfloat16 autocast of the forward for 'bf16_autocast', a no-op for the other precisions'''
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16_autocast')
+
+def grid_patch_coords(grid_size, patch_size, shift_size=(0,0,0)):
+    '''
+    Grid indices of the cells of every cuboid patch of a regular grid, patches in (n1, n2, n3) order and
+    cells in (p1, p2, p3) order inside each patch, i.e. the 'patch' option of to_windowed for one time step
+    shift_size: (s1, s2, s3) roll of the grid, the cell at i holds the coordinate (i+s) % grid_size
+    return: (n1 x n2 x n3, p1 x p2 x p3, 3) long tensor
+    '''
+    grid_size = (grid_size,)*3 if type(grid_size) == int else tuple(grid_size)
+    axes = [(torch.arange(g)+s) % g for g, s in zip(grid_size, shift_size)]
+    coord = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1)
+    (g1, g2, g3), (p1, p2, p3) = grid_size, patch_size
+    coord = coord.view(g1//p1, p1, g2//p2, p2, g3//p3, p3, 3).permute(0,2,4,1,3,5,6)
+    return coord.reshape(-1, p1*p2*p3, 3)
+
+class KVRing():
+    '''
+    Keys and values of the last num_blocks blocks seen by one attention layer of an incremental rollout, in
+    preallocated buffers that the projections of new blocks overwrite in place, like RingContext
+    block_length: tokens per block, e.g. the patch length
+    '''
+    def __init__(self, num_blocks, block_length):
+        self.num_blocks = num_blocks
+        self.block_length = block_length
+        self.keys = self.values = None
+        self.head = 0 ### slot of the oldest block
+
+    def push(self, keys, values, rewind=0):
+        '''
+        Write the (batch x heads, n x block_length, head_dim) keys and values of n new blocks over the oldest ones,
+        after dropping the newest rewind blocks (e.g. decoder padding that the new blocks replace)
+        '''
+        if self.keys is None:
+            self.keys = keys.new_empty((keys.shape[0], self.num_blocks*self.block_length, keys.shape[2]))
+            self.values = torch.empty_like(self.keys)
+        self.head = (self.head - rewind) % self.num_blocks
+        blocks = (self.head + torch.arange(keys.shape[1]//self.block_length, device=keys.device)) % self.num_blocks
+        index = (blocks.unsqueeze(1)*self.block_length + torch.arange(self.block_length, device=keys.device)).view(-1)
+        self.keys.index_copy_(1, index, keys)
+        self.values.index_copy_(1, index, values)
+        self.head = (self.head + len(blocks)) % self.num_blocks
+
+    def positions(self):
+        '''Window position of the block in each key slot, 0 for the oldest'''
+        slots = torch.arange(self.keys.shape[1], device=self.keys.device)//self.block_length
+        return (slots - self.head) % self.num_blocks
+
+def cached_attention(attn, query, memory, ring, query_pos, shift=0, rewind=0):
+    '''
+    nn.MultiheadAttention attn of the new query tokens over the window of key/value tokens cached in ring,
+    after the projections of the new memory tokens are pushed to it
+        query: (Lq, batch, E) tokens of new blocks, at window positions query_pos (Lq,)
+        memory: (Lm, batch, E) key/value tokens of new blocks
+        shift: a query at window position i sees the keys at positions <= i+shift, None for all (the patch masks of forward)
+    '''
+    E = query.shape[-1]
+    head_dim = E//attn.num_heads
+    def split_heads(x):
+        return x.reshape(x.shape[0], -1, head_dim).transpose(0,1)
+    w_q, w_k, w_v = attn.in_proj_weight.split(E)
+    b_q, b_k, b_v = attn.in_proj_bias.split(E) if attn.in_proj_bias is not None else (None,)*3
+    ring.push(split_heads(F.linear(memory, w_k, b_k)), split_heads(F.linear(memory, w_v, b_v)), rewind)
+    scores = torch.bmm(split_heads(F.linear(query, w_q, b_q))*head_dim**-0.5, ring.keys.transpose(1,2))
+    if shift is not None:
+        scores = scores.masked_fill(ring.positions() > query_pos.unsqueeze(1)+shift, float('-inf'))
+    output = torch.bmm(scores.softmax(-1), ring.values)
+    return attn.out_proj(output.transpose(0,1).reshape(query.shape))
+
+def encoder_layer_step(layer, x, ring, pos):
+    '''nn.TransformerEncoderLayer (post-norm) on the new tokens x at window positions pos, see cached_attention'''
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, x, x, ring, pos)))
+    return layer.norm2(x + layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+
+def decoder_layer_step(layer, x, memory, self_ring, cross_ring, pos, memory_shift=0, rewind=0):
+    '''nn.TransformerDecoderLayer (post-norm) on the new tokens x at window positions pos with the new memory tokens'''
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, x, x, self_ring, pos, rewind=rewind)))
+    x = layer.norm2(x + layer.dropout2(cached_attention(layer.multihead_attn, x, memory, cross_ring, pos, memory_shift)))
+    return layer.norm3(x + layer.dropout3(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_model, dropout= 0.1, max_len= 5000):
@@ -77,6 +168,15 @@ class PositionalEmbedding3D(nn.Module):
         xs,ys,zs = coords[0].long(),coords[1].long(),coords[2].long()
         return self.pe[xs,ys,zs].view(batch.shape[0],-1,self.d_model_)  #torch.stack([self.pe[i,j,k] for i,j,k in zip(xs,ys,zs)]).view(batch.shape[0],-1,self.d_model_)
 
+    def patch_embedding(self, patch_coords):
+        '''
+        Embedding of a fixed patch layout, looked up once instead of per batch
+        :param patch_coords: (num_patches, patch_length, 3) grid indices of the cells of each patch, see grid_patch_coords
+        :return: (num_patches, patch_length, d_model_)
+        '''
+        xs, ys, zs = torch.as_tensor(patch_coords).long().unbind(-1)
+        return self.pe[xs,ys,zs]
+
 class TokenEmbedding(nn.Module):
     def __init__(self, d_model):
         super(TokenEmbedding, self).__init__()
@@ -114,14 +214,22 @@ class TemporalEmbedding(nn.Module):
 
     def forward(self, x):
         #x = x.unsqueeze(2)
-        x = self.l1(x)
-        x = self.fc1(x)
+        ### the sin of absolute times is computed in fp32 at any precision, see Transformer._set_precision
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = self.l1(x.to(self.w.dtype))
+        x = self.fc1(x.to(self.fc1.weight.dtype))
         return x
 
 class Transformer(nn.Module):
-    def __init__(self,feature_size=250,num_enc_layers=1,num_dec_layers=1,d_ff = 256, dropout=0.1,num_head=2,pe_type='3d',grid_size=16,mask_type=None,patch_size=(2,2,2),window_size=5,decoder_only=False):
+    def __init__(self,feature_size=250,num_enc_layers=1,num_dec_layers=1,d_ff = 256, dropout=0.1,num_head=2,pe_type='3d',grid_size=16,mask_type=None,patch_size=(2,2,2),window_size=5,decoder_only=False,patch_coords=None,precision='fp32'):
         '''
         mask_type: 'patch' if using cuboic patches, which masks by patch instead of elements. Default to None (square_subsequent mask)
+        patch_coords: (num_patches, patch_length, 3) cell coordinates of every patch in one time step of the windows, e.g.
+                      grid_patch_coords(grid_size, patch_size) or WindowDataset.patch_coords. If given, the 3d embeddings
+                      are precomputed in this layout and src_coord/tgt_coord are the (batch,) patch indices of the windows
+                      (WindowDataset with return_coords=False) instead of coordinate tensors. Default to None (coordinates)
+        precision: 'fp32', 'bf16_autocast' (fp32 weights, run the forward under autocast) or 'bf16' (bf16 weights and
+                   inputs, see _set_precision). Default to 'fp32'
         '''
         super(Transformer, self).__init__()
         self.patch_size = patch_size
@@ -132,6 +240,10 @@ class Transformer(nn.Module):
         self.src_mask = mask_type
         self.pos_encoder = PositionalEncoding(feature_size)
         self.pos3d_encoder = PositionalEmbedding3D(feature_size,grid_size)
+        self.use_patch_pe = patch_coords is not None
+        if self.use_patch_pe:
+            ### derived from pos3d_encoder.pe, so not saved with the model
+            self.register_buffer('patch_pe', self.pos3d_encoder.patch_embedding(patch_coords), persistent=False)
         #self.token_embedding = TokenEmbedding(feature_size)
         self.temporal_encoder = TemporalEmbedding(input_dim=feature_size, output_dim=feature_size, activation='sin')
 
@@ -143,7 +255,10 @@ class Transformer(nn.Module):
             nhead=num_head, dropout=dropout, dim_feedforward = d_ff)  
         self.transformer_decoder = nn.TransformerDecoder(self.decoder_layer, num_layers=num_dec_layers)
         self.decoder = nn.Linear(feature_size,1)
+        ### (shape, device) key of each mask cached as a non-persistent buffer, see _cached_buffer
+        self._buffer_keys = {}
         self.init_weights()
+        self._set_precision(precision)
 
     def init_weights(self):
         initrange = 0.1    
@@ -153,6 +268,24 @@ class Transformer(nn.Module):
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
+    def _set_precision(self, precision):
+        '''
+        Weights and buffers in the dtype of precision, except the LayerNorm and BatchNorm weights and statistics (bf16
+        inputs are normalized with fp32 weights and accumulation) and the time weights of the TemporalEmbedding, as the
+        sin of absolute times needs fp32
+        '''
+        self.precision = precision
+        dtype = precision_dtype(precision)
+        if dtype == torch.float32:
+            return
+        for module in self.modules():
+            if isinstance(module, (nn.LayerNorm, nn.modules.batchnorm._BatchNorm)):
+                continue
+            time_weights = ('w0', 'b0', 'w', 'b') if isinstance(module, TemporalEmbedding) else ()
+            for name, tensor in list(module._parameters.items()) + list(module._buffers.items()):
+                if tensor is not None and tensor.is_floating_point() and name not in time_weights:
+                    tensor.data = tensor.data.to(dtype)
+
     def forward(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts):
         if self.pe_type == '1d':
             src = src.permute(1,0,2)
@@ -161,28 +294,30 @@ class Transformer(nn.Module):
             tgt = self.pos_encoder(tgt)
 
         elif self.pe_type == '3d':
-            src = src + self.pos3d_encoder(src_coord)
-            tgt = tgt + self.pos3d_encoder(tgt_coord)
+            src = self._add_pos3d(src, src_coord)
+            tgt = self._add_pos3d(tgt, tgt_coord)
             src = src.permute(1,0,2)
             tgt = tgt.permute(1,0,2)
         
         elif self.pe_type == '3d_temporal':
-            src = src + self.pos3d_encoder(src_coord) + self.temporal_encoder(src_ts)
-            tgt = tgt + self.pos3d_encoder(tgt_coord) + self.temporal_encoder(tgt_ts)
+            src = self._add_pos3d(src, src_coord) + self.temporal_encoder(src_ts)
+            tgt = self._add_pos3d(tgt, tgt_coord) + self.temporal_encoder(tgt_ts)
             src = src.permute(1,0,2)
             tgt = tgt.permute(1,0,2)
 
         #print(f'src shape {src.shape}, tgt shape: {tgt.shape}')
-        ### generate patch mask
+        ### generate patch mask, built once per shape and device
+        device = src.device
         if self.src_mask == 'patch':
-            device = src.device
-            self.mask = self._generate_patch_mask(self.patch_size,self.window_size,0).to(device)
-            self.dec_src_mask = self._generate_patch_mask(self.patch_size,self.window_size,-1).to(device)
+            self.mask = self._cached_buffer('patch_mask', (self.patch_size,self.window_size,0,device), \
+                lambda: self._generate_patch_mask(self.patch_size,self.window_size,0).to(device))
+            self.dec_src_mask = self._cached_buffer('dec_src_patch_mask', (self.patch_size,self.window_size,-1,device), \
+                lambda: self._generate_patch_mask(self.patch_size,self.window_size,-1).to(device))
             #print(f'Using patch mask: mask: {self.mask}, shape: {self.mask.shape}', flush=True)
             #self.src_mask = mask
         elif self.src_mask is None or self.src_mask.size(0) != len(src):
-            device = src.device
-            self.mask = self._generate_square_subsequent_mask(src.shape[0]).to(device)
+            self.mask = self._cached_buffer('square_mask', (src.shape[0],device), \
+                lambda: self._generate_square_subsequent_mask(src.shape[0]).to(device))
             #print(f'Using original mask: mask: {self.mask}, shape: {self.mask.shape}', flush=True)
             #self.src_mask = mask
 
@@ -205,6 +340,85 @@ class Transformer(nn.Module):
         #print('output shape: ',output.shape)
         return output.permute(1,0,2)
 
+    def forward_incremental(self, src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, cache=None, step_blocks=1):
+        '''
+        Incremental inference for autoregressive rollouts with the patch mask: the keys and values of every attention
+        layer are cached per window block (see KVRing), so a step only embeds and attends the blocks that are new since
+        the previous call, and the oldest blocks are evicted as the window slides.
+        Inputs are the full windows, as for forward. With cache=None every block is new and the output equals forward;
+        otherwise the windows slid by step_blocks blocks, so the newest step_blocks blocks of src are new, and the newest
+        2 x step_blocks of tgt (the prediction that replaced the padding of the previous decoder input, and the new padding).
+        Only the keys and values of the first attention layer depend on their block alone: the states of any deeper layer
+        (and the encoder output) depend on the earlier blocks of the window, evicted ones included, so the steps equal
+        forward for models with a single attention layer (decoder_only with one decoder layer) only.
+        return: (batch, new tgt tokens, 1) output of the new tgt blocks, and the cache for the next step
+        '''
+        if self.src_mask != 'patch' or self.pe_type not in ['3d', '3d_temporal']:
+            raise ValueError('incremental decoding needs mask_type="patch" and a 3d positional embedding')
+        patch_length = int(np.prod(self.patch_size))
+        encoder_layers = [] if self.decoder_only else self.transformer_encoder.layers
+        decoder_layers = self.transformer_decoder.layers
+        if len(encoder_layers) + len(decoder_layers) != 1:
+            raise ValueError(f'incremental decoding is only exact with a single attention layer, the model has '
+                             f'{len(encoder_layers)} encoder and {len(decoder_layers)} decoder layers')
+        if cache is None:
+            cache = {'encoder': [KVRing(self.window_size, patch_length) for _ in encoder_layers], \
+                     'self': [KVRing(self.window_size, patch_length) for _ in decoder_layers], \
+                     'cross': [KVRing(self.window_size, patch_length) for _ in decoder_layers]}
+            num_src = num_tgt = self.window_size
+        else:
+            num_src, num_tgt = step_blocks, 2*step_blocks
+
+        def new_tokens(x, coord, ts, num_blocks):
+            ### embedded (num_blocks x patch_length, batch, feature_size) tokens of the newest blocks of a window
+            length = num_blocks*patch_length
+            x = self._add_pos3d(x[:,-length:], coord if self.use_patch_pe else coord[:,-length:].contiguous())
+            if self.pe_type == '3d_temporal':
+                x = x + self.temporal_encoder(ts[:,-length:])
+            return x.permute(1,0,2)
+        def positions(num_blocks):
+            return torch.arange(self.window_size-num_blocks, self.window_size, device=src.device).repeat_interleave(patch_length)
+
+        memory = new_tokens(src, src_coord, src_ts, num_src)
+        for layer, ring in zip(encoder_layers, cache['encoder']):
+            memory = encoder_layer_step(layer, memory, ring, positions(num_src))
+        if not self.decoder_only and self.transformer_encoder.norm is not None:
+            memory = self.transformer_encoder.norm(memory)
+        output = new_tokens(tgt, tgt_coord, tgt_ts, num_tgt)
+        for layer, self_ring, cross_ring in zip(decoder_layers, cache['self'], cache['cross']):
+            ### the decoder sees one block ahead in the memory, as dec_src_mask
+            output = decoder_layer_step(layer, output, memory, self_ring, cross_ring, positions(num_tgt), \
+                                        memory_shift=1, rewind=num_tgt-num_src)
+        if self.transformer_decoder.norm is not None:
+            output = self.transformer_decoder.norm(output)
+        return self.decoder(output).permute(1,0,2), cache
+
+    def _add_pos3d(self, x, coord):
+        '''
+        x: (batch, seq_len, feature_size); coord: (batch, seq_len, 3) coordinates, or (batch,) patch indices with patch_coords
+        '''
+        if not self.use_patch_pe:
+            return x + self.pos3d_encoder(coord)
+        ### the patch embedding is the same for every time step, so broadcast it over the window
+        pe = self.patch_pe.index_select(0, coord.view(-1).long())
+        ### x may have fewer channels than the embedding (e.g. one variable), which broadcasts as in the coordinate path
+        return (x.view(x.shape[0], -1, pe.shape[1], x.shape[-1]) + pe.unsqueeze(1)).flatten(1,2)
+
+    def _cached_buffer(self, name, key, build):
+        '''
+        Return the non-persistent buffer `name`, (re)building it with build() when its key changes
+        key: hashable description of the shape and device the buffer is built for
+        '''
+        ### DataParallel replicas share the plain attributes of the module but own copies of its buffers, so each
+        ### replica keeps its own copy of the keys, matching the buffers it was given
+        if getattr(self, '_is_replica', False) and '_replica_buffer_keys' not in self.__dict__:
+            self._replica_buffer_keys = dict(self._buffer_keys)
+        keys = self.__dict__.get('_replica_buffer_keys', self._buffer_keys)
+        if keys.get(name) != key or name not in self._buffers:
+            self.register_buffer(name, build(), persistent=False)
+            keys[name] = key
+        return getattr(self, name)
+
     def _generate_square_subsequent_mask(self, sz):
         mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
         mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
@@ -9,7 +9,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import time
 import os
-from transformer import Transformer
+from transformer import Transformer, precision_dtype, autocast
 from utils import *
 
 class early_stopping():
@@ -20,6 +20,13 @@ class early_stopping():
         self.best_loss = None
         self.counter = 0
         self.best_model = None
+
+    def state_dict(self):
+        ### best_model is the trained model itself, it is saved with it
+        return {'early_stop': self.early_stop, 'best_loss': self.best_loss, 'counter': self.counter}
+
+    def load_state_dict(self, state):
+        self.early_stop, self.best_loss, self.counter = state['early_stop'], state['best_loss'], state['counter']
     
     def __call__(self, model, val_loss):
         if self.best_loss is None:
@@ -35,14 +42,12 @@ class early_stopping():
                 print('Early stopping')
             print(f'----Current loss {val_loss} higher than best loss {self.best_loss}, early stop counter {self.counter}----')
 
-def process_one_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, patch_size): 
+def process_one_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, patch_size, dec_method='mean'): 
     x1, x2, x3 = patch_size
     #dec_rollout = src[:,-x1*x2*x3:,:]
-    dec_rollout = torch.zeros([tgt.shape[0], x1*x2*x3, tgt.shape[-1]]).float().to(device)
-    for i in range(batch_size):
-        for j in range(x1*x2*x3):
-            dec_rollout[i,j,:] = torch.cat([tgt[i,j+x1*x2*x3*k,:] for k in range(window_size-1)], dim=0).mean()
-    dec_in = torch.cat([src[:,x1*x2*x3:,:], dec_rollout], dim=1).float().to(device)
+    ### (B, window_size-1, patch_length, C) patches known to the decoder, padded by dec_method
+    context = src[:,x1*x2*x3:,:].reshape(src.shape[0], -1, x1*x2*x3, src.shape[-1])
+    dec_in = build_dec_in(context, dec_method).reshape(src.shape).float().to(device)
     outputs = model(src, dec_in, src_coord, tgt_coord, src_ts, tgt_ts)
     return outputs, tgt
 
@@ -78,15 +83,24 @@ def predict_model(model, test_loader, epoch, config={},\
     parameters:
         plot_range: [a,b], 0<=a<b<=1, where a is the proportion that determines the start point to plot, b determines the end point. 
         final_prediction: True, if done with training and using the trained/saved model to predict the final result
-        config: dictionary, the config of this plot, used for saving distinguishable plots for each trail
+        config: dictionary, the config of this plot, used for saving distinguishable plots for each trail,
+                config['dec_method'] selects the decoder input of the rollout steps (see build_dec_in), default 'mean'
+                'mean' pads each window with the mean of its own context blocks, where it used to be one mean over
+                the context blocks of the whole batch, so its predictions differ from those of earlier versions
+                config['kv_cache'] if True, steps only attend the new blocks over cached keys/values (see
+                Transformer.forward_incremental), for models with a single attention layer only; default False
+                the inputs are cast to the dtype of the model precision (see Transformer) and its outputs back to fp32,
+                so the rollout and the scaler inverse transform stay in fp32
     '''
     model.eval()
+    precision = getattr(getattr(model, 'module', model), 'precision', 'fp32')
+    dtype = precision_dtype(precision)
     window_size = config['window_size']  
-    test_result = torch.Tensor(0)
-    test_rollout = {}#torch.Tensor(0) 
-    truth = torch.Tensor(0) 
-    test_ts = torch.Tensor(0)
-    test_coord = torch.Tensor(0)
+    patch_length = x1*x2*x3
+    test_rollout = {} ### RingContext of the last window of each patch position
+    kv_caches = {} ### attention cache of each patch position, with config['kv_cache']
+    ### every window predicts one patch, so the length of the rollout is known up front
+    writer = RolloutWriter(len(test_loader.dataset)*patch_length, {'time': 0, 'coord': 3, 'prediction': 0, 'truth': 0})
     device = "cpu"
     if torch.cuda.is_available():
         device = "cuda:0"
@@ -98,61 +112,47 @@ def predict_model(model, test_loader, epoch, config={},\
             src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
                                                             src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
             key_val = str(tgt_coord[0,0,:])
-            if test_rollout.get(key_val) == None:
+            if test_rollout.get(key_val) is None:
                 enc_in = src
                 dec_in = tgt
             else:
-                enc_in = test_rollout[key_val][:,-tgt.shape[1]:,:].float()
+                enc_in = test_rollout[key_val].get().reshape(tgt.shape[0], -1, tgt.shape[-1]).float()
                 # dec_rollout = enc_in[:,-x1*x2*x3:,:].float()
-                dec_rollout = torch.zeros([tgt.shape[0], x1*x2*x3, tgt.shape[-1]]).float().to(device)
-                for j in range(x1*x2*x3):
-                    dec_rollout[:,j,:] = torch.cat([enc_in[:,j+x1*x2*x3*k,:] for k in range(1, window_size)], dim=0).mean()
-                dec_in = torch.cat([enc_in[:,x1*x2*x3:,:], dec_rollout], dim=1).float()
-
-            output = model(enc_in, dec_in, src_coord, tgt_coord, src_ts, tgt_ts)
-            test_rollout[key_val] = torch.cat([test_rollout.get(key_val, enc_in[:,x1*x2*x3:,:]),output[:,-x1*x2*x3:,:]], dim=1)
-            test_ts = torch.cat((test_ts, tgt_ts[:,-x1*x2*x3:,:].flatten().detach().cpu()), 0)
-            test_coord = torch.cat((test_coord, tgt_coord[:,-x1*x2*x3:,:].reshape(-1,3).detach().cpu()), 0)
-            truth = torch.cat((truth, tgt[:,-x1*x2*x3:,:].flatten().detach().cpu()), 0)
-            test_result = torch.cat((test_result, output[:,-x1*x2*x3:,:].flatten().detach().cpu()), 0)
+                context = enc_in[:,patch_length:,:].reshape(enc_in.shape[0], -1, patch_length, enc_in.shape[-1])
+                dec_in = build_dec_in(context, config.get('dec_method', 'mean')).reshape(enc_in.shape).float()
 
+            with autocast(precision, device):
+                if config.get('kv_cache', False):
+                    output, kv_caches[key_val] = getattr(model, 'module', model).forward_incremental(enc_in.to(dtype), dec_in.to(dtype), \
+                                                            src_coord, tgt_coord, src_ts, tgt_ts, kv_caches.get(key_val))
+                else:
+                    output = model(enc_in.to(dtype), dec_in.to(dtype), src_coord, tgt_coord, src_ts, tgt_ts)
+            output = output.float()
+            ### (B, num_patches, patch_length, C) context, the new patch replaces the oldest one
+            if test_rollout.get(key_val) is None:
+                context = torch.cat([enc_in[:,patch_length:,:], output[:,-patch_length:,:]], dim=1)
+                test_rollout[key_val] = RingContext(context.reshape(context.shape[0], -1, patch_length, context.shape[-1]), dim=1)
+            else:
+                test_rollout[key_val].push(output[:,-patch_length:,:].unsqueeze(1))
+            writer.write(time=tgt_ts[:,-patch_length:,:], coord=tgt_coord[:,-patch_length:,:], \
+                         prediction=output[:,-patch_length:,:], truth=tgt[:,-patch_length:,:])
+
+        rollout = writer.result()
+        test_ts, test_coord, test_result, truth = rollout['time'], rollout['coord'], rollout['prediction'], rollout['truth']
         a = torch.cat([test_ts.unsqueeze(-1), test_coord, test_result.unsqueeze(-1), truth.unsqueeze(-1)], dim=-1)
         a = a.numpy()
-        a = a[np.argsort(a[:, 3])]
-        a = a[np.argsort(a[:, 2], kind='stable')]
-        a = a[np.argsort(a[:, 1], kind='stable')]
-        a = a[np.argsort(a[:, 0], kind='stable')]
+        a = sort_grid_rows(a)
 
-        final_result = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5]}
-        
+        if config['scale']==True:
+            a[:,4] = scaler.inverse_transform(a[:,4:5]).reshape(-1)
+            a[:,5] = scaler.inverse_transform(a[:,5:6]).reshape(-1)
         if predict_res:
-            residuals = pd.DataFrame.from_dict(final_result)
-            truth = pd.read_csv('tune_results/data_original.csv',index_col=0)
-            ### Group by time since last timestamp is duplicated
-            #truth.time = np.round(truth.time.values,5)
-            #residuals.time = np.round(residuals.time.values,5)
-            #residuals = residuals.groupby(['time','x1','x2','x3']).mean().reset_index()
-            #truth = truth.groupby(['time','x1','x2','x3']).mean().reset_index()
-
-            ### Reconstruct predictions, truth is also reconstructed to validate answer
-            pred_timestamps = residuals.time.unique()
-            pred_start_time = residuals.time[0]
-            pred_start_truth = truth[truth['time']==truth.time.unique()[-len(pred_timestamps)]]
-            for i,(t1,t2) in enumerate(zip(pred_timestamps,truth.time.unique()[-len(pred_timestamps):])):
-                truth_values = truth.loc[truth['time']==t2].truth_original.values
-                pred_values = residuals.loc[residuals['time']==t1].prediction.values
-                truth_check_values = residuals.loc[residuals['time']==t1].truth.values
-                if i==0:
-                    prev_truth_plus_residual = pred_values+truth_values
-                else:
-                    prev_truth_plus_residual = pred_values+prev_truth_plus_residual
-                residuals.loc[residuals['time']==t1,'prediction']= prev_truth_plus_residual
-                residuals.loc[residuals['time']==t1,'truth'] = truth_check_values+truth_values
-            final_result = residuals
+            ### residuals -> absolute values, accumulated from the last observed block of the unscaled series
+            if getattr(test_loader.dataset, 'origin', None) is None:
+                raise ValueError('predict_res needs the absolute series of the test set, see WindowDataset origin')
+            a = reconstruct_residual_rows(a, test_loader.dataset.origin, test_loader.dataset.times)
 
-        if config['scale']==True:
-            final_result['prediction'] = scaler.inverse_transform(final_result['prediction'])
-            final_result['truth'] = scaler.inverse_transform(final_result['truth'])
+        final_result = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'prediction': a[:,4], 'truth':a[:,5]}
     if plot==True:
         # plot a part of the result
         fig, ax = plt.subplots(nrows =1, ncols=1, figsize=(20,10))
@@ -182,7 +182,7 @@ def predict_model(model, test_loader, epoch, config={},\
 if __name__ == "__main__":
     print(f'Pytorch version {torch.__version__}')
     root_dir = '/scratch/zh2095/nyu-capstone/yd_test/tune_results/'
-    csv_path = '/scratch/zh2095/nyu-capstone/data/rho_original_16.csv'
+    cache_path = '/scratch/zh2095/nyu-capstone/data/rho_original_16.npy'
 
     sns.set_style("whitegrid")
     sns.set_palette(['#57068c','#E31212','#01AD86'])
@@ -256,9 +256,9 @@ if __name__ == "__main__":
     
     ### SPECIFYING use_coords=True WILL RETURN DATALOADERS FOR COORDS
     train_loader, test_loader, scaler = get_data_loaders(train_proportion, test_proportion, val_proportion,\
-        pred_size = 1, batch_size = batch_size, num_workers = 2, pin_memory = False, use_coords = True, use_time = True,\
+        pred_size = 1, batch_size = batch_size, num_workers = 0, pin_memory = False, use_coords = True, use_time = True,\
         test_mode = True, scale = scale, window_size = window_size, grid_size = grid_size, patch_size = patch_size, \
-        option = option, predict_res = predict_res, add_noise = add_noise, noise = noise, csv_path = csv_path)
+        option = option, predict_res = predict_res, add_noise = add_noise, noise = noise, cache_path = cache_path)
     
     train_losses = []
     test_losses = []
@@ -269,25 +269,49 @@ if __name__ == "__main__":
     x1, x2, x3 = patch_size
 
 
+    ### periodic checkpoints of the whole run, a restarted job resumes from the last one, mid-epoch included
+    checkpointer = AsyncCheckpointer(root_dir + '/checkpoint.pth')
+    checkpoint_interval = model_config.get('checkpoint_interval', 200) ### optimizer steps between mid-epoch checkpoints
+    start_epoch, start_batch, start_loss, start_rng = 1, 0, 0., None
+    checkpoint = checkpointer.load()
+    if checkpoint is not None and not skip_training:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        Early_Stopping.load_state_dict(checkpoint['early_stopping'])
+        counter_old, train_losses, test_losses = checkpoint['counter_old'], checkpoint['train_losses'], checkpoint['test_losses']
+        start_epoch, start_batch, start_loss, start_rng = checkpoint['epoch'], checkpoint['batch'], checkpoint['total_loss'], checkpoint['rng']
+        if Early_Stopping.early_stop:
+            start_epoch = epochs + 1
+        print(f'Resuming from epoch {start_epoch}, batch {start_batch}', flush=True)
+
+    def training_state(epoch, num_batches, total_loss):
+        return {'epoch': epoch, 'batch': num_batches, 'total_loss': total_loss, 'model': model.state_dict(), \
+                'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'early_stopping': Early_Stopping.state_dict(), \
+                'counter_old': counter_old, 'train_losses': train_losses, 'test_losses': test_losses, 'rng': rng_states()}
+
+    def loss_fn(batch):
+        ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) = batch
+        #print(f'i: {i}, src_coord: {src_coord}, tgt_coord: {tgt_coord}, src_ts: {src_ts}, tgt_ts: {tgt_ts}', flush=True)
+        src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
+                                                    src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
+        output = model(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts)
+        # output, truth = process_one_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, patch_size)
+        return criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:])
+    engine = TrainEngine(model, optimizer, loss_fn)
+
     if os.path.exists(root_dir+'/best_model.pth') and skip_training:
         model.load_state_dict(torch.load(root_dir+'/best_model.pth'))
     else:
-        for epoch in range(1, epochs + 1):    
-            model.train() 
-            total_loss = 0.
+        epoch = start_epoch - 1
+        for epoch in range(start_epoch, epochs + 1):    
             start_time = time.time()
 
-            for i, ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) in enumerate(train_loader):
-                #print(f'i: {i}, src_coord: {src_coord}, tgt_coord: {tgt_coord}, src_ts: {src_ts}, tgt_ts: {tgt_ts}', flush=True)
-                src, tgt, src_coord, tgt_coord, src_ts, tgt_ts = src.to(device), tgt.to(device), \
-                                                            src_coord.to(device), tgt_coord.to(device), src_ts.to(device), tgt_ts.to(device)
-                optimizer.zero_grad()
-                output = model(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts)
-                # output, truth = process_one_batch(src, tgt, src_coord, tgt_coord, src_ts, tgt_ts, patch_size)
-                loss = criterion(output[:,-x1*x2*x3:,:], tgt[:,-x1*x2*x3:,:])
-                total_loss += loss.item()
-                loss.backward()
-                optimizer.step()
+            def on_step(num_batches, total_loss):
+                if (num_batches//engine.accumulation_steps) % checkpoint_interval == 0 and num_batches < len(train_loader):
+                    checkpointer.save(training_state(epoch, num_batches, total_loss.item()))
+            total_loss = engine.run_epoch(train_loader, start_batch, start_loss, start_rng, on_step=on_step)
+            start_batch, start_loss, start_rng = 0, 0., None
 
             avg_train_loss = total_loss*batch_size/len(train_loader.dataset)
             total_test_loss = evaluate(model, test_loader, criterion, patch_size=patch_size, predict_res = predict_res)
@@ -317,16 +341,14 @@ if __name__ == "__main__":
             if counter_new != counter_old:
                 scheduler.step()  # update lr if early stop
                 counter_old = counter_new
+            checkpointer.save(training_state(epoch+1, 0, 0.))
             if Early_Stopping.early_stop:
                 break
+        checkpointer.wait()
 
         #save model
         if save_model:
-            if os.path.exists(root_dir + '/best_model.pth'):  # checking if there is a file with this name
-                os.remove(root_dir + '/best_model.pth')  # deleting the file
-                torch.save(model.state_dict(), root_dir + '/best_model.pth')
-            else:
-                torch.save(model.state_dict(), root_dir + '/best_model.pth')
+            save_checkpoint(model.state_dict(), root_dir + '/best_model.pth')
 ### Plot losses        
     xs = np.arange(len(train_losses))
     fig, ax = plt.subplots(nrows =1, ncols=1, figsize=(20,10))
@@ -1,5 +1,8 @@
 #!/bin/bash python
 import os
+import json
+import random
+import threading
 import numpy as np
 import pandas as pd
 import math
@@ -41,44 +44,64 @@ def to_windowed(data, meshed_blocks, pred_size, window_size , patch_size=(1,1,16
             out.append((feature,target))
         patches_per_block = None 
 
-    elif option == 'patch':
-        x1, x2, x3 = patch_size
-        nx1, nx2, nx3 = meshed_blocks
+    elif option in ['patch', 'patch_overlap']:
+        return patch_windows(data, meshed_blocks, pred_size, window_size, patch_size, option, patch_stride)
+            
+    return np.array(out), patches_per_block
 
-        vertices = []
-        for t in range(int((len(data)-nx1*nx2*nx3*window_size)/(nx1*nx2*nx3))):
-            for i in range(nx1//x1):
-                for j in range(nx2//x2):
-                    for k in range(nx3//x3):
-                        vertices.append(t*nx1*nx2*nx3 + i*x1*nx2*nx3 + j*x2*nx3 + k*x3)
-
-        for i in vertices:
-            feature  = np.array(data[[i + time*nx1*nx2*nx3 + j*(nx2*nx3) + k*(nx3) + l \
-                                for time in range(window_size-pred_size+1) for j in range(x1) for k in range(x2) for l in range(x3)]])
-            target  = np.array(data[[i + (time+pred_size)*nx1*nx2*nx3 + j*(nx2*nx3) + k*(nx3) + l \
-                                for time in range(window_size-pred_size+1) for j in range(x1) for k in range(x2) for l in range(x3)]])  
-            out.append((feature,target))
-        patches_per_block = np.prod([nx1//x1,nx2//x2,nx3//x3])
-        
-    elif option == 'patch_overlap':
+
+def patch_windows(data, meshed_blocks, pred_size, window_size, patch_size=(1,1,16), option='patch', patch_stride = (1,1,1)):
+    """
+    Strided view of the 'patch'/'patch_overlap' windows of data, no cell is copied
+    data: (T x nx1 x nx2 x nx3,) or (T x nx1 x nx2 x nx3, F) values in (time, x1, x2, x3) order
+    returns:
+        windows: torch view of shape (num_windows, n1, n2, n3, 2, W, p1, p2, p3[, F]), where (n1, n2, n3) indexes
+                 the patch inside a block, [..., 0, ...] is the source and [..., 1, ...] the target window. Flattening
+                 the leading 4 and the (W, p1, p2, p3) dims gives the (num_windows, 2, W*p1*p2*p3[, F]) layout
+        patches_per_block: n1*n2*n3
+    """
+    nx1, nx2, nx3 = meshed_blocks
+    base = torch.as_tensor(data if torch.is_tensor(data) else np.ascontiguousarray(data), dtype=torch.float32)
+    block = nx1*nx2*nx3
+    num_blocks = base.shape[0] // block
+    feature_shape = tuple(base.shape[1:])
+    row = int(np.prod(feature_shape))  ### elements per cell
+    feature_strides = tuple(base.stride()[1:])
+    if option == 'patch':
+        x1, x2, x3 = patch_size
+        num_patches = (nx1//x1, nx2//x2, nx3//x3)
+        patch_strides = (x1*nx2*nx3, x2*nx3, x3)
+        ### (time, x1, x2, x3) inside each window
+        window_shape = (window_size-pred_size+1, x1, x2, x3)
+        window_strides = (block, nx2*nx3, nx3, 1)
+        num_windows = num_blocks-window_size
+    else:
         x1, x2, x3 = patch_size
-        nx1, nx2, nx3 = meshed_blocks
         stride_x, stride_y, stride_z = patch_stride
-        vertices = []
-        for t in range(int((len(data)-nx1*nx2*nx3*window_size)/(nx1*nx2*nx3))):
-            for k in range(math.floor((nx3-x3)/stride_z+1)):
-                for j in range(math.floor((nx2-x2)/stride_y+1)):
-                    for i in range(math.floor((nx1-x1)/stride_x+1)):
-                        vertices.append(t*nx1*nx2*nx3 + k*nx1*nx2 + j*nx1 + i)
-        for i in vertices:
-            feature  = np.array(data[[i + time*nx1*nx2*nx3 + l*(nx2*nx3) + k*(nx3) + j \
-                                for time in range(window_size) for j in range(x1) for k in range(x2) for l in range(x3)]])
-            target  = np.array(data[[i + (time+pred_size)*nx1*nx2*nx3 + l*(nx2*nx3) + k*(nx3) + j \
-                                for time in range(window_size) for j in range(x1) for k in range(x2) for l in range(x3)]])      
-            out.append((feature,target))
-        patches_per_block = np.prod([nx1-x1+1,nx2-x2+1,nx3-x3+1])
-            
-    return np.array(out), patches_per_block
+        num_patches = ((nx1-x3)//stride_z+1, (nx2-x2)//stride_y+1, (nx3-x1)//stride_x+1)
+        patch_strides = (stride_z*nx2*nx3, stride_y*nx3, stride_x)
+        ### (time, x3, x2, x1) inside each window: patch_size[0] runs along the last axis of the block
+        window_shape = (window_size, x1, x2, x3)
+        window_strides = (block, 1, nx3, nx2*nx3)
+        ### the target window ends pred_size blocks after the source window
+        num_windows = num_blocks-window_size-pred_size+1
+    shape = (num_windows,) + num_patches + (2,) + window_shape + feature_shape
+    strides = tuple(row*s for s in (block,) + patch_strides + (pred_size*block,) + window_strides) + feature_strides
+    windows = base.as_strided(shape, strides)
+    patches_per_block = int(np.prod(num_patches))
+    return windows, patches_per_block
+
+
+def split_blocks(total_num_blocks, train_proportion, val_proportion, window_size, pred_size):
+    """
+    Block ranges [start, stop) of the train, val and test windows in the 'patch'/'patch_overlap' options,
+    each set starts on a new block. The test stop is None, i.e. up to the last window
+    """
+    window_adjust_length = (window_size-1)+pred_size ###Move the sliding window to cover the data lost on the edges
+    train_num_blocks = int(total_num_blocks*train_proportion)-window_adjust_length
+    val_num_blocks = int(total_num_blocks*val_proportion)
+    val_start_block = train_num_blocks
+    return (0, train_num_blocks), (val_start_block, val_start_block+val_num_blocks), (val_start_block+val_num_blocks, None)
 
 
 def train_test_val_split(data, meshed_blocks, train_proportion = 0.6, val_proportion = 0.2, test_proportion = 0.2\
@@ -91,47 +114,39 @@ def train_test_val_split(data, meshed_blocks, train_proportion = 0.6, val_propor
     if option in ['patch','patch_overlap']: ### Force each set start on a new block
         windows, patches_per_block = to_windowed(data, meshed_blocks, pred_size, window_size, patch_size, option)
         total_num_blocks = int(len(data)/np.prod(meshed_blocks)) #-(window_size-1)-(pred_size)
-        window_adjust_length = (window_size-1)+pred_size ###Move the sliding window to cover the data lost on the edges
-
-        train_num_blocks = int(total_num_blocks*train_proportion)-window_adjust_length
-        val_num_blocks = int(total_num_blocks*val_proportion)
+        (train_start, train_stop), (val_start, val_stop), (test_start, _) = split_blocks(total_num_blocks, \
+                                                    train_proportion, val_proportion, window_size, pred_size)
 
-        val_start_block = train_num_blocks
-
-        train_data_size = train_num_blocks*patches_per_block
-        val_data_size = val_num_blocks*patches_per_block
-
-        val_start_index = val_start_block*patches_per_block
-
-        train = windows[:train_data_size]
-        val = windows[val_start_index:val_start_index+val_data_size]
-        test = windows[val_start_index+val_data_size:]
+        ### windows are views indexed by (block, patch...), so the sets are slices of the block axis
+        train = windows[train_start:train_stop]
+        val = windows[val_start:val_stop]
+        test = windows[test_start:]
         # if option == 'patch_overlap': ###Retain the non-overlap test set in patch mode
         #     test = train_test_val_split(data, meshed_blocks, train_proportion, val_proportion, test_proportion, pred_size, scale, window_size, patch_size, option='patch')[2]
         #     test = test.numpy() ###Might not be efficient...
         # else: 
         #     test = windows[val_start_index+val_data_size:]
     else:
-        windows = to_windowed(data, meshed_blocks, pred_size, window_size, patch_size, option)
+        windows, _ = to_windowed(data, meshed_blocks, pred_size, window_size, patch_size, option)
 
         total_len = len(windows)
         train_len = int(total_len*train_proportion)
         val_len = int(total_len*val_proportion)
         
-        train = windows[0:train_len]
-        val = windows[train_len:(train_len+val_len)]
-        test = windows[(train_len+val_len):]
+        train = torch.from_numpy(windows[0:train_len])
+        val = torch.from_numpy(windows[train_len:(train_len+val_len)])
+        test = torch.from_numpy(windows[(train_len+val_len):])
     
     if add_noise == True:
         mu = noise[0]
         sigma = noise[1]
-        train_noise = np.random.normal(mu, sigma, train.shape)
-        train = train + train_noise
+        train_noise = np.random.normal(mu, sigma, tuple(train.shape))
+        train = train + torch.from_numpy(train_noise)
     
     print(train.shape,val.shape,test.shape)
-    train_data = torch.from_numpy(train).float()
-    val_data = torch.from_numpy(val).float()
-    test_data = torch.from_numpy(test).float()
+    train_data = train.float()
+    val_data = val.float()
+    test_data = test.float()
     
     return train_data,val_data,test_data,scaler
     
@@ -139,108 +154,602 @@ def train_test_val_split(data, meshed_blocks, train_proportion = 0.6, val_propor
 
 ## Adjust __init__ to fit the inputs
 class CustomDataset(torch.utils.data.Dataset):
-    def __init__(self,x,coords,timestamp):
+    """
+    window_dims: number of leading dims of x, coords and timestamp that index the windows,
+                 4 for the (block, n1, n2, n3) views returned by patch_windows
+    """
+    def __init__(self,x,coords,timestamp,window_dims=1):
         self.x=x
         self.coords=coords
         self.timestamp=timestamp
+        self.window_dims=window_dims
  
     def __len__(self):
-        return len(self.x)
+        return int(np.prod(self.x.shape[:self.window_dims]))
  
     def __getitem__(self,idx):
-        return((self.x[idx][0].view(-1,1), self.x[idx][1].view(-1,1)),(self.coords[idx][0], self.coords[idx][1]),(self.timestamp[idx][0].view(-1,1), self.timestamp[idx][1].view(-1,1)))
+        if self.window_dims > 1:
+            idx = np.unravel_index(idx, tuple(self.x.shape[:self.window_dims]))
+        x, coords, timestamp = self.x[idx], self.coords[idx], self.timestamp[idx]
+        return((x[0].reshape(-1,1), x[1].reshape(-1,1)),(coords[0].reshape(-1,coords.shape[-1]), coords[1].reshape(-1,coords.shape[-1])),(timestamp[0].reshape(-1,1), timestamp[1].reshape(-1,1)))
     
 
+class WindowDataset(torch.utils.data.Dataset):
+    """
+    'patch'/'patch_overlap' windows computed on the fly from the base series, items match CustomDataset
+    Only data is held, as a float32 tensor; the windows are views of it (see patch_windows), and the
+    coordinates and timestamps of a window are rebuilt from its patch and block index.
+    parameters:
+        data: (T x nx1 x nx2 x nx3,) array or tensor of values in (time, x1, x2, x3) order; a float32 tensor is used without copy
+        times: (T,) time of each block
+        block_range: (start, stop) blocks of the windows in this set, stop=None for up to the last window
+        noise: (mu, sigma) of gaussian noise added to the values of each window, or None. The noise of a
+               window only depends on seed and the window index (see counter_normal), so it is the same every epoch
+        return_coords: if False, items hold the (B,) patch index of each window in place of the coordinates,
+                       for models that precompute the embedding of patch_coords (see Transformer patch_coords)
+        origin: if data are residuals between consecutive blocks, the (T+1, nx1, nx2, nx3) absolute blocks they
+                were taken from, kept to reconstruct predicted residuals (see reconstruct_residual_rows)
+    """
+    def __init__(self, data, times, meshed_blocks, pred_size, window_size, patch_size=(4,4,4), option='patch', \
+                 block_range=(0,None), noise=None, seed=505, return_coords=True, origin=None):
+        self.data = torch.as_tensor(data if torch.is_tensor(data) else np.ascontiguousarray(data), dtype=torch.float32)
+        windows, self.patches_per_block = patch_windows(self.data, meshed_blocks, pred_size, window_size, patch_size, option)
+        start, stop = block_range
+        stop = windows.shape[0] if stop is None else stop
+        self.start = start
+        self.windows = windows[start:stop]
+        ### every block has the same cell coordinates, so window one coordinate series just long enough for one block of windows
+        nx1, nx2, nx3 = meshed_blocks
+        coord = np.transpose(np.array(np.meshgrid(np.arange(nx1),np.arange(nx2),np.arange(nx3))), axes=[2,1,3,0]).reshape(-1,3)
+        coord_windows = patch_windows(np.tile(coord, (window_size+pred_size,1)), meshed_blocks, pred_size, window_size, \
+                                      patch_size, option)[0][0]
+        ### (patches_per_block, 2, L, 3) coordinates of the source and target windows of each patch
+        self.coord_windows = coord_windows.reshape(self.patches_per_block, 2, -1, 3).contiguous()
+        ### (num_windows, 2, W) times of the source and target windows
+        self.times = torch.as_tensor(np.ascontiguousarray(times), dtype=torch.float32)
+        num_steps = self.windows.shape[5]
+        self.time_windows = self.times.as_strided((windows.shape[0], 2, num_steps), (1, pred_size, 1))[start:stop]
+        self.window_length = int(np.prod(self.windows.shape[5:9]))
+        ### (patches_per_block, patch_length, 3) coordinates of each patch, the same for every time step of a window
+        self.patch_coords = self.coord_windows[:, 0, :self.window_length//num_steps].long()
+        self.return_coords = return_coords
+        ### flat offsets for gathering a batch of windows from the base tensor in one indexing op
+        self.window_offsets = window_offsets(self.windows, 4)
+        self.noise = noise
+        self.seed = seed
+        self.origin = origin
+ 
+    def __len__(self):
+        return self.windows.shape[0]*self.patches_per_block
+ 
+    def __getitem__(self,idx):
+        (src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts) = self.__getitems__([idx])
+        return((src[0], tgt[0]),(src_coord[0], tgt_coord[0]),(src_ts[0], tgt_ts[0]))
+
+    def __getitems__(self, indices):
+        """
+        Gather a whole batch of windows with one indexing op per tensor, already collated as
+        ((src, tgt), (src_coord, tgt_coord), (src_ts, tgt_ts)) of shape (B, L, 1) or (B, L, 3).
+        Used by DataLoader in place of per-sample __getitem__ calls, see batch_collate
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f'window index out of range for {len(self)} windows')
+        batch_size = len(indices)
+        ### (B, 4) block and patch index of each window
+        lead = torch.from_numpy(np.stack(np.unravel_index(indices, tuple(self.windows.shape[:4])), axis=1))
+        x = gather_windows(self.data, self.window_offsets, lead).reshape(batch_size, 2, -1, 1)
+        if self.noise is not None:
+            ### the noise of the whole batch in one draw, keyed by the index of each window in the full series
+            noise = counter_normal(self.seed, indices + self.start*self.patches_per_block, x.shape[1:])
+            x = x + (self.noise[0] + self.noise[1]*noise)
+        patch_index = torch.from_numpy(indices % self.patches_per_block)
+        if self.return_coords:
+            coords = self.coord_windows.index_select(0, patch_index)
+            src_coord, tgt_coord = coords[:,0].contiguous(), coords[:,1].contiguous()
+        else:
+            src_coord, tgt_coord = patch_index, patch_index
+        patch_length = self.window_length//self.time_windows.shape[-1]
+        timestamp = self.time_windows[lead[:,0]].repeat_interleave(patch_length, dim=2).reshape(batch_size, 2, -1, 1)
+        ### contiguous like the collated CustomDataset items, the models view them
+        return((x[:,0].contiguous(), x[:,1].contiguous()),(src_coord, tgt_coord),(timestamp[:,0].contiguous(), timestamp[:,1].contiguous()))
+
+
+def window_offsets(windows, lead_dims):
+    """
+    Storage offsets of a strided window view: windows[idx] is base.take(offset + inner) with
+    offset = sum(idx*lead_strides) for an index idx over the leading lead_dims dims
+    returns (lead_strides, inner), inner includes the storage offset of the view
+    """
+    inner = torch.zeros((), dtype=torch.long)
+    for size, stride in zip(windows.shape[lead_dims:], windows.stride()[lead_dims:]):
+        inner = inner[...,None] + torch.arange(size)*stride
+    return torch.tensor(windows.stride()[:lead_dims]), windows.storage_offset() + inner
+
+
+def gather_windows(base, offsets, lead):
+    """Gather the windows at the (B, lead_dims) indices lead, see window_offsets"""
+    lead_strides, inner = offsets
+    start = (lead*lead_strides).sum(1)
+    return torch.take(base, start.view((-1,)+(1,)*inner.dim()) + inner)
+
+
+def _shift_right(z, bits):
+    """Logical right shift of int64 tensors, as for their uint64 bits"""
+    return (z >> bits).bitwise_and_((1 << (64-bits)) - 1)
+
+
+def _splitmix64(z):
+    """splitmix64 finalizer of int64 tensors, in place, the products wrapping around as uint64 ones"""
+    z = (z ^ _shift_right(z, 30)).mul_(-4658895280553007687) ### 0xBF58476D1CE4E5B9
+    z = (z ^ _shift_right(z, 27)).mul_(-7723592293110705685) ### 0x94D049BB133111EB
+    return z.bitwise_xor_(_shift_right(z, 31))
+
+
+def counter_normal(seed, keys, shape):
+    """
+    (len(keys), *shape) float32 standard normal values, those of each key a function of (seed, key) only, so they are
+    drawn in one vectorised op without a generator per key: the splitmix64 hash of every (key, pair of elements)
+    counter is split into two 24-bit uniforms and Box-Muller transformed into the pair
+    """
+    size = int(np.prod(shape))
+    pairs = (size+1)//2
+    counter = torch.as_tensor(np.asarray(keys), dtype=torch.int64).view(-1, 1)*pairs + torch.arange(1, pairs+1)
+    ### the splitmix64 sequence of the hashed seed, 0x9E3779B97F4A7C15 apart, at each counter
+    z = _splitmix64(counter.mul_(-7046029254386353131).add_(_splitmix64(torch.tensor(seed, dtype=torch.int64))))
+    u1 = _shift_right(z, 40).float().add_(0.5).mul_(2**-24)
+    angle = z.bitwise_and_(0xFFFFFF).float().mul_(2*math.pi*2**-24)
+    radius = u1.log_().mul_(-2).sqrt_()
+    normal = torch.cat([radius*torch.cos(angle), radius*torch.sin(angle)], dim=1)[:, :size]
+    return normal.reshape((len(counter),) + tuple(shape))
+
+
+def batch_collate(batch):
+    """collate_fn for datasets whose __getitems__ already returns a collated batch"""
+    return batch
+
+
+class WindowBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of consecutive window indices, so each batch covers neighbouring patches and blocks.
+    shuffle: shuffle the order of the batches every epoch, the windows inside a batch stay together
+    """
+    def __init__(self, num_windows, batch_size, shuffle=False, drop_last=False, seed=505):
+        self.num_windows = num_windows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_windows//self.batch_size
+        return math.ceil(self.num_windows/self.batch_size)
+
+    def __iter__(self):
+        starts = torch.arange(len(self))*self.batch_size
+        if self.shuffle:
+            starts = starts[torch.randperm(len(starts), generator=self.generator)]
+        for start in starts.tolist():
+            yield list(range(start, min(start+self.batch_size, self.num_windows)))
+
+
+def get_loader(dataset, batch_size, num_workers=0, pin_memory=True, prefetch_factor=16, shuffle=False):
+    """
+    DataLoader over a dataset; WindowDataset batches are gathered in one __getitems__ call per batch,
+    which makes num_workers=0 the fastest setting for it
+    """
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor) if num_workers > 0 else {}
+    if isinstance(dataset, WindowDataset):
+        return torch.utils.data.DataLoader(dataset, batch_sampler=WindowBatchSampler(len(dataset), batch_size, shuffle=shuffle), \
+                                           collate_fn=batch_collate, num_workers=num_workers, pin_memory=pin_memory, **worker_kwargs)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=False, \
+                                       num_workers=num_workers, pin_memory=pin_memory, **worker_kwargs)
+
+
+class TrainEngine():
+    """
+    Training epochs whose optimizer steps sum the gradients of accumulation_steps micro-batches, an effective batch of
+    accumulation_steps*batch_size; the batch losses are summed on the device and read once per epoch
+    loss_fn: maps a batch of the loader to its scalar loss
+    use_compile: wrap loss_fn (forward and loss) in torch.compile
+    """
+    def __init__(self, model, optimizer, loss_fn, accumulation_steps=1, use_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        self.loss_fn = torch.compile(loss_fn) if use_compile else loss_fn
+
+    def run_epoch(self, loader, start_batch=0, start_loss=0., rng=None, on_step=None):
+        """
+        One pass over loader; returns the sum of the batch losses, the only device sync of the epoch
+        start_batch, start_loss: resume a pass stopped after start_batch batches (a step boundary) whose losses summed
+                                 to start_loss, the skipped batches are drawn from loader but not computed
+        rng: rng_states restored once the skipped batches are drawn, so the rest of the pass draws the same noise
+             and dropout as the interrupted one
+        on_step: called as on_step(num_batches, total_loss) after every optimizer step, total_loss on the device
+        """
+        self.model.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        num_batches = len(loader)
+        total_loss = None
+        batches = iter(loader)
+        for _ in range(start_batch):
+            next(batches)
+        if rng is not None:
+            set_rng_states(rng)
+        for i, batch in enumerate(batches, start_batch):
+            ### the last step of the epoch may accumulate fewer micro-batches, its gradient is still their mean
+            group_start = i - i%self.accumulation_steps
+            group_size = min(self.accumulation_steps, num_batches-group_start)
+            loss = self.loss_fn(batch)
+            (loss/group_size).backward()
+            total_loss = loss.detach()+start_loss if total_loss is None else total_loss + loss.detach()
+            if i+1 == group_start+group_size:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+                if on_step is not None:
+                    on_step(i+1, total_loss)
+        return float(start_loss) if total_loss is None else total_loss.item()
+
+
+def rng_states():
+    """RNG states of python, numpy, torch and the cuda devices, restored by set_rng_states"""
+    ### the numpy keys as a tensor, so checkpoints holding the states load with torch.load(weights_only=True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    states = {'python': random.getstate(), 'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian), \
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def _detached_copy(state):
+    """Copy of a nested dict/list/tuple of states with every tensor cloned to cpu"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _detached_copy(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_detached_copy(value) for value in state)
+    return state
+
+def save_checkpoint(state, path):
+    """torch.save to a temporary file renamed over path, so path is never left holding a partly written file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class AsyncCheckpointer():
+    """
+    Checkpoints of a training run written by a background thread. save copies the state to cpu on the calling thread,
+    so training can go on while it is written; one write is in flight at a time.
+    path: checkpoint file, replaced atomically by every save, see save_checkpoint
+    """
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.error = None
+
+    def _write(self, state):
+        try:
+            save_checkpoint(state, self.path)
+        except Exception as error:
+            self.error = error
+
+    def save(self, state):
+        self.wait()
+        state = _detached_copy(state)
+        self.thread = threading.Thread(target=self._write, args=(state,))
+        self.thread.start()
+
+    def wait(self):
+        """Block until the last save is on disk, and raise its error if it failed"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self, map_location='cpu'):
+        """The last complete checkpoint, None if there is none"""
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, map_location=map_location)
+
+
+DEC_IN_METHODS = ('mean', 'repeat', 'zero', 'residual_repeat')
+
+def build_dec_in(context, method='zero', pred_blocks=1):
+    """
+    Decoder input of an autoregressive step for the whole batch at once: the known context blocks followed
+    by pred_blocks padding blocks standing in for the blocks to predict
+    context: (B, K, *block_shape, C) known blocks, a block is one patch (patch_length, ) or one snapshot (nx1, nx2, nx3)
+    method:
+        'mean': every cell of the padding is the mean of that cell over the K context blocks and the C channels
+        'repeat': the last context block repeated
+        'zero': zeros
+        'residual_repeat': the K-1 residuals between consecutive context blocks, followed by the last residual repeated
+    returns: (B, K+pred_blocks, *block_shape, C), K-1+pred_blocks blocks for 'residual_repeat'
+    """
+    if method not in DEC_IN_METHODS:
+        raise ValueError(f'Unknown decoder input method {method}, expect one of {DEC_IN_METHODS}')
+    if method == 'residual_repeat':
+        context = context[:,1:] - context[:,:-1]
+    if method == 'mean':
+        padding = context.mean(dim=(1,-1), keepdim=True)
+    elif method in ['repeat', 'residual_repeat']:
+        padding = context[:,-1:]
+    else:
+        padding = context.new_zeros((1,1)+tuple(context.shape[2:]))
+    padding = padding.expand((context.shape[0], pred_blocks)+tuple(context.shape[2:]))
+    return torch.cat([context, padding], dim=1)
+
+class RingContext():
+    """
+    Fixed-size autoregressive context: the last num_blocks blocks of a rollout along dim, kept in one
+    preallocated tensor that new blocks overwrite in place instead of growing the history with torch.cat
+    init: first context, num_blocks = init.shape[dim]
+    """
+    def __init__(self, init, dim=0):
+        self.dim = dim
+        self.buffer = init.clone()
+        self.num_blocks = init.shape[dim]
+        self.head = 0 ### position of the oldest block
+
+    def push(self, blocks):
+        """Replace the oldest blocks.shape[dim] blocks by blocks"""
+        index = (self.head + torch.arange(blocks.shape[self.dim], device=self.buffer.device)) % self.num_blocks
+        self.buffer.index_copy_(self.dim, index, blocks.to(self.buffer.dtype))
+        self.head = (self.head + blocks.shape[self.dim]) % self.num_blocks
+
+    def get(self):
+        """The context in time order, oldest block first"""
+        if self.head == 0:
+            return self.buffer
+        return torch.roll(self.buffer, -self.head, dims=self.dim)
+
+
+class RolloutWriter():
+    """
+    Preallocated host buffers for the per-step outputs of a rollout whose length is known up front.
+    With cuda the buffers are pinned and device-to-host copies are asynchronous, result() waits for them
+    columns: {name: width} of each output, a width of 0 gives a 1-d buffer
+    """
+    def __init__(self, num_rows, columns, dtype=torch.float32):
+        self.pin = torch.cuda.is_available()
+        self.buffers = {name: torch.empty((num_rows, width) if width else (num_rows,), dtype=dtype, pin_memory=self.pin) \
+                        for name, width in columns.items()}
+        self.num_rows = num_rows
+        self.pos = 0
+
+    def write(self, **outputs):
+        """Append the rows of each named output, flattened to the width of its column"""
+        num_rows = None
+        for name, x in outputs.items():
+            buffer = self.buffers[name]
+            rows = x.detach().reshape((-1,) + tuple(buffer.shape[1:]))
+            num_rows = rows.shape[0] if num_rows is None else num_rows
+            if rows.shape[0] != num_rows or self.pos + num_rows > self.num_rows:
+                raise ValueError(f'{rows.shape[0]} rows of {name} do not fit the rollout buffers at row {self.pos} of {self.num_rows}')
+            buffer[self.pos:self.pos+num_rows].copy_(rows, non_blocking=self.pin)
+        self.pos += num_rows or 0
+
+    def result(self):
+        """The written rows of every output"""
+        if self.pin:
+            torch.cuda.synchronize()
+        return {name: buffer[:self.pos] for name, buffer in self.buffers.items()}
+    
+
+def sort_grid_rows(a):
+    """
+    Rows of a (N, 4+k) table of (time, x1, x2, x3, values...) in (time, x1, x2, x3) order, the order of
+    chained stable argsorts on x3, x2, x1 and time. Rows of a complete grid are scattered straight to their
+    linear index in O(N); duplicated or missing cells, or non-integer coordinates, fall back to np.lexsort
+    """
+    a = np.asarray(a)
+    ### rank of each row's time among the distinct times, by hashing instead of sorting all rows
+    time_codes, times = pd.factorize(a[:,0])
+    time_rank = np.empty(len(times), dtype=np.int64)
+    time_rank[np.argsort(times, kind='stable')] = np.arange(len(times))
+    coords = a[:,1:4].astype(np.int64)
+    if len(a) and np.array_equal(coords, a[:,1:4]) and coords.min() >= 0:
+        shape = (len(times),) + tuple(coords.max(axis=0)+1)
+        if np.prod(shape) == len(a):
+            linear = np.ravel_multi_index((time_rank[time_codes],) + tuple(coords.T), shape)
+            order = np.full(len(a), -1, dtype=np.int64)
+            order[linear] = np.arange(len(a))
+            if (order >= 0).all(): ### every cell exactly once
+                return a[order]
+    return a[np.lexsort((a[:,3], a[:,2], a[:,1], a[:,0]))]
+
+def reconstruct_residual_rows(a, origin, times):
+    """
+    Absolute values of a (N, 6) table of (time, x1, x2, x3, prediction, truth) residual rows, residual[t] = x[t]-x[t-1].
+    Rows are averaged per (time, cell) onto a (T, nx1*nx2*nx3) grid, which is accumulated over time from the
+    last observed block before the first predicted time, so nothing is read back from disk
+        origin: (len(times)+1, nx1, nx2, nx3) absolute blocks of the series, residual block t goes from origin[t] to origin[t+1]
+        times: (len(times),) time of each residual block of the series
+    returns: (T*nx1*nx2*nx3, 6) table in (time, x1, x2, x3) order, truth is reconstructed the same way as a check
+    """
+    a = np.asarray(a, dtype=np.float64)
+    origin = np.asarray(origin, dtype=np.float64)
+    grid = origin.shape[1:]
+    num_cells = int(np.prod(grid))
+    pred_times, time_index = np.unique(a[:,0], return_inverse=True)
+    ### position of the first predicted time in the series, the predicted blocks have to follow it to be accumulated
+    times = np.asarray(times, dtype=np.float64)
+    start = np.searchsorted(times, pred_times[0])
+    if not np.array_equal(times[start:start+len(pred_times)], pred_times):
+        raise ValueError('residual rows have to cover consecutive blocks of the series')
+    cell = np.ravel_multi_index(tuple(a[:,1:4].astype(np.int64).T), grid)
+    linear = time_index.reshape(-1)*num_cells + cell
+    counts = np.bincount(linear, minlength=len(pred_times)*num_cells).reshape(len(pred_times), num_cells)
+    if (counts == 0).any():
+        raise ValueError('residual rows have to cover every cell of every predicted block')
+    seed = origin[start].reshape(-1)
+    columns = [seed + np.cumsum(np.bincount(linear, weights=a[:,j], minlength=counts.size).reshape(counts.shape)/counts, axis=0) \
+               for j in (4, 5)]
+    coord = np.stack(np.unravel_index(np.arange(num_cells), grid), axis=1)
+    return np.hstack([np.repeat(pred_times, num_cells).reshape(-1,1), np.tile(coord, (len(pred_times),1))] + \
+                     [c.reshape(-1,1) for c in columns])
+
+def load_cache(cache_path):
+    """
+    Open a tensor written by get_csv.save_cache without copying it into memory
+    returns:
+        data: np.memmap of shape (T, nx1, nx2, nx3, C)
+        metadata: dict with 'time', 'var_names', 'mean' and 'std' of each variable
+    """
+    data = np.load(cache_path, mmap_mode='r')
+    with open(os.path.splitext(cache_path)[0] + '.json') as f:
+        metadata = json.load(f)
+    return data, metadata
+
+
+def cache_scaler(metadata, var_name):
+    """StandardScaler of var_name set from the mean and std of a load_cache sidecar, without a pass over the data"""
+    index = metadata['var_names'].index(var_name)
+    mean, std = metadata['mean'][index], metadata['std'][index]
+    scaler = StandardScaler()
+    scaler.mean_, scaler.var_, scaler.scale_ = np.array([mean]), np.array([std**2]), np.array([std if std > 0 else 1.])
+    scaler.n_features_in_, scaler.n_samples_seen_ = 1, int(np.prod(metadata['shape'][:4]))
+    return scaler
+
+
 def get_data_loaders(train_proportion = 0.5, test_proportion = 0.25, val_proportion = 0.25, \
                         pred_size =1, batch_size = 16, num_workers = 1, pin_memory = True, \
                         use_coords = True, use_time = True, test_mode = False, scale = False, \
                         window_size = 10, grid_size = 16, patch_size=(4,4,4), option='patch', predict_res=False, \
-                        add_noise=True, noise=(0,1e-2), csv_path = '/scratch/zh2095/nyu-capstone/data/data_original_16.csv'): 
+                        add_noise=True, noise=(0,1e-2), csv_path = '/scratch/zh2095/nyu-capstone/data/data_original_16.csv', \
+                        cache_path = None, target_var = 'rho'): 
+    """
+    cache_path: path of a .npy tensor written by get_csv.save_cache; if given, it is read instead of csv_path
+    target_var: variable of the cached tensor to use as target
+    use_coords: in the 'patch'/'patch_overlap' options, False gives the patch index of each window instead of
+                its coordinates, see WindowDataset return_coords
+    predict_res: if True, the sets hold the residuals between consecutive blocks, labelled by the time of the later
+                 block; the unscaled absolute series stays in memory as WindowDataset origin
+    """
     np.random.seed(505)
     
-    df = pd.read_csv(csv_path)
-    data = df['target'].to_numpy()
-    coords = df[['x1','x2','x3']].to_numpy()
-    timestamps = df['time'].to_numpy()
     meshed_blocks = (grid_size, grid_size, grid_size)
+    scaler = None
+    if cache_path is not None:
+        cache, metadata = load_cache(cache_path)
+        var_index = metadata['var_names'].index(target_var)
+        ### the grid is the one of the cache, the series stays a view of the memmap
+        meshed_blocks = tuple(cache.shape[1:4])
+        data = cache[..., var_index].reshape(-1)
+        times = np.array(metadata['time'])
+        if not predict_res:
+            scaler = cache_scaler(metadata, target_var)
+        ### per-cell coords and timestamps are only stored by the 'space' and 'time' options
+        coords, timestamps = None, None
+        if option not in ['patch','patch_overlap']:
+            coord = np.transpose(np.array(np.meshgrid(*[np.arange(n) for n in meshed_blocks])), axes=[2,1,3,0]).reshape(-1,3)
+            coords = np.tile(coord, (cache.shape[0],1))
+            timestamps = np.repeat(times, np.prod(meshed_blocks))
+    else:
+        df = pd.read_csv(csv_path)
+        data = df['target'].to_numpy()
+        coords = df[['x1','x2','x3']].to_numpy()
+        timestamps = df['time'].to_numpy()
+        times = timestamps[::np.prod(meshed_blocks)]
+
+    origin = None
+    if predict_res:
+        ### residual t goes from origin[t] to origin[t+1], the first block only seeds the reconstruction
+        num_cells = int(np.prod(meshed_blocks))
+        origin = torch.from_numpy(np.array(data, dtype=np.float32).reshape((-1,)+meshed_blocks))
+        data = (origin[1:]-origin[:-1]).numpy().reshape(-1)
+        times = times[1:]
+        if coords is not None:
+            coords, timestamps = coords[num_cells:], timestamps[num_cells:]
 
     ###FOR SIMPLE TEST SINE AND COSINE 
     #long_range_stationary_x_vals = (np.sin(2*np.pi*time_vec/period))+(np.cos(3*np.pi*time_vec/period)) + 0.25*np.random.randn(time_vec.size)
     ###FOR ARFIMA TEST
     #data = arfima([0.5,0.4],0.3,[0.2,0.1],10000,warmup=2^10)
 
-    if use_coords:
-        print('-'*20,'split for coords')
-        train_coords,val_coords,test_coords, _ = train_test_val_split(\
-            coords, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
-            , val_proportion = val_proportion, test_proportion = test_proportion\
-            , pred_size = pred_size, scale = False, window_size = window_size, \
-            patch_size = patch_size, option = option, add_noise=False, noise=(0,1e-2))
-        print(f'train_coords: {train_coords.shape}')
+    if option in ['patch','patch_overlap']:
+        ### Windows, coords and timestamps are built per item from the base series
+        if scaler is None:
+            scaler = StandardScaler()
+            if scale == True:
+                scaler.fit(data.reshape(-1, 1))
+        data = torch.from_numpy(np.array(data, dtype=np.float32)) ### one writable float32 copy shared by the three sets
+        if scale == True:
+            data.sub_(float(scaler.mean_[0])).div_(float(scaler.scale_[0]))
+        if num_workers > 0:
+            data.share_memory_() ### DataLoader workers map it instead of receiving their own copy
+        train_range, val_range, test_range = split_blocks(len(times), train_proportion, val_proportion, window_size, pred_size)
+        if test_mode:
+            val_range, test_range = (val_range[0], None), None
+        window_kwargs = dict(meshed_blocks = meshed_blocks, pred_size = pred_size, window_size = window_size, \
+                             patch_size = patch_size, option = option, return_coords = use_coords, origin = origin)
+        dataset_train = WindowDataset(data, times, block_range = train_range, \
+                                      noise = noise if add_noise else None, **window_kwargs)
+        dataset_val = WindowDataset(data, times, block_range = val_range, **window_kwargs)
+        dataset_test = WindowDataset(data, times, block_range = test_range, **window_kwargs) if test_range else None
+        print(f'train windows: {len(dataset_train)}, val windows: {len(dataset_val)}, test windows: {len(dataset_test) if dataset_test else 0}')
+    else:
+        if use_coords:
+            print('-'*20,'split for coords')
+            train_coords,val_coords,test_coords, _ = train_test_val_split(\
+                coords, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
+                , val_proportion = val_proportion, test_proportion = test_proportion\
+                , pred_size = pred_size, scale = False, window_size = window_size, \
+                patch_size = patch_size, option = option, add_noise=False, noise=(0,1e-2))
+            print(f'train_coords: {train_coords.shape}')
+
 
+        if use_time:
+            print('-'*20,'split for timestamp')
+            train_timestamps,val_timestamps,test_timestamps, _ = train_test_val_split(\
+                timestamps, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
+                , val_proportion = val_proportion, test_proportion = test_proportion\
+                , pred_size = pred_size, scale = False, window_size = window_size, \
+                 patch_size = patch_size, option = option, add_noise=False, noise=(0,1e-2))
+            print(f'train_timestamps: {train_timestamps.shape}')
 
-    if use_time:
-        print('-'*20,'split for timestamp')
-        train_timestamps,val_timestamps,test_timestamps, _ = train_test_val_split(\
-            timestamps, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
+        print('-'*20,'split for data')
+        train_data,val_data,test_data, scaler = train_test_val_split(\
+            data, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
             , val_proportion = val_proportion, test_proportion = test_proportion\
-            , pred_size = pred_size, scale = False, window_size = window_size, \
-             patch_size = patch_size, option = option, add_noise=False, noise=(0,1e-2))
-        print(f'train_timestamps: {train_timestamps.shape}')
-
-    print('-'*20,'split for data')
-    train_data,val_data,test_data, scaler = train_test_val_split(\
-        data, meshed_blocks = meshed_blocks, train_proportion = train_proportion\
-        , val_proportion = val_proportion, test_proportion = test_proportion\
-        , pred_size = pred_size, scale = scale, window_size = window_size, \
-        patch_size = patch_size, option = option, add_noise=add_noise, noise=(0,1e-2))
-    print(f'train_data: {train_data.shape}')
-
-#----------------------------------------------------------------
-### Save the original data table for reconstructing from residual predictions. May need to be optimized?
-    if predict_res: 
-        a = np.hstack([timestamps.reshape(-1,1), coords, data_original.reshape(-1,1)])
-        a = a[np.argsort(a[:, 3])]
-        a = a[np.argsort(a[:, 2], kind='stable')]
-        a = a[np.argsort(a[:, 1], kind='stable')]
-        a = a[np.argsort(a[:, 0], kind='stable')]
-        if scale==True:
-            data_origin_dict = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'truth_original':scaler.inverse_transform(a[:,4])}
-        elif scale==False:
-            data_origin_dict = {'time': a[:,0], 'x1': a[:,1], 'x2': a[:,2], 'x3': a[:,3], 'truth_original':a[:,4]}
-        data_origin_df = pd.DataFrame.from_dict(data_origin_dict)
-        data_origin_df.to_csv('/scratch/zh2095/nyu-capstone/yd_test/tune_results/' + '/data_original.csv')
-        #print(data_origin_df,flush=True)
- #----------------------------------------------------------------   
+            , pred_size = pred_size, scale = scale, window_size = window_size, \
+            patch_size = patch_size, option = option, add_noise=add_noise, noise=(0,1e-2))
+        print(f'train_data: {train_data.shape}')
+
+        dataset_train = CustomDataset(train_data,train_coords,train_timestamps)
+        if test_mode:
+            ### Get the first block in test_original to perform rollout that gives back the original data based on predicted residuals
+            dataset_val = CustomDataset(torch.cat((val_data, test_data),0),torch.cat((val_coords,test_coords),0),torch.cat((val_timestamps,test_timestamps),0))
+        else:
+            dataset_val = CustomDataset(val_data,val_coords,val_timestamps)
+            dataset_test = CustomDataset(test_data,test_coords,test_timestamps)
+
 
     if test_mode:
-        val_test_data = torch.cat((val_data, test_data),0)
-        val_test_coords = torch.cat((val_coords,test_coords),0)
-        val_test_timestamps = torch.cat((val_timestamps,test_timestamps),0)
-
-        ### Get the first block in test_original to perform rollout that gives back the original data based on predicted residuals
-
-        dataset_train, dataset_test = CustomDataset(train_data,train_coords,train_timestamps), CustomDataset(val_test_data,val_test_coords,val_test_timestamps)
-        train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size, \
-                                        drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                        persistent_workers=True, prefetch_factor = 16)
-        test_loader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size, \
-                                        drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                        persistent_workers=True, prefetch_factor = 128) 
+        train_loader = get_loader(dataset_train, batch_size, num_workers, pin_memory, prefetch_factor = 16)
+        test_loader = get_loader(dataset_val, batch_size, num_workers, pin_memory, prefetch_factor = 128)
         return train_loader, test_loader, scaler
     if not test_mode:                           
-        dataset_train, dataset_test, dataset_val = CustomDataset(train_data,train_coords,train_timestamps), CustomDataset(test_data,test_coords,test_timestamps), CustomDataset(val_data,val_coords,val_timestamps)
-
-        train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-        test_loader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-        val_loader = torch.utils.data.DataLoader(dataset_val, batch_size=batch_size, \
-                                            drop_last=False, num_workers=num_workers, pin_memory=pin_memory,\
-                                            persistent_workers=True, prefetch_factor = 16)
-       
+        train_loader = get_loader(dataset_train, batch_size, num_workers, pin_memory, prefetch_factor = 16)
+        test_loader = get_loader(dataset_test, batch_size, num_workers, pin_memory, prefetch_factor = 16)
+        val_loader = get_loader(dataset_val, batch_size, num_workers, pin_memory, prefetch_factor = 16)
         return train_loader,val_loader, test_loader
 
 # img_dir = 'figs' ###dir to save images to